@@ -0,0 +1,158 @@
+"""
+CPU cost of broadcasting one caption as the number of clients grows.
+
+Compares encoding the caption for every client, which is what calling
+send_json on each socket did, with encoding it once for all of them using each
+available encoder. The `broadcast` numbers go through ConnectionManager with
+sockets that send instantly, so they include queueing and the writer tasks.
+
+Run from hand/app:
+
+    python -m benchmarks.caption_encoding --clients 1 10 100 1000
+
+The report is JSON with the commit it ran on, so runs can be compared across
+commits with --output.
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import sys
+import time
+from typing import Callable, Dict, List
+
+from benchmarks.queue_latency import git_commit
+from core.encoding import ENCODERS, Encoder, encode_stdlib
+from routes.captions_ws import ConnectionManager
+
+
+def make_caption(index: int) -> dict:
+    # an interim caption part way through a sentence
+    return {
+        "type": "caption",
+        "captionId": f"speaker{index // 20}",
+        "transcript": "so the next thing we look at is how the queue " * 2,
+        "identity": "speaker",
+        "timestamp": 1_700_000_000_000 + index,
+    }
+
+
+def cpu_us_per_caption(run: Callable[[dict], None], captions: int) -> float:
+    started = time.process_time()
+    for i in range(captions):
+        run(make_caption(i))
+    return (time.process_time() - started) / captions * 1_000_000
+
+
+def encode_per_client(clients: int) -> Callable[[dict], None]:
+    def run(message: dict) -> None:
+        for _ in range(clients):
+            encode_stdlib(message)
+
+    return run
+
+
+def encode_once(encode: Encoder, clients: int) -> Callable[[dict], None]:
+    def run(message: dict) -> None:
+        text = encode(message)
+        for _ in range(clients):
+            # what each writer gets handed
+            _ = text
+
+    return run
+
+
+class NullWebSocket:
+    async def accept(self) -> None:
+        pass
+
+    async def send_text(self, message: str) -> None:
+        pass
+
+    async def close(self, code: int = 1000) -> None:
+        pass
+
+
+async def broadcast_us_per_caption(
+    encode: Encoder, clients: int, captions: int
+) -> float:
+    manager = ConnectionManager(encode)
+    websockets = [NullWebSocket() for _ in range(clients)]
+    for websocket in websockets:
+        await manager.connect(websocket)
+
+    started = time.process_time()
+    for i in range(captions):
+        manager.broadcast(make_caption(i))
+        # let every writer send it before the next one
+        await asyncio.sleep(0)
+    elapsed = time.process_time() - started
+
+    for websocket in websockets:
+        await manager.disconnect(websocket)
+    return elapsed / captions * 1_000_000
+
+
+async def run_scenario(clients: int, captions: int) -> Dict[str, object]:
+    encode_us: Dict[str, float] = {
+        "per_client_json": cpu_us_per_caption(encode_per_client(clients), captions)
+    }
+    broadcast_us: Dict[str, float] = {}
+    for name, encode in ENCODERS.items():
+        encode_us[f"once_{name}"] = cpu_us_per_caption(
+            encode_once(encode, clients), captions
+        )
+        broadcast_us[name] = await broadcast_us_per_caption(encode, clients, captions)
+
+    return {
+        "clients": clients,
+        "captions": captions,
+        "encode_cpu_us_per_caption": encode_us,
+        "broadcast_cpu_us_per_caption": broadcast_us,
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    results: List[Dict[str, object]] = []
+    for clients in args.clients:
+        print(f"Running with {clients} clients", file=sys.stderr)
+        results.append(await run_scenario(clients, args.captions))
+
+    return {
+        **git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "config": {"captions": args.captions, "encoders": list(ENCODERS)},
+        "results": results,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "--clients",
+        type=int,
+        nargs="+",
+        default=[1, 10, 100, 1000],
+        help="Number of caption clients. One run per value.",
+    )
+    parser.add_argument(
+        "--captions", type=int, default=500, help="Captions broadcast per run."
+    )
+    parser.add_argument("--output", help="Also write the report to this file.")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    report = asyncio.run(run(args))
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+"""
+End-to-end latency of a raised hand reaching queue subscribers.
+
+Runs the app in this process with the mock GPIO from conftest.py. Simulated sse
+clients are driven straight through ASGI, and hands are raised and lowered with
+POST /api/raisehand at a fixed rate. For every raise, the time from sending the
+POST to each client receiving a frame that has the new identity is recorded.
+
+Run from hand/app:
+
+    python -m benchmarks.queue_latency --clients 10 100 1000 --rate 20 --duration 10
+
+The report is JSON with the commit it ran on, so runs can be compared across
+commits with --output.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from array import array
+from typing import Dict, List, Optional, Tuple, Union
+
+# sets PYTEST_RUNNING and replaces RPi.GPIO, so this has to come before the app
+import conftest  # noqa: F401
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def summarize_ms(values: List[float]) -> Dict[str, float]:
+    ordered = sorted(values)
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered) * 1000 if ordered else 0.0,
+        "p50": percentile(ordered, 0.50) * 1000,
+        "p95": percentile(ordered, 0.95) * 1000,
+        "p99": percentile(ordered, 0.99) * 1000,
+        "max": (ordered[-1] if ordered else 0.0) * 1000,
+    }
+
+
+def git_commit() -> Dict[str, Union[str, bool, None]]:
+    def git(*args: str) -> Optional[str]:
+        try:
+            result = subprocess.run(
+                ["git", *args], capture_output=True, text=True, check=True
+            )
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        return result.stdout.strip()
+
+    status = git("status", "--porcelain", "--untracked-files=no")
+    return {
+        "commit": git("rev-parse", "HEAD"),
+        "dirty": None if status is None else bool(status),
+    }
+
+
+class SseClient:
+    """
+    A queue subscriber talking to the app through ASGI. Each frame body is
+    compared with the previous one to find identities that just joined, and the
+    latency since their raise was sent is recorded.
+    """
+
+    def __init__(self, app, room: str, raised_at: Dict[str, float], stats) -> None:
+        self.app = app
+        self.room = room
+        self.raised_at = raised_at
+        self.stats = stats
+        self.connected = asyncio.Event()
+        self.frames = 0
+
+        self._disconnect = asyncio.Event()
+        self._request_sent = False
+        self._previous = b""
+
+    async def receive(self) -> dict:
+        if not self._request_sent:
+            self._request_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await self._disconnect.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(self, message: dict) -> None:
+        if message["type"] == "http.response.start":
+            return
+
+        body = message.get("body", b"")
+        if not body.startswith(b"data:"):
+            # pings and the final empty body
+            return
+
+        now = time.perf_counter()
+        self.frames += 1
+        for identity in self.stats.new_identities(self._previous, body):
+            raised_at = self.raised_at.get(identity)
+            if raised_at is not None:
+                self.stats.latencies.append(now - raised_at)
+        self._previous = body
+
+        self.connected.set()
+
+    async def run(self) -> None:
+        query = f"room={self.room}".encode()
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": "/api/queue",
+            "raw_path": b"/api/queue",
+            "query_string": query,
+            "root_path": "",
+            "headers": [(b"host", b"bench")],
+            "client": ("127.0.0.1", 0),
+            "server": ("bench", 80),
+        }
+        await self.app(scope, self.receive, self.send)
+
+    def close(self) -> None:
+        self._disconnect.set()
+
+
+class DeliveryStats:
+    def __init__(self) -> None:
+        self.latencies = array("d")
+        # every client sees the same few frame bodies, so diff each pair once
+        self._diffs: Dict[Tuple[bytes, bytes], List[str]] = {}
+
+    def new_identities(self, previous: bytes, body: bytes) -> List[str]:
+        key = (previous, body)
+        diff = self._diffs.get(key)
+        if diff is None:
+            before = set(json.loads(previous[5:])) if previous else set()
+            diff = [i for i in json.loads(body[5:]) if i not in before]
+            self._diffs[key] = diff
+        return diff
+
+
+async def run_scenario(
+    clients: int, rate: float, duration: float, queue_size: int, room: str
+) -> dict:
+    import httpx
+
+    from core import state_backend
+    from main import app
+    from routes import queue_sse
+
+    # every scenario starts from an empty queue
+    state_backend._backend = state_backend.MemoryBackend()
+    queue_sse.rooms.clear()
+
+    raised_at: Dict[str, float] = {}
+    stats = DeliveryStats()
+
+    sse_clients = [SseClient(app, room, raised_at, stats) for _ in range(clients)]
+    tasks = [asyncio.create_task(sse_clients[0].run())]
+    # the first client also sets up the room, so it's left out of the memory use
+    await sse_clients[0].connected.wait()
+
+    tracemalloc.start()
+    memory_before, _ = tracemalloc.get_traced_memory()
+
+    tasks += [asyncio.create_task(client.run()) for client in sse_clients[1:]]
+    await asyncio.gather(*(client.connected.wait() for client in sse_clients))
+
+    memory_after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    post_latencies: List[float] = []
+    queued: List[str] = []
+    operations = int(rate * duration)
+    interval = 1 / rate
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+
+        async def post(mode: str, identity: str) -> None:
+            start = time.perf_counter()
+            if mode == "RAISE":
+                raised_at[identity] = start
+            payload = {"mode": mode, "identity": identity, "room": room}
+            response = await http.post("/api/raisehand", json=payload)
+            response.raise_for_status()
+            post_latencies.append(time.perf_counter() - start)
+
+        started = time.perf_counter()
+        requests = []
+        for n in range(operations):
+            # a fixed schedule so runs are comparable
+            delay = started + n * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            if len(queued) >= queue_size:
+                requests.append(asyncio.create_task(post("LOWER", queued.pop(0))))
+            else:
+                identity = f"bench-{n}"
+                queued.append(identity)
+                requests.append(asyncio.create_task(post("RAISE", identity)))
+
+        await asyncio.gather(*requests)
+        elapsed = time.perf_counter() - started
+
+        # let the last coalesced update reach everyone
+        await asyncio.sleep(queue_sse.QUEUE_COALESCE_SECONDS + 0.5)
+
+    for client in sse_clients:
+        client.close()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    frames = sum(client.frames for client in sse_clients)
+    raises = len(raised_at)
+    return {
+        "clients": clients,
+        "operations": operations,
+        "raises": raises,
+        "operations_per_second": operations / elapsed,
+        "frames_delivered": frames,
+        "frames_per_second": frames / elapsed,
+        # every client should see every raise unless it joined and left
+        # within one coalescing window
+        "deliveries_expected": raises * clients,
+        "delivery_latency_ms": summarize_ms(stats.latencies.tolist()),
+        "post_latency_ms": summarize_ms(post_latencies),
+        "memory_per_subscriber_bytes": (
+            (memory_after - memory_before) / (clients - 1) if clients > 1 else None
+        ),
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    from routes import queue_sse
+
+    results = []
+    for clients in args.clients:
+        print(f"Running with {clients} clients", file=sys.stderr)
+        results.append(
+            await run_scenario(
+                clients, args.rate, args.duration, args.queue_size, args.room
+            )
+        )
+
+    return {
+        **git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "config": {
+            "rate": args.rate,
+            "duration": args.duration,
+            "queue_size": args.queue_size,
+            "room": args.room,
+            "coalesce_ms": queue_sse.QUEUE_COALESCE_SECONDS * 1000,
+        },
+        "results": results,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "--clients",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000, 5000],
+        help="Number of sse clients. One run per value.",
+    )
+    parser.add_argument(
+        "--rate", type=float, default=20, help="Raise and lower requests per second."
+    )
+    parser.add_argument(
+        "--duration", type=float, default=10, help="Seconds of requests per run."
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=20,
+        dest="queue_size",
+        help="Once this many hands are up, the oldest is lowered instead.",
+    )
+    parser.add_argument(
+        "--room",
+        default="Benchmark",
+        help="Room to raise hands in. Use the hand room to include the servo.",
+    )
+    parser.add_argument("--output", help="Also write the report to this file.")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    # the connection limit is per server, raise it so every client gets in
+    os.environ["MAX_SSE_CONNECTIONS"] = str(max(args.clients) + 1)
+    # and don't rate limit the raises
+    os.environ["GLOBAL_HAND_RATE_PER_SECOND"] = str(args.rate * 2)
+
+    report = asyncio.run(run(args))
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
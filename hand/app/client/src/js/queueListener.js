@@ -1,4 +1,8 @@
-const eventSource = new EventSource("/api/queue");
+// show the queue of the room in the page url, e.g. /queue?room=Classroom
+const room = new URLSearchParams(window.location.search).get("room");
+const eventSource = new EventSource(
+  room ? `/api/queue?room=${encodeURIComponent(room)}` : "/api/queue"
+);
 
 const currentItems = new Map();
 
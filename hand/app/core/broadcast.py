@@ -0,0 +1,201 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Set, Union
+
+
+class Subscriber:
+    """
+    One client of a `BroadcastHub`.
+
+    Attributes:
+        sent_version (int): Latest version the client has finished sending.
+
+        behind_since (float): When the client first missed a notification, or
+        `None` if it's up to date.
+
+        evicted (bool): True once the client has been behind for too long.
+    """
+
+    __slots__ = ("sent_version", "behind_since", "evicted")
+
+    def __init__(self, version: int) -> None:
+        self.sent_version = version
+        self.behind_since: Optional[float] = None
+        self.evicted = False
+
+
+class BroadcastHub:
+    """
+    Wakes every subscriber when the published version changes.
+
+    Each publish bumps a monotonically increasing version. Subscribers are
+    notified by setting the current event once, then dropping it so the next
+    waiter gets a fresh one. Subscribers compare against the last version they
+    sent instead of clearing a shared event, so no subscriber can consume
+    another one's wakeup.
+
+    Notifications are throttled to one per `coalesce_seconds`. The first change
+    after a quiet period is sent right away and changes during the window are
+    sent together when it ends, so the latest version always goes out within
+    `coalesce_seconds`.
+
+    Subscribers that are still sending an older version when later notifications
+    go out are marked as behind, and evicted once that lasts longer than
+    `evict_after_seconds`.
+
+    Attributes:
+        version (int): Incremented on every publish, unless the publisher gives
+        its own version.
+
+        notified_version (int): Latest version subscribers have been woken for.
+
+        subscribers (int): Number of active subscriptions.
+    """
+
+    def __init__(
+        self, coalesce_seconds: float = 0.0, evict_after_seconds: Optional[float] = None
+    ) -> None:
+        self.coalesce_seconds = coalesce_seconds
+        self.evict_after_seconds = evict_after_seconds
+        self.version = 0
+        self.notified_version = 0
+
+        self._subscribers: Set[Subscriber] = set()
+
+        self._event: Optional[asyncio.Event] = None
+        self._event_loop: Optional[asyncio.AbstractEventLoop] = None
+
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._last_flush = float("-inf")
+
+        # fan-out measurements
+        self._notified_at = 0.0
+        self._publishes = 0
+        self._notifications = 0
+        self._wakeups = 0
+        self._total_lag = 0.0
+        self._max_lag = 0.0
+        self._max_fanout = 0
+        self._evictions = 0
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    def publish(self, version: Optional[int] = None) -> int:
+        """
+        Bump the version, or move it to `version` if given, and schedule waking all
+        subscribers. Doesn't block.
+        """
+        self.version = self.version + 1 if version is None else version
+        self._publishes += 1
+
+        if self.coalesce_seconds <= 0:
+            self._flush()
+            return self.version
+
+        loop = asyncio.get_running_loop()
+        if self._flush_handle is not None and self._flush_loop is loop:
+            # this change goes out with the flush that's already scheduled
+            return self.version
+
+        delay = self._last_flush + self.coalesce_seconds - time.monotonic()
+        if delay <= 0:
+            self._flush()
+        else:
+            self._flush_handle = loop.call_later(delay, self._flush)
+            self._flush_loop = loop
+
+        return self.version
+
+    async def wait(self, subscriber: Subscriber) -> int:
+        """
+        Wait until there's a notified version newer than the one the subscriber
+        sent, or until it's evicted.
+        """
+        while (
+            not subscriber.evicted and self.notified_version <= subscriber.sent_version
+        ):
+            await self._get_event().wait()
+
+        lag = time.monotonic() - self._notified_at
+        self._wakeups += 1
+        self._total_lag += lag
+        self._max_lag = max(self._max_lag, lag)
+
+        return self.notified_version
+
+    def mark_sent(self, subscriber: Subscriber, version: int) -> None:
+        subscriber.sent_version = version
+        subscriber.behind_since = None
+
+    @contextmanager
+    def subscription(self) -> Iterator[Subscriber]:
+        """Register a subscriber while active."""
+        subscriber = Subscriber(self.version)
+        self._subscribers.add(subscriber)
+        try:
+            yield subscriber
+        finally:
+            self._subscribers.discard(subscriber)
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {
+            "version": self.version,
+            "subscribers": self.subscribers,
+            # raw changes vs notifications actually sent to subscribers
+            "publishes": self._publishes,
+            "notifications": self._notifications,
+            "wakeups": self._wakeups,
+            "max_fanout": self._max_fanout,
+            "avg_wake_lag_ms": (
+                self._total_lag / self._wakeups * 1000 if self._wakeups else 0.0
+            ),
+            "max_wake_lag_ms": self._max_lag * 1000,
+            "behind": sum(1 for s in self._subscribers if s.behind_since is not None),
+            "evictions": self._evictions,
+        }
+
+    def _flush(self) -> None:
+        self._flush_handle = None
+        self._flush_loop = None
+        if self.notified_version == self.version:
+            return
+
+        now = time.monotonic()
+        self._check_behind(now)
+
+        self.notified_version = self.version
+        self._notifications += 1
+        self._last_flush = self._notified_at = now
+        self._max_fanout = max(self._max_fanout, self.subscribers)
+
+        if self._event is not None:
+            self._event.set()
+            self._event = None
+
+    def _check_behind(self, now: float) -> None:
+        # anyone that still hasn't sent the previous notification is behind
+        for subscriber in self._subscribers:
+            if subscriber.evicted or subscriber.sent_version >= self.notified_version:
+                continue
+
+            if subscriber.behind_since is None:
+                subscriber.behind_since = now
+            elif (
+                self.evict_after_seconds is not None
+                and now - subscriber.behind_since > self.evict_after_seconds
+            ):
+                subscriber.evicted = True
+                self._evictions += 1
+
+    def _get_event(self) -> asyncio.Event:
+        # events are bound to the loop that first waits on them, so make a new one
+        # if the loop changed (e.g. between uvicorn reloads or test cases)
+        loop = asyncio.get_running_loop()
+        if self._event is None or self._event_loop is not loop:
+            self._event = asyncio.Event()
+            self._event_loop = loop
+        return self._event
@@ -0,0 +1,71 @@
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+
+class CaptionHistory:
+    """
+    Recent finalized captions of a room, oldest first, so clients that join
+    late or reconnect can catch up.
+
+    A caption is finalized when its speaker marks it final, or when they start
+    a new one since that means they finished the last. Only the latest update of
+    each is kept. The oldest captions are dropped past `max_captions`, or once
+    their transcripts add up to more than `max_chars`, so memory stays bounded
+    however long the captions are.
+
+    Attributes:
+        max_captions (int): Most captions kept.
+
+        max_chars (int): Most transcript characters kept across all captions.
+    """
+
+    def __init__(self, max_captions: int = 200, max_chars: int = 50_000) -> None:
+        self.max_captions = max_captions
+        self.max_chars = max_chars
+
+        self._captions: Deque[dict] = deque()
+        self._chars = 0
+        # identity to the caption they're still speaking
+        self._open: Dict[str, dict] = {}
+
+    def __len__(self) -> int:
+        return len(self._captions)
+
+    def update(self, caption: dict, is_final: bool = False) -> None:
+        """Record a caption update from the live stream."""
+        identity = caption["identity"]
+        previous = self._open.pop(identity, None)
+        if previous is not None and previous["captionId"] != caption["captionId"]:
+            self._finalize(previous)
+
+        if is_final:
+            self._finalize(caption)
+        else:
+            self._open[identity] = caption
+
+    def recent(self, limit: int, since: Optional[int] = None) -> List[dict]:
+        """
+        Up to `limit` of the newest captions, oldest first. With `since`, only
+        captions updated after that timestamp in milliseconds.
+        """
+        # captions are kept in the order they were finalized, which isn't
+        # timestamp order, so check them all rather than stop at the first old one
+        captions = [
+            caption
+            for caption in self._captions
+            if since is None or caption["timestamp"] > since
+        ]
+        return captions[-limit:] if limit > 0 else []
+
+    def clear(self) -> None:
+        self._captions.clear()
+        self._chars = 0
+        self._open.clear()
+
+    def _finalize(self, caption: dict) -> None:
+        self._captions.append(caption)
+        self._chars += len(caption["transcript"])
+        while self._captions and (
+            len(self._captions) > self.max_captions or self._chars > self.max_chars
+        ):
+            self._chars -= len(self._captions.popleft()["transcript"])
@@ -0,0 +1,116 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import List, Optional, Tuple
+
+
+class Clock:
+    """
+    Where the hand pipeline gets the time and sleeps. This is real time, and
+    tests swap in a VirtualClock to run hours of traffic in moments.
+    """
+
+    def time(self) -> float:
+        """Unix time, for deadlines that are kept across restarts."""
+        return time.time()
+
+    def monotonic(self) -> float:
+        """For deadlines and measuring how long things took."""
+        return time.monotonic()
+
+    def to_unix(self, when: float) -> float:
+        """A `monotonic` time as unix time, so it can be kept across restarts."""
+        return when + self.time() - self.monotonic()
+
+    def from_unix(self, when: float) -> float:
+        """A unix time as a `monotonic` time."""
+        return when + self.monotonic() - self.time()
+
+    async def sleep(self, seconds: float) -> None:
+        await asyncio.sleep(seconds)
+
+    async def wait(self, event: asyncio.Event, timeout: Optional[float]) -> bool:
+        """Wait for `event` for up to `timeout`. Returns False if it timed out."""
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+class VirtualClock(Clock):
+    """
+    A clock that only moves when `advance` is called. Sleepers wake up one
+    deadline at a time, in order, and everything they start gets to run before
+    the next one wakes, so a run gives the same result every time.
+
+    Attributes:
+        now (float): The current virtual time. Both `time` and `monotonic` return
+        it.
+    """
+
+    # loop iterations given to woken tasks before time moves on
+    SETTLE_STEPS = 10
+
+    def __init__(self, start: float = 0.0) -> None:
+        self.now = start
+        # (deadline, tiebreak, future)
+        self._sleepers: List[Tuple[float, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float) -> None:
+        if seconds <= 0:
+            await asyncio.sleep(0)
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(
+            self._sleepers, (self.now + seconds, next(self._counter), future)
+        )
+        await future
+
+    async def wait(self, event: asyncio.Event, timeout: Optional[float]) -> bool:
+        if timeout is None:
+            await event.wait()
+            return True
+
+        waiter = asyncio.ensure_future(event.wait())
+        sleeper = asyncio.ensure_future(self.sleep(timeout))
+        try:
+            await asyncio.wait([waiter, sleeper], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+            sleeper.cancel()
+        return event.is_set()
+
+    async def advance(self, seconds: float) -> None:
+        """Move time forward, waking every sleeper that is due on the way."""
+        target = self.now + seconds
+        await self._settle()
+        while self._sleepers and self._sleepers[0][0] <= target:
+            deadline, _, future = heapq.heappop(self._sleepers)
+            if future.done():
+                # the sleeper was cancelled
+                continue
+            self.now = max(self.now, deadline)
+            future.set_result(None)
+            await self._settle()
+        self.now = target
+
+    async def _settle(self) -> None:
+        for _ in range(self.SETTLE_STEPS):
+            await asyncio.sleep(0)
+
+
+_clock: Clock = Clock()
+
+
+def get_clock() -> Clock:
+    return _clock
@@ -13,6 +13,12 @@ class Mode(enum.Enum):
 
 PORT = 8080
 
+# room used when a request doesn't name one
+DEFAULT_ROOM = "Classroom"
+
+# most raises and lowers in one /raisehand/batch request
+MAX_BATCH_CHANGES = 50
+
 MAX_ANGLE = 30
 MIN_ANGLE = 170
 
@@ -29,6 +35,9 @@ FULL_SLEEP_TIME = 3.5
 HALFWAY_SLEEP_TIME = 3.5
 SMALL_SLEEP_TIME = 0.25
 
+# moves are sent to the servo in steps of one pwm period (50hz)
+SERVO_STEP_TIME = 0.02
+
 
 SERVO_PIN = 12
 
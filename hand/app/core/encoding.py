@@ -0,0 +1,43 @@
+import json
+import os
+from typing import Any, Callable, Dict
+
+# optional, much faster at encoding. the standard library is used without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# json, orjson, or auto to use orjson when it's installed
+JSON_ENCODER = os.getenv("JSON_ENCODER", "auto").lower()
+
+Encoder = Callable[[Any], str]
+
+
+def encode_stdlib(value: Any) -> str:
+    # same output as starlette's send_json
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+def encode_orjson(value: Any) -> str:
+    return orjson.dumps(value).decode()
+
+
+ENCODERS: Dict[str, Encoder] = {"json": encode_stdlib}
+if orjson is not None:
+    ENCODERS["orjson"] = encode_orjson
+
+
+def get_encoder(name: str = JSON_ENCODER) -> Encoder:
+    """The named encoder. `auto` is the fastest one installed."""
+    if name == "auto":
+        return ENCODERS.get("orjson", encode_stdlib)
+    if name not in ENCODERS:
+        raise ValueError(
+            f"JSON encoder {name} isn't available, use one of: {', '.join(ENCODERS)}"
+        )
+    return ENCODERS[name]
+
+
+# messages sent to many clients are encoded once with this
+encode_json = get_encoder()
@@ -0,0 +1,190 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    Generic,
+    Hashable,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+from core.clock import get_clock
+
+Key = TypeVar("Key", bound=Hashable)
+
+
+class ExpiryScheduler(Generic[Key]):
+    """
+    Calls `on_expire` with every key whose deadline has passed, using a single
+    task for all keys instead of a sleeping task per key.
+
+    Deadlines are kept in a heap. Re-arming or cancelling only updates the dict
+    of current deadlines, and heap entries that no longer match it are skipped
+    when they reach the top. Arming is O(log n) and cancelling is O(1). Keys
+    that are due at the same time are expired together in one call.
+
+    Deadlines are monotonic times, so a step of the wall clock (an NTP sync on a
+    Pi without a real time clock) can't expire every key at once or hold them
+    back for hours.
+
+    Attributes:
+        on_expire (Callable): Called with a list of (key, deadline) that are due.
+
+        batch_seconds (float): Wake-ups are rounded up to a multiple of this, so
+        keys due in the same interval are expired in one call instead of many.
+        Keys are never expired early, and at most this late.
+    """
+
+    # rebuild the heap once stale entries outnumber live ones by this much
+    COMPACT_SLACK = 64
+
+    def __init__(
+        self,
+        on_expire: Callable[[List[Tuple[Key, float]]], Awaitable[None]],
+        batch_seconds: float = 0.0,
+    ) -> None:
+        self.on_expire = on_expire
+        self.batch_seconds = batch_seconds
+
+        self._deadlines: Dict[Key, float] = {}
+        # (deadline, tiebreak, key). the tiebreak keeps keys from being compared
+        self._heap: List[Tuple[float, int, Key]] = []
+        self._counter = itertools.count()
+
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+        self._expired = 0
+        self._batches = 0
+        self._total_lateness = 0.0
+        self._max_lateness = 0.0
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._deadlines
+
+    def deadline(self, key: Key) -> Optional[float]:
+        return self._deadlines.get(key)
+
+    def arm(self, key: Key, deadline: float) -> None:
+        """Expire `key` at `deadline`, replacing any deadline it had."""
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._counter), key))
+
+        self._ensure_running()
+        if self._heap[0][2] == key and self._heap[0][0] == deadline:
+            # the runner is sleeping until a later deadline
+            self._wakeup.set()
+
+    def cancel(self, key: Key) -> bool:
+        """Stop `key` from expiring. Returns False if it wasn't armed."""
+        if self._deadlines.pop(key, None) is None:
+            return False
+
+        if len(self._heap) > 2 * len(self._deadlines) + self.COMPACT_SLACK:
+            self._compact()
+        return True
+
+    def cancel_many(self, keys: Iterable[Key]) -> int:
+        """Stop every key in `keys` from expiring. Returns how many were armed."""
+        cancelled = 0
+        for key in keys:
+            if self._deadlines.pop(key, None) is not None:
+                cancelled += 1
+
+        # compact once for the whole batch instead of once per key
+        if len(self._heap) > 2 * len(self._deadlines) + self.COMPACT_SLACK:
+            self._compact()
+        return cancelled
+
+    def clear(self) -> None:
+        self._deadlines.clear()
+        self._heap.clear()
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {
+            "armed": len(self._deadlines),
+            "heap_size": len(self._heap),
+            "expired": self._expired,
+            "batches": self._batches,
+            "avg_lateness_ms": (
+                self._total_lateness / self._expired * 1000 if self._expired else 0.0
+            ),
+            "max_lateness_ms": self._max_lateness * 1000,
+        }
+
+    def pop_due(self, now: float) -> List[Tuple[Key, float]]:
+        """Remove and return every key with a deadline at or before `now`."""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(self._heap)
+            # entries for keys that were re-armed or cancelled are stale
+            if self._deadlines.get(key) != deadline:
+                continue
+            del self._deadlines[key]
+            due.append((key, deadline))
+        return due
+
+    def _next_deadline(self) -> Optional[float]:
+        # drop stale entries so the runner doesn't wake up for nothing
+        while self._heap and self._deadlines.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def _compact(self) -> None:
+        self._heap = [
+            entry for entry in self._heap if self._deadlines.get(entry[2]) == entry[0]
+        ]
+        heapq.heapify(self._heap)
+
+    def _ensure_running(self) -> None:
+        # the task and event belong to the loop that started them, so start again
+        # if the loop changed (e.g. between uvicorn reloads or test cases)
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            clock = get_clock()
+            self._wakeup.clear()
+            timeout = None
+            deadline = self._next_deadline()
+            if deadline is not None:
+                if self.batch_seconds:
+                    # the max guards against the rounding landing just before it
+                    rounded = math.ceil(deadline / self.batch_seconds)
+                    deadline = max(rounded * self.batch_seconds, deadline)
+                timeout = max(deadline - clock.monotonic(), 0)
+            if await clock.wait(self._wakeup, timeout):
+                # an earlier deadline was armed
+                continue
+
+            now = clock.monotonic()
+            due = self.pop_due(now)
+            if not due:
+                continue
+
+            for _, deadline in due:
+                lateness = now - deadline
+                self._total_lateness += lateness
+                self._max_lateness = max(self._max_lateness, lateness)
+            self._expired += len(due)
+            self._batches += 1
+
+            try:
+                await self.on_expire(due)
+            except Exception:
+                logging.exception("Error expiring keys")
@@ -0,0 +1,137 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, Optional, Sequence, Tuple, Union
+
+# (angle, duty cycle)
+Step = Tuple[float, float]
+
+# tells the thread to exit
+_STOP = object()
+
+
+class ActuationStats:
+    """How late duty cycles reach the pwm compared to when they were due."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, latency: float) -> None:
+        latency = max(latency, 0.0)
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {
+            "actuations": self.count,
+            "avg_actuation_latency_ms": (
+                self.total / self.count * 1000 if self.count else 0.0
+            ),
+            "max_actuation_latency_ms": self.max * 1000,
+        }
+
+
+class GpioWorker:
+    """
+    Sends duty cycles to the pwm from its own thread, so stalls in the event loop
+    don't show up as servo jitter and gpio calls don't block the loop.
+
+    Moves are put on a SimpleQueue and run one at a time. Steps are timed from
+    when the move was queued, so the latency recorded for each step includes
+    the handoff to the thread. A running move stops before its next step once
+    anything else is queued behind it.
+
+    Attributes:
+        angle (float): The last angle sent to the pwm. None until the first step.
+    """
+
+    # longest the thread sleeps without checking for an interrupt
+    POLL_SECONDS = 0.01
+
+    def __init__(self, pwm: Any, stats: Optional[ActuationStats] = None) -> None:
+        self.pwm = pwm
+        self.stats = stats or ActuationStats()
+        self.angle: Optional[float] = None
+
+        self._commands: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="gpio", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self, timeout: float = 1.0) -> None:
+        self._commands.put(_STOP)
+        self._thread.join(timeout)
+
+    def move(
+        self, steps: Sequence[Step], step_time: float, relax: bool = False
+    ) -> "Future[bool]":
+        """
+        Queue a move of one step every `step_time`. If `relax`, the pwm is
+        turned off once the move finishes. The future is True if the move
+        finished and False if it was interrupted.
+        """
+        future: "Future[bool]" = Future()
+        self._commands.put((steps, step_time, relax, future, time.perf_counter()))
+        return future
+
+    def interrupt(self) -> None:
+        """Stop the running move before its next step."""
+        self._commands.put(None)
+
+    def _run(self) -> None:
+        while True:
+            command = self._commands.get()
+            if command is _STOP:
+                return
+            if command is None:
+                # an interrupt that came after its move finished
+                continue
+
+            steps, step_time, relax, future, queued_at = command
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self._move(steps, step_time, relax, queued_at))
+            except Exception as e:
+                logging.exception("Error moving servo")
+                future.set_exception(e)
+
+    def _wait_until(self, deadline: float) -> bool:
+        """Sleep until `deadline`. Returns False if interrupted first."""
+        while True:
+            if not self._commands.empty():
+                return False
+            delay = deadline - time.perf_counter()
+            if delay <= 0:
+                return True
+            time.sleep(min(delay, self.POLL_SECONDS))
+
+    def _move(
+        self,
+        steps: Sequence[Step],
+        step_time: float,
+        relax: bool,
+        queued_at: float,
+    ) -> bool:
+        for n, (angle, duty_cycle) in enumerate(steps):
+            due = queued_at + n * step_time
+            if not self._wait_until(due):
+                return False
+
+            self.pwm.ChangeDutyCycle(duty_cycle)
+            self.stats.record(time.perf_counter() - due)
+            self.angle = angle
+
+        # give the last step time to finish before relaxing or the next move
+        if not self._wait_until(queued_at + len(steps) * step_time):
+            return False
+
+        if relax:
+            self.pwm.ChangeDutyCycle(0)
+        return True
@@ -1,9 +1,13 @@
 import asyncio
 import logging
+import os
+import sqlite3
 from collections import defaultdict
-from typing import Dict, Optional, Tuple
+from typing import Dict, Hashable, List, Optional, Tuple
 
+from core.clock import get_clock
 from core.constants import (
+    DEFAULT_ROOM,
     FULL_SLEEP_TIME,
     HALFWAY_ANGLE,
     HALFWAY_HIGHER_ANGLE,
@@ -14,62 +18,106 @@ from core.constants import (
     SMALL_SLEEP_TIME,
     Mode,
 )
-from core.models import RaiseHandRequest
+from core.expiry import ExpiryScheduler
+from core.idempotency import IdempotencyCache
+from core.metrics import registry
+from core.models import BatchRaiseHandRequest, RaiseHandRequest
+from core.motion_planner import MotionPlanner
+from core.rate_limit import RateLimiter
 from core.servo_controller import servo_controller
-from routes.notifications import send_notification
-from routes.queue_sse import add_to_queue, remove_from_queue
+from core.state_backend import get_backend
+from routes.notifications import send_batch_notification, send_notification
+from routes.queue_sse import (
+    RoomQueue,
+    get_queue_length,
+    get_room_queue,
+    sync_rooms,
+)
 
 # 5 minutes
 HAND_TIMEOUT_SECONDS = 300
 
-raised_hands: Dict[str, bool] = defaultdict(lambda: False)
-timers: Dict[str, asyncio.Task] = {}
-
+# the room the physical hand is in. other rooms only have a queue
+HAND_ROOM = os.getenv("HAND_ROOM", DEFAULT_ROOM)
 
-hand_lock = asyncio.Lock()
+# how often other workers' changes are picked up when the state is shared
+STATE_POLL_SECONDS = 0.05
 
+# hands that time out within this long of each other are lowered together
+EXPIRY_BATCH_SECONDS = 0.5
 
-async def expire_hand(identity: str) -> None:
-    async with hand_lock:
-        if not raised_hands[identity]:
-            # hand is already lowered, skip
-            return
+# how long and how many results are kept to answer retried requests with
+IDEMPOTENCY_TTL_SECONDS = 60
+IDEMPOTENCY_CACHE_SIZE = 1024
 
-        raised_hands[identity] = False
-        if identity in timers:
-            del timers[identity]
+# raises and lowers allowed per client, and from every client together
+HAND_RATE_PER_SECOND = float(os.getenv("HAND_RATE_PER_SECOND", "1"))
+HAND_BURST = float(os.getenv("HAND_BURST", "5"))
+GLOBAL_HAND_RATE_PER_SECOND = float(os.getenv("GLOBAL_HAND_RATE_PER_SECOND", "50"))
+GLOBAL_HAND_BURST = 2 * GLOBAL_HAND_RATE_PER_SECOND
 
-        # lower the physical hand
-        queue_length = await remove_from_queue(identity)
-        if queue_length >= 0:
-            await raise_hand(get_lower_mode(queue_length))
+# a wave holds the servo for seconds, so they're allowed much less often
+WAVE_INTERVAL_SECONDS = float(os.getenv("WAVE_INTERVAL_SECONDS", "30"))
+GLOBAL_WAVE_INTERVAL_SECONDS = 10
 
-        logging.info(f"Timer expired for {identity}")
+hand_requests_total = registry.counter(
+    "hand_requests_total", "Hand requests by mode and result.", ("mode", "result")
+)
+hand_request_seconds = registry.histogram(
+    "hand_request_seconds", "Seconds to answer a hand request.", ("mode",)
+)
 
 
-async def reset_hand_task(identity: str) -> None:
-    try:
-        await asyncio.sleep(HAND_TIMEOUT_SECONDS)
-        await expire_hand(identity)
-    except asyncio.CancelledError:
-        pass
+async def expire_hands(expired: List[Tuple[Tuple[str, str], float]]) -> None:
+    """Lower hands that timed out, with one servo move per room."""
+    by_room: Dict[str, List[Tuple[str, float]]] = defaultdict(list)
+    for (room, identity), deadline in expired:
+        by_room[room].append((identity, deadline))
+
+    for room, hands in by_room.items():
+        # the timers are already gone, so the hands have to be lowered even when
+        # there are too many rooms. the room is dropped again once it's idle
+        room_queue = get_room_queue(room, capped=False)
+        async with room_queue.lock:
+            lowered = 0
+            for identity, deadline in hands:
+                # only removed if it has the same deadline, so a hand that was
+                # lowered and raised again through another worker stays up
+                removed, queue_length = room_queue.remove(identity, deadline)
+                if removed:
+                    lowered += 1
+                    logging.info(f"Timer expired for {identity} in {room}")
+
+            # lower the physical hand
+            if lowered and room == HAND_ROOM:
+                move_hand(get_lower_mode(queue_length))
+
+        if lowered > 1:
+            logging.info(f"Lowered {lowered} expired hands in {room}")
+
+
+# one timer for every raised hand in every room, keyed by (room, identity)
+expiry_scheduler: ExpiryScheduler[Tuple[str, str]] = ExpiryScheduler(
+    expire_hands, EXPIRY_BATCH_SECONDS
+)
 
 
-async def manage_reset_timer(identity: str, start: bool) -> None:
-    """Start or stop the reset timer for a raised hand."""
-    async with hand_lock:
-        if start:
-            raised_hands[identity] = True
+async def restore_hands() -> None:
+    """
+    Re-arm the reset timers of hands restored from the journal with the time they
+    had left, and move the physical hand to match the restored queue.
+    """
+    raised_hands = get_backend().get_raised_hands()
+    for room, identity, deadline in raised_hands:
+        # hands that expired while the server was down are lowered right away
+        expiry_scheduler.arm((room, identity), deadline)
 
-            if identity in timers:
-                timers[identity].cancel()
+    queue_length = await get_queue_length(HAND_ROOM)
+    move_hand(Mode.RAISE if queue_length > 0 else Mode.LOWER)
 
-            timers[identity] = asyncio.create_task(reset_hand_task(identity))
-        else:
-            if identity in timers:
-                timers[identity].cancel()
-                timers.pop(identity, None)
-            raised_hands[identity] = False
+    logging.info(
+        f"Restored {len(raised_hands)} raised hands, {queue_length} in {HAND_ROOM}"
+    )
 
 
 async def raise_hand(mode: Mode) -> None:
@@ -109,6 +157,41 @@ async def raise_hand(mode: Mode) -> None:
         logging.info("Initializing remote.it connection")
 
 
+# runs the moves of the worker that owns the servo one at a time
+motion_planner = MotionPlanner(raise_hand)
+
+
+def move_hand(mode: Mode, requested_at: Optional[float] = None) -> None:
+    """
+    Schedule moving the physical hand in the background. Only one worker can
+    drive the servo, so the others hand the move over through the state backend.
+    """
+    if servo_controller.owner:
+        motion_planner.submit(mode, requested_at)
+    else:
+        get_backend().push_servo_command(mode.value)
+
+
+async def watch_shared_state() -> None:
+    """Pick up queue changes and servo commands from the other workers."""
+    backend = get_backend()
+    if backend.claim_servo():
+        servo_controller.take_ownership()
+
+    while True:
+        await asyncio.sleep(STATE_POLL_SECONDS)
+        try:
+            if not backend.has_changed():
+                continue
+
+            sync_rooms()
+            if servo_controller.owner:
+                for mode in backend.pop_servo_commands():
+                    motion_planner.submit(Mode(mode))
+        except sqlite3.Error as e:
+            logging.error(f"Error syncing shared state: {e}")
+
+
 def get_raise_mode(new_queue_length: int) -> Mode:
     # if new length is 1, there were 0 hands before
     return Mode.RAISE if new_queue_length == 1 else Mode.RAISE_RETURN
@@ -119,8 +202,21 @@ def get_lower_mode(new_queue_length: int) -> Mode:
     return Mode.LOWER if new_queue_length == 0 else Mode.LOWER_RETURN
 
 
+def get_batch_mode(old_queue_length: int, new_queue_length: int) -> Optional[Mode]:
+    """The one move that shows how a batch changed the queue, if any."""
+    if old_queue_length == 0 and new_queue_length > 0:
+        return Mode.RAISE
+    if new_queue_length == 0 and old_queue_length > 0:
+        return Mode.LOWER
+    if new_queue_length > old_queue_length:
+        return Mode.RAISE_RETURN
+    if new_queue_length < old_queue_length:
+        return Mode.LOWER_RETURN
+    return None
+
+
 async def validate_request(
-    mode: str, identity: Optional[str]
+    mode: str, identity: Optional[str], room: str = DEFAULT_ROOM
 ) -> Tuple[Optional[Mode], Optional[str]]:
     try:
         mode_enum = Mode[mode.upper()]
@@ -131,8 +227,13 @@ async def validate_request(
     if mode_enum in [Mode.RAISE, Mode.LOWER] and not identity:
         return None, f"Identity is required for mode: {mode}"
 
-    async with hand_lock:
-        if mode_enum in [Mode.WAVE, Mode.WAVE2] and any(raised_hands.values()):
+    if mode_enum in [Mode.WAVE, Mode.WAVE2]:
+        if room != HAND_ROOM:
+            return None, f"There is no hand to {mode_enum} in {room}"
+
+        # every queued identity has a raised hand, so the queue length is the
+        # number of raised hands
+        if await get_queue_length(room) > 0:
             return None, f"Can't {mode_enum} while hand is raised"
 
     if mode_enum in [Mode.RAISE_RETURN, Mode.LOWER_RETURN]:
@@ -141,55 +242,260 @@ async def validate_request(
     return mode_enum, None
 
 
-async def handle_raise(identity: str) -> Tuple[Optional[Mode], Optional[str]]:
-    async with hand_lock:
-        if raised_hands[identity]:
-            return None, f"Hand is already raised for {identity}"
+async def handle_raise(
+    identity: str, room: str = DEFAULT_ROOM
+) -> Tuple[Optional[Mode], Optional[str]]:
+    room_queue = get_room_queue(room)
+    async with room_queue.lock:
+        # the deadline also tells the timer if the hand was raised again since
+        deadline = get_clock().monotonic() + HAND_TIMEOUT_SECONDS
+        success, new_queue_length = room_queue.add(identity, deadline)
+        if not success:
+            position = room_queue.queue.position(identity)
+            return None, f"Hand is already raised at position {position}"
+
+        expiry_scheduler.arm((room, identity), deadline)
+
+    await send_notification(identity, room)
+
+    logging.info(
+        f"Hand raised for {identity} in {room}, queue length: {new_queue_length}"
+    )
+    return get_raise_mode(new_queue_length), None
 
-    success, new_queue_length = await add_to_queue(identity)
-    if not success:
-        return None, "Hand is already raised"
 
-    await manage_reset_timer(identity, start=True)
-    await send_notification(identity)
+async def handle_lower(
+    identity: str, room: str = DEFAULT_ROOM
+) -> Tuple[Optional[Mode], Optional[str]]:
+    room_queue = get_room_queue(room)
+    async with room_queue.lock:
+        success, new_queue_length = room_queue.remove(identity)
+        if not success:
+            return None, f"Hand isn't raised for {identity}"
 
-    logging.info(f"Hand raised for {identity}, queue length: {new_queue_length}")
-    return get_raise_mode(new_queue_length), None
+        expiry_scheduler.cancel((room, identity))
 
+    logging.info(
+        f"Hand lowered for {identity} in {room}, queue length: {new_queue_length}"
+    )
+    return get_lower_mode(new_queue_length), None
+
+
+hand_limiter = RateLimiter(
+    HAND_RATE_PER_SECOND, HAND_BURST, GLOBAL_HAND_RATE_PER_SECOND, GLOBAL_HAND_BURST
+)
+wave_limiter = RateLimiter(
+    1 / WAVE_INTERVAL_SECONDS, 1, 1 / GLOBAL_WAVE_INTERVAL_SECONDS, 1
+)
+
+
+def mode_label(mode: str) -> str:
+    # anything a client sends that isn't a mode is counted together
+    mode = mode.upper()
+    return mode if mode in Mode.__members__ else "INVALID"
+
+
+def check_rate_limit(mode: str, client: str, room: str = DEFAULT_ROOM) -> float:
+    """
+    Seconds the client has to wait before this request is allowed, or 0 if it
+    is. This is checked before anything else so a rejection costs almost nothing.
+    """
+    if mode.upper() in [Mode.WAVE.value, Mode.WAVE2.value]:
+        wait = wave_limiter.acquire((room, client))
+    else:
+        wait = hand_limiter.acquire((room, client))
+    if wait > 0:
+        hand_requests_total.inc(mode=mode_label(mode), result="rate_limited")
+    return wait
+
+
+def check_batch_rate_limit(request: BatchRaiseHandRequest) -> float:
+    """
+    Like `check_rate_limit` for a batch. Each change costs its identity what its
+    own request would, so batching can't get around the limit.
+    """
+    wait = hand_limiter.acquire_many(
+        (request.room, change.identity) for change in request.changes
+    )
+    if wait > 0:
+        hand_requests_total.inc(mode="BATCH", result="rate_limited")
+    return wait
+
+
+# results of requests with an idempotency key, by (room, identity, mode, key)
+hand_request_cache: IdempotencyCache[Optional[str]] = IdempotencyCache(
+    IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_TTL_SECONDS
+)
 
-async def handle_lower(identity: str) -> Tuple[Optional[Mode], Optional[str]]:
-    async with hand_lock:
-        if not raised_hands[identity]:
-            return None, f"Hand isn't raised for {identity}"
 
-    await manage_reset_timer(identity, start=False)
-    new_queue_length = await remove_from_queue(identity)
-    final_mode = get_lower_mode(new_queue_length)
+def request_cache_key(request: RaiseHandRequest) -> Hashable:
+    return (request.room, request.identity, request.mode, request.idempotency_key)
 
-    logging.info(f"Hand lowered for {identity}, queue length: {new_queue_length}")
-    return final_mode, None
+
+def is_retry(request: RaiseHandRequest) -> bool:
+    """
+    True if the request reuses an idempotency key, so it gets the first result
+    without being processed again. Retries aren't charged against rate limits.
+    """
+    return (
+        request.idempotency_key is not None
+        and request_cache_key(request) in hand_request_cache
+    )
 
 
 async def process_hand_request(request: RaiseHandRequest) -> Optional[str]:
+    requested_at = get_clock().monotonic()
+    if request.idempotency_key is None:
+        error = await _process_hand_request(request, requested_at)
+    else:
+        # a retry gets the first result without touching the queue or the servo
+        key = request_cache_key(request)
+        error = await hand_request_cache.run(
+            key, lambda: _process_hand_request(request, requested_at)
+        )
+
+    mode = mode_label(request.mode)
+    hand_requests_total.inc(mode=mode, result="error" if error else "ok")
+    hand_request_seconds.observe(get_clock().monotonic() - requested_at, mode=mode)
+    return error
+
+
+async def _process_hand_request(
+    request: RaiseHandRequest, requested_at: float
+) -> Optional[str]:
     mode = request.mode
     identity = request.identity
+    room = request.room
 
-    mode_enum, error = await validate_request(mode, identity)
+    mode_enum, error = await validate_request(mode, identity, room)
     if error:
         logging.error(f"Error validating hand: {error}")
         return error
 
     if mode_enum == Mode.RAISE:
-        mode_enum, error = await handle_raise(identity)
+        mode_enum, error = await handle_raise(identity, room)
     elif mode_enum == Mode.LOWER:
-        mode_enum, error = await handle_lower(identity)
+        mode_enum, error = await handle_lower(identity, room)
 
     if error:
         logging.error(f"Error processing hand request: {error}")
         return error
 
-    # schedule this task to run in the background then immediately return None
-    # so client doesn't have to wait for servo to get their response
-    asyncio.create_task(raise_hand(mode_enum))
+    if room == HAND_ROOM:
+        # the move runs in the background so the client doesn't have to wait for
+        # the servo to get their response
+        move_hand(mode_enum, requested_at)
 
     return None
+
+
+def apply_hand_changes(
+    room_queue: RoomQueue, changes: List[Tuple[Mode, str]]
+) -> Tuple[Optional[str], List[str], List[bool]]:
+    """
+    Apply raises and lowers in order as one transition. The caller holds the
+    lock and has synced the room. A batch with a change that can't be applied
+    is rejected as a whole. Returns an error, the identities that were raised,
+    and whether each change was applied.
+    """
+    # check the whole batch first so a bad change can't leave half of it applied
+    raised = {identity: identity in room_queue.queue for _, identity in changes}
+    for mode, identity in changes:
+        if mode == Mode.RAISE and raised[identity]:
+            return f"Hand is already raised for {identity}", [], []
+        if mode == Mode.LOWER and not raised[identity]:
+            return f"Hand isn't raised for {identity}", [], []
+        raised[identity] = mode == Mode.RAISE
+
+    deadline = get_clock().monotonic() + HAND_TIMEOUT_SECONDS
+    applied, _ = room_queue.apply_batch(
+        [
+            ("add", identity, deadline)
+            if mode == Mode.RAISE
+            else ("remove", identity, None)
+            for mode, identity in changes
+        ]
+    )
+
+    # another worker can get in between the check and the backend, so timers
+    # follow what the backend actually did. the last applied change of each
+    # identity decides its timer
+    changed: Dict[str, bool] = {}
+    for (mode, identity), was_applied in zip(changes, applied):
+        if was_applied:
+            changed[identity] = mode == Mode.RAISE
+
+    room = room_queue.name
+    for identity, is_raised in changed.items():
+        if is_raised:
+            expiry_scheduler.arm((room, identity), deadline)
+    expiry_scheduler.cancel_many(
+        (room, identity) for identity, is_raised in changed.items() if not is_raised
+    )
+
+    newly_raised = [identity for identity, is_raised in changed.items() if is_raised]
+    return None, newly_raised, applied
+
+
+async def finish_hand_changes(
+    room: str, raised: List[str], old_queue_length: int, new_queue_length: int
+) -> None:
+    """Notify and move the hand once for a whole batch."""
+    await send_batch_notification(raised, room)
+
+    mode = get_batch_mode(old_queue_length, new_queue_length)
+    if mode is not None and room == HAND_ROOM:
+        move_hand(mode)
+
+
+async def process_batch_request(
+    request: BatchRaiseHandRequest,
+) -> Tuple[Optional[str], List[bool]]:
+    """Returns an error and whether each change was applied."""
+    changes = []
+    for change in request.changes:
+        mode_enum, error = await validate_request(
+            change.mode, change.identity, request.room
+        )
+        if not error and mode_enum not in [Mode.RAISE, Mode.LOWER]:
+            error = f"Mode not allowed in a batch: {change.mode}"
+        if error:
+            logging.error(f"Error validating hand batch: {error}")
+            return error, []
+        changes.append((mode_enum, change.identity))
+
+    room_queue = get_room_queue(request.room)
+    async with room_queue.lock:
+        # check against the shared state, not what this worker last saw
+        room_queue.sync()
+        old_queue_length = len(room_queue.queue)
+        error, raised, applied = apply_hand_changes(room_queue, changes)
+        if error:
+            logging.error(f"Error processing hand batch: {error}")
+            return error, []
+        new_queue_length = len(room_queue.queue)
+
+    logging.info(
+        f"Applied {sum(applied)} of {len(changes)} hand changes in {request.room}, "
+        f"queue length: {new_queue_length}"
+    )
+    await finish_hand_changes(request.room, raised, old_queue_length, new_queue_length)
+    return None, applied
+
+
+async def clear_hands(room: str = DEFAULT_ROOM) -> int:
+    """Lower every hand in the room at once. Returns how many were lowered."""
+    room_queue = get_room_queue(room)
+    async with room_queue.lock:
+        room_queue.sync()
+        old_queue_length = len(room_queue.queue)
+        _, _, applied = apply_hand_changes(
+            room_queue,
+            [(Mode.LOWER, identity) for identity in room_queue.queue.to_list()],
+        )
+        new_queue_length = len(room_queue.queue)
+
+    lowered = sum(applied)
+    logging.info(f"Cleared {lowered} hands in {room}")
+    await finish_hand_changes(room, [], old_queue_length, new_queue_length)
+    return lowered
@@ -0,0 +1,82 @@
+import asyncio
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Generic, Hashable, Tuple, TypeVar
+
+from core.clock import get_clock
+
+Result = TypeVar("Result")
+
+
+class IdempotencyCache(Generic[Result]):
+    """
+    Remembers the result of each request by its idempotency key, so a retried
+    request gets the first one's result without running again. A retry that
+    comes in while the first is still running waits for the same result.
+
+    Entries expire `ttl_seconds` after they were added, and the least recently
+    used are evicted past `max_size`. A request that raises isn't remembered so
+    it can be retried.
+
+    Attributes:
+        max_size (int): Most keys remembered at once.
+
+        ttl_seconds (float): How long a result is reused for.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl_seconds: float = 60.0) -> None:
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        # key to (expiry time, result), oldest use first
+        self._entries: "OrderedDict[Hashable, Tuple[float, asyncio.Future]]" = (
+            OrderedDict()
+        )
+
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        """True if `run` would reuse a result, finished or not, for `key`."""
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] > get_clock().monotonic()
+
+    async def run(self, key: Hashable, func: Callable[[], Awaitable[Result]]) -> Result:
+        """Result of `func`, or of the earlier call with the same key."""
+        now = get_clock().monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > now:
+            self._hits += 1
+            self._entries.move_to_end(key)
+            # shield so a retry that disconnects doesn't cancel the first request
+            return await asyncio.shield(entry[1])
+
+        self._misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._entries[key] = (now + self.ttl_seconds, future)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+        try:
+            result = await func()
+        except BaseException as e:
+            if self._entries.get(key, (0, None))[1] is future:
+                del self._entries[key]
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # the waiting retries get it, this stops an unretrieved warning
+                future.exception()
+            raise
+
+        future.set_result(result)
+        return result
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._entries), "hits": self._hits, "misses": self._misses}
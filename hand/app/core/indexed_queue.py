@@ -0,0 +1,100 @@
+from typing import Dict, Iterable, Iterator, List, Optional
+
+
+class IndexedQueue:
+    """
+    FIFO queue of unique identities.
+
+    Membership is O(1). Append, remove and position lookup are O(log n), with
+    remove amortized over the occasional O(n) rebuild of the tree.
+    Each identity is stored in insertion order with a sequence number, and a
+    Fenwick tree over the sequence numbers counts the live entries so that the
+    position of an identity is the prefix sum up to its sequence number.
+    """
+
+    # rebuild the tree once removed slots outnumber live entries by this much
+    COMPACT_SLACK = 64
+
+    def __init__(self, identities: Iterable[str] = ()) -> None:
+        self._seqs: Dict[str, int] = {}
+        # 1-indexed fenwick tree, index 0 is unused
+        self._tree: List[int] = [0]
+
+        for identity in identities:
+            self.append(identity)
+
+    def __len__(self) -> int:
+        return len(self._seqs)
+
+    def __contains__(self, identity: object) -> bool:
+        return identity in self._seqs
+
+    def __iter__(self) -> Iterator[str]:
+        # dicts keep insertion order, which is the queue order
+        return iter(self._seqs)
+
+    def __repr__(self) -> str:
+        return f"IndexedQueue({list(self._seqs)!r})"
+
+    def append(self, identity: str) -> bool:
+        """Add identity to the end of the queue. Returns False if already queued."""
+        if identity in self._seqs:
+            return False
+
+        seq = len(self._tree)
+        # a new fenwick node covers (seq - lowbit, seq], so it holds its own
+        # value plus the nodes before it in that range
+        lowbit = seq & -seq
+        covered = self._prefix_sum(seq - 1) - self._prefix_sum(seq - lowbit)
+        self._tree.append(1 + covered)
+        self._seqs[identity] = seq
+        return True
+
+    def remove(self, identity: str) -> bool:
+        """Remove identity from the queue. Returns False if it wasn't queued."""
+        seq = self._seqs.pop(identity, None)
+        if seq is None:
+            return False
+
+        self._add(seq, -1)
+        if len(self._tree) - 1 > 2 * len(self._seqs) + self.COMPACT_SLACK:
+            self._compact()
+        return True
+
+    def position(self, identity: str) -> Optional[int]:
+        """1-based position of identity in the queue, or None if not queued."""
+        seq = self._seqs.get(identity)
+        if seq is None:
+            return None
+        return self._prefix_sum(seq)
+
+    def clear(self) -> None:
+        self._seqs.clear()
+        self._tree = [0]
+
+    def to_list(self) -> List[str]:
+        return list(self._seqs)
+
+    def _add(self, seq: int, delta: int) -> None:
+        while seq < len(self._tree):
+            self._tree[seq] += delta
+            seq += seq & -seq
+
+    def _prefix_sum(self, seq: int) -> int:
+        total = 0
+        while seq > 0:
+            total += self._tree[seq]
+            seq -= seq & -seq
+        return total
+
+    def _compact(self) -> None:
+        """Renumber live entries 1..n and rebuild the tree in O(n)."""
+        size = len(self._seqs)
+        tree = [0] + [1] * size
+        for seq in range(1, size + 1):
+            parent = seq + (seq & -seq)
+            if parent <= size:
+                tree[parent] += tree[seq]
+
+        self._tree = tree
+        self._seqs = {identity: seq for seq, identity in enumerate(self._seqs, 1)}
@@ -0,0 +1,185 @@
+import json
+import logging
+import os
+import queue
+import threading
+from typing import IO, List, Optional, Tuple
+
+# write a new snapshot and empty the journal after this many records
+JOURNAL_COMPACT_EVERY = 1000
+
+# tells the thread to exit
+_STOP = object()
+
+
+class Journal:
+    """
+    Append-only log of state changes, one JSON record per line, plus a snapshot
+    that the log is periodically compacted into.
+
+    Every record gets a sequence number and the snapshot stores the last one it
+    includes, so records that were already compacted are skipped on replay even
+    if the process died between writing the snapshot and emptying the log.
+
+    Records and snapshots are serialized by the caller but written from a
+    thread, so a slow disk never blocks the event loop. The thread writes
+    everything queued while it was busy and then syncs once, so a burst of
+    changes costs one fsync. A record is on disk shortly after `append`
+    returns rather than before, so a crash can lose the last few milliseconds
+    of changes. `flush` waits for everything queued so far.
+
+    Attributes:
+        path (str): The journal file. The snapshot is next to it.
+
+        seq (int): Sequence number of the last record queued.
+
+        fsync (bool): Whether writes are synced to disk, so they survive a power
+        cut and not only a crash.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        compact_every: int = JOURNAL_COMPACT_EVERY,
+        fsync: bool = True,
+    ) -> None:
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self.seq = 0
+
+        self._since_snapshot = 0
+
+        self._writes: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: Optional[threading.Thread] = None
+
+    def load(self) -> Tuple[Optional[dict], List[dict]]:
+        """Read the snapshot and the records written after it."""
+        snapshot = None
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            pass
+
+        snapshot_seq = snapshot["seq"] if snapshot else 0
+        records = []
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a record cut off by a crash. it's always the last one
+                        # since the journal is compacted after every load
+                        logging.warning(f"Ignoring incomplete record in {self.path}")
+                        break
+                    if record["seq"] > snapshot_seq:
+                        records.append(record)
+        except FileNotFoundError:
+            pass
+
+        self.seq = records[-1]["seq"] if records else snapshot_seq
+        self._since_snapshot = len(records)
+        return snapshot, records
+
+    def append(self, record: dict) -> None:
+        self.seq += 1
+        record["seq"] = self.seq
+        self._since_snapshot += 1
+        self._queue(("append", json.dumps(record) + "\n"))
+
+    def needs_compaction(self) -> bool:
+        return self._since_snapshot >= self.compact_every
+
+    def compact(self, state: dict) -> None:
+        """Replace the snapshot with `state` and empty the journal."""
+        # serialized now since the caller keeps changing the state
+        self._since_snapshot = 0
+        self._queue(("compact", json.dumps({"seq": self.seq, **state})))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until everything queued so far is written. False on timeout."""
+        if self._thread is None:
+            return True
+        done = threading.Event()
+        self._writes.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Write everything queued and stop the thread."""
+        if self._thread is None:
+            return
+        self._writes.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _queue(self, write: Tuple[str, str]) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="journal", daemon=True
+            )
+            self._thread.start()
+        self._writes.put(write)
+
+    def _run(self) -> None:
+        # the thread keeps the journal open for as long as it runs
+        with open(self.path, "a") as journal:
+            while True:
+                # take everything queued while the last batch was being written
+                batch = [self._writes.get()]
+                while True:
+                    try:
+                        batch.append(self._writes.get_nowait())
+                    except queue.Empty:
+                        break
+
+                dirty = False
+                for item in batch:
+                    if item is _STOP or isinstance(item, threading.Event):
+                        # anything before it has to be on disk first
+                        if dirty:
+                            self._sync(journal)
+                            dirty = False
+                        if item is _STOP:
+                            return
+                        item.set()
+                        continue
+
+                    kind, data = item
+                    try:
+                        if kind == "append":
+                            journal.write(data)
+                            dirty = True
+                        else:
+                            self._write_snapshot(journal, data)
+                            dirty = False
+                    except Exception:
+                        logging.exception(f"Error writing {self.path}")
+
+                if dirty:
+                    self._sync(journal)
+
+    def _sync(self, journal: IO) -> None:
+        try:
+            journal.flush()
+            if self.fsync:
+                os.fsync(journal.fileno())
+        except Exception:
+            logging.exception(f"Error syncing {self.path}")
+
+    def _write_snapshot(self, journal: IO, data: str) -> None:
+        # write to a temp file first so a crash never leaves half a snapshot
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+        # records queued before the snapshot are in it, so they can go. the
+        # journal is in append mode so the next record goes at the start
+        journal.flush()
+        journal.truncate(0)
@@ -1,8 +1,10 @@
 from dataclasses import dataclass
-from typing import Optional
+from typing import List, Optional
 
 from fastapi import Form
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+from core.constants import DEFAULT_ROOM, MAX_BATCH_CHANGES
 
 
 class RaiseHandRequest(BaseModel):
@@ -10,6 +12,23 @@ class RaiseHandRequest(BaseModel):
 
     mode: str
     identity: Optional[str] = None
+    room: str = DEFAULT_ROOM
+    # retries with the same key get the first result instead of running again
+    idempotency_key: Optional[str] = None
+
+
+class HandChange(BaseModel):
+    """A single raise or lower in a /raisehand/batch request"""
+
+    mode: str
+    identity: str
+
+
+class BatchRaiseHandRequest(BaseModel):
+    """Client request to /raisehand/batch"""
+
+    changes: List[HandChange] = Field(max_length=MAX_BATCH_CHANGES)
+    room: str = DEFAULT_ROOM
 
 
 class TTSRequest(BaseModel):
@@ -23,6 +42,7 @@ class TokenRequest(BaseModel):
     """Client post request to /get-token"""
 
     id: str
+    room: str = DEFAULT_ROOM
 
 
 class CaptionData(BaseModel):
@@ -31,6 +51,8 @@ class CaptionData(BaseModel):
     type: str
     transcript: str
     id: int
+    # older clients don't send this, a new id from them finalizes the last one
+    isFinal: bool = False
 
 
 class CaptionActionData(BaseModel):
@@ -0,0 +1,217 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple, Union
+
+from core.clock import get_clock
+from core.constants import Mode
+from core.metrics import registry
+
+# whether the hand ends up raised after each move
+END_POSITION = {
+    Mode.RAISE: True,
+    Mode.RAISE_RETURN: True,
+    Mode.LOWER_RETURN: True,
+    Mode.LOWER: False,
+    Mode.WAVE: False,
+    Mode.WAVE2: False,
+}
+POSITION_MODES = (Mode.RAISE, Mode.LOWER)
+NUDGE_MODES = (Mode.RAISE_RETURN, Mode.LOWER_RETURN)
+WAVE_MODES = (Mode.WAVE, Mode.WAVE2)
+
+# the most moves that can wait for the servo, the oldest are dropped past this
+MAX_PENDING_MOVES = 8
+
+pending_moves = registry.histogram(
+    "servo_pending_moves",
+    "Moves waiting for the servo after each submit.",
+    buckets=(0, 1, 2, 4, MAX_PENDING_MOVES),
+)
+actuation_latency_seconds = registry.histogram(
+    "hand_actuation_latency_seconds",
+    "Seconds from the oldest request a move covers to the servo starting it.",
+)
+
+
+class MotionPlanner:
+    """
+    Runs servo moves one at a time from a bounded queue of pending moves, and
+    drops moves that are out of date before they run, so a burst of requests
+    ends in the fewest moves that get the hand where it should be.
+
+    - A raise or lower replaces everything pending since only the final
+      position matters, and is skipped if the hand is already going there.
+    - A nudge (RAISE_RETURN or LOWER_RETURN) replaces a pending nudge and is
+      skipped if the hand is still going up or down.
+    - Waves back to back become one wave.
+
+    A move that is running is cancelled when a raise or lower sends the hand the
+    other way, so the servo turns around from wherever it got to.
+
+    Attributes:
+        target (bool): Whether the hand should be raised, from the latest raise
+        or lower. None until the first one.
+
+        position (bool): Whether the hand was raised after the last finished
+        move. None until the first one.
+    """
+
+    def __init__(
+        self,
+        execute: Callable[[Mode], Awaitable[None]],
+        max_pending: int = MAX_PENDING_MOVES,
+    ) -> None:
+        self.execute = execute
+        self.max_pending = max_pending
+        self.target: Optional[bool] = None
+        self.position: Optional[bool] = None
+
+        # (mode, when the oldest request it stands for was submitted)
+        self._pending: Deque[Tuple[Mode, float]] = deque()
+        # where the hand ends up after the move that is running
+        self._planned: Optional[bool] = None
+        self._running_since: Optional[float] = None
+        self._move: Optional[asyncio.Task] = None
+
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+        self._submitted = 0
+        self._executed = 0
+        self._collapsed = 0
+        self._dropped = 0
+        self._interrupted = 0
+        self._max_lag = 0.0
+
+    @property
+    def depth(self) -> int:
+        return len(self._pending)
+
+    def submit(self, mode: Mode, requested_at: Optional[float] = None) -> None:
+        """
+        Plan a move. Doesn't wait for the servo. `requested_at` is the clock's
+        monotonic time the request came in, if that was before now.
+        """
+        self._submitted += 1
+        now = get_clock().monotonic()
+        if requested_at is not None:
+            now = min(now, requested_at)
+
+        if mode not in END_POSITION:
+            # INIT and anything else that doesn't move the servo
+            logging.info(f"Not moving hand for mode: {mode}")
+            return
+
+        if mode in POSITION_MODES:
+            self.target = END_POSITION[mode]
+            since = self._collapse(lambda _: True, now)
+            if self.target == self._planned_position():
+                self._collapsed += 1
+                return
+
+            if self._move is not None and not self._move.done():
+                self._move.cancel()
+                self._move = None
+                self._interrupted += 1
+                # the arm stops part way, so going back needs a move too
+                self._planned = None
+        elif mode in NUDGE_MODES:
+            if any(pending in POSITION_MODES for pending, _ in self._pending):
+                self._collapsed += 1
+                return
+            since = self._collapse(lambda pending: pending in NUDGE_MODES, now)
+        else:
+            since = now
+            if self._pending and self._pending[-1][0] in WAVE_MODES:
+                previous, since = self._pending.pop()
+                self._collapsed += 1
+                if previous == Mode.WAVE2:
+                    mode = Mode.WAVE2
+
+        self._pending.append((mode, since))
+        if len(self._pending) > self.max_pending:
+            self._pending.popleft()
+            self._dropped += 1
+        pending_moves.observe(len(self._pending))
+
+        self._ensure_running()
+        self._wakeup.set()
+
+    def lag(self) -> float:
+        """Seconds since the oldest request the hand hasn't caught up with."""
+        oldest = [since for _, since in self._pending]
+        if self._running_since is not None:
+            oldest.append(self._running_since)
+        return get_clock().monotonic() - min(oldest) if oldest else 0.0
+
+    def stats(self) -> Dict[str, Union[int, float, bool, None]]:
+        return {
+            "depth": self.depth,
+            "submitted": self._submitted,
+            "executed": self._executed,
+            "collapsed": self._collapsed,
+            "dropped": self._dropped,
+            "interrupted": self._interrupted,
+            "target_raised": self.target,
+            "position_raised": self.position,
+            "lag_ms": self.lag() * 1000,
+            "max_lag_ms": self._max_lag * 1000,
+        }
+
+    def _collapse(self, matches: Callable[[Mode], bool], now: float) -> float:
+        """Drop pending moves that match. Returns the oldest submit time kept."""
+        since = now
+        kept: Deque[Tuple[Mode, float]] = deque()
+        for pending, pending_since in self._pending:
+            if matches(pending):
+                since = min(since, pending_since)
+                self._collapsed += 1
+            else:
+                kept.append((pending, pending_since))
+        self._pending = kept
+        return since
+
+    def _planned_position(self) -> Optional[bool]:
+        # where the hand ends up once everything already planned has run
+        for pending, _ in reversed(self._pending):
+            return END_POSITION[pending]
+        return self._planned
+
+    def _ensure_running(self) -> None:
+        # the task and event belong to the loop that started them, so start again
+        # if the loop changed (e.g. between uvicorn reloads or test cases)
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            while not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+
+            mode, since = self._pending.popleft()
+            self._planned = END_POSITION[mode]
+            self._running_since = since
+            actuation_latency_seconds.observe(get_clock().monotonic() - since)
+            move = self._move = asyncio.ensure_future(self.execute(mode))
+            try:
+                await asyncio.wait([move])
+            except asyncio.CancelledError:
+                move.cancel()
+                raise
+
+            if move.cancelled():
+                logging.info(f"Interrupted moving hand with mode: {mode}")
+            elif move.exception() is not None:
+                logging.error(
+                    f"Error moving hand with mode: {mode}",
+                    exc_info=move.exception(),
+                )
+            else:
+                self.position = self._planned
+            self._running_since = None
+            self._executed += 1
+            self._max_lag = max(self._max_lag, get_clock().monotonic() - since)
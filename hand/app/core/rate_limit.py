@@ -0,0 +1,119 @@
+import math
+from collections import Counter, OrderedDict
+from typing import Dict, Hashable, Iterable, Optional, Tuple
+
+from core.clock import get_clock
+
+
+def refill(
+    bucket: Optional[Tuple[float, float]], rate: float, burst: float, now: float
+) -> float:
+    """Tokens in a (tokens, updated at) bucket now. No bucket is a full one."""
+    if bucket is None:
+        return burst
+    tokens, updated = bucket
+    return min(burst, tokens + (now - updated) * rate)
+
+
+class RateLimiter:
+    """
+    A token bucket for each key plus one shared by every key. Each bucket holds
+    up to `burst` tokens and refills at `rate` tokens per second, and a request
+    has to take tokens from both its own bucket and the shared one.
+
+    A bucket is only two floats. Once it has been idle long enough to refill it
+    is the same as a new bucket, so it's dropped. Buckets are kept in order of
+    last use, so those are always at the front and dropping them is O(1) each.
+
+    Attributes:
+        rate (float): Tokens per second for each key.
+
+        burst (float): Most tokens a key can save up.
+
+        global_rate (float): Tokens per second shared by every key.
+
+        global_burst (float): Most tokens the shared bucket can save up.
+    """
+
+    def __init__(
+        self, rate: float, burst: float, global_rate: float, global_burst: float
+    ) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+
+        # key to (tokens, updated at), least recently used first
+        self._buckets: "OrderedDict[Hashable, Tuple[float, float]]" = OrderedDict()
+        self._global: Optional[Tuple[float, float]] = None
+
+        self._allowed = 0
+        self._rejected = 0
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def acquire(self, key: Hashable, cost: float = 1.0) -> float:
+        """
+        Take `cost` tokens for `key`. Returns 0 if they were taken, otherwise the
+        seconds until there will be enough, or inf if a bucket can never hold
+        enough. Nothing is taken when rejected.
+        """
+        return self.acquire_many((key,), cost)
+
+    def acquire_many(self, keys: Iterable[Hashable], cost: float = 1.0) -> float:
+        """
+        Take `cost` tokens for each of `keys` as one request, so a request on
+        behalf of several keys costs each of them what its own would. Either all
+        are taken or, if any key is short, none are. Returns inf when the cost
+        is more than a bucket can hold, since no wait would be long enough.
+        """
+        now = get_clock().monotonic()
+        self._evict_idle(now)
+
+        costs = {key: count * cost for key, count in Counter(keys).items()}
+        tokens = {
+            key: refill(self._buckets.get(key), self.rate, self.burst, now)
+            for key in costs
+        }
+        total = sum(costs.values())
+        if max(costs.values(), default=0) > self.burst or total > self.global_burst:
+            # waiting wouldn't help, so don't tell the client to retry
+            self._rejected += 1
+            return math.inf
+
+        global_tokens = refill(self._global, self.global_rate, self.global_burst, now)
+        wait = max(
+            [(costs[key] - tokens[key]) / self.rate for key in costs]
+            + [(total - global_tokens) / self.global_rate, 0.0]
+        )
+        if wait > 0:
+            self._rejected += 1
+            return wait
+
+        for key, key_cost in costs.items():
+            self._buckets[key] = (tokens[key] - key_cost, now)
+            self._buckets.move_to_end(key)
+        self._global = (global_tokens - total, now)
+        self._allowed += 1
+        return 0.0
+
+    def clear(self) -> None:
+        self._buckets.clear()
+        self._global = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active": len(self._buckets),
+            "allowed": self._allowed,
+            "rejected": self._rejected,
+        }
+
+    def _evict_idle(self, now: float) -> None:
+        # any bucket untouched this long has refilled, whatever it had left
+        refill_seconds = self.burst / self.rate
+        while self._buckets:
+            key, (_, updated) = next(iter(self._buckets.items()))
+            if now - updated < refill_seconds:
+                return
+            del self._buckets[key]
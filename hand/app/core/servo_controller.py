@@ -1,8 +1,16 @@
 import asyncio
+import contextlib
+import functools
+import math
 import os
 import platform
+from typing import Any, AsyncIterator, Dict, Optional, Tuple, Union
 
-from core.constants import MIN_ANGLE, SERVO_PIN
+from core.clock import get_clock
+from core.constants import FULL_SLEEP_TIME, MIN_ANGLE, SERVO_PIN, SERVO_STEP_TIME
+from core.gpio_worker import ActuationStats, GpioWorker, Step
+from core.metrics import registry
+from core.state_backend import STATE_BACKEND
 
 # this is for running on non rasp pi devices
 is_rasp_pi = False
@@ -12,45 +20,186 @@ if (platform.system() == "Linux" and platform.machine() == "aarch64") or is_test
 
     is_rasp_pi = True
 
+# send duty cycles from a separate thread instead of the event loop
+SERVO_THREAD = os.getenv("SERVO_THREAD", "true").lower() == "true"
+
+# full sleep time is how long the servo takes to go 180 degrees
+SECONDS_PER_DEGREE = FULL_SLEEP_TIME / 180
+
+lock_wait_seconds = registry.histogram(
+    "servo_lock_wait_seconds", "Seconds a move waited for another to finish."
+)
+motion_seconds = registry.histogram(
+    "servo_motion_seconds", "Seconds from sending the first step to the last."
+)
+
+
+def angle_to_duty_cycle(angle: float) -> float:
+    # convert angle to duty cycle (2 to 12)
+    return (angle / 18) + 2
+
+
+def travel_time(start: float, end: float) -> float:
+    return abs(end - start) * SECONDS_PER_DEGREE
+
+
+@functools.lru_cache(maxsize=64)
+def trajectory(start: float, end: float, steps: int) -> Tuple[Tuple[float, float], ...]:
+    """
+    (angle, duty cycle) for each step from `start` to `end`. The steps speed up
+    and slow down along a cosine so the arm doesn't jerk at either end.
+    """
+    points = []
+    for step in range(1, steps + 1):
+        progress = (1 - math.cos(math.pi * step / steps)) / 2
+        angle = start + (end - start) * progress
+        points.append((angle, angle_to_duty_cycle(angle)))
+    return tuple(points)
+
 
 class ServoController:
-    def __init__(self) -> None:
-        if is_rasp_pi:
+    """
+    Attributes:
+        owner (bool): Whether this process drives the servo. With several workers
+        only one of them can own the gpio pin, and the rest forward moves to it.
+
+        angle (float): The last angle sent to the servo. None until the first
+        move, since the arm could be anywhere when the server starts.
+
+        threaded (bool): Whether duty cycles are sent from a GpioWorker thread
+        or straight from the event loop.
+
+        pwm: Used instead of the gpio pin when given, like a SimulatedPwm.
+    """
+
+    def __init__(
+        self, owner: bool = True, threaded: bool = SERVO_THREAD, pwm: Any = None
+    ) -> None:
+        self.owner = False
+        self.uses_gpio = False
+        self.threaded = threaded
+        self.pwm = pwm
+        self.angle: Optional[float] = None
+        self.actuation_stats = ActuationStats()
+        self.worker: Optional[GpioWorker] = None
+
+        # the lock is so multiple users can't use the servo at the same time
+        self.lock = asyncio.Lock()
+
+        if owner:
+            self.take_ownership()
+
+    def take_ownership(self) -> None:
+        if self.owner:
+            return
+
+        self.owner = True
+        if self.pwm is None and is_rasp_pi:
             GPIO.setmode(GPIO.BOARD)
             GPIO.setup(SERVO_PIN, GPIO.OUT)
             self.pwm = GPIO.PWM(SERVO_PIN, 50)
+
+        if self.pwm is not None:
+            self.uses_gpio = True
             self.pwm.start(0)
 
-        # the lock is so multiple users can't use the servo at the same time
-        self.lock = asyncio.Lock()
+            if self.threaded:
+                self.worker = GpioWorker(self.pwm, self.actuation_stats)
+                self.worker.start()
 
     async def _set_angle(self, angle: float, sleep_time: float) -> None:
-        if is_rasp_pi:
-            # convert angle to duty cycle (2 to 12)
-            duty_cycle = (angle / 18) + 2
-            self.pwm.ChangeDutyCycle(duty_cycle)
+        """
+        Move to `angle` in the time the distance takes. `sleep_time` is only
+        waited when the starting angle isn't known. Cancelling stops the arm
+        where it is and leaves `angle` at the last step sent.
+        """
+        if angle == self.angle:
+            return
+
+        if not self.uses_gpio:
+            self.angle = angle
+            return
+
+        if self.angle is None:
             # wait a bit before stopping servo to remove momentum
-            await asyncio.sleep(sleep_time)
+            steps: Tuple[Step, ...] = ((angle, angle_to_duty_cycle(angle)),)
+            step_time = sleep_time
+        else:
+            count = max(round(travel_time(self.angle, angle) / SERVO_STEP_TIME), 1)
+            steps = trajectory(self.angle, angle, count)
+            step_time = SERVO_STEP_TIME
 
-            # if lowering hand, relax servo to stop erratic movements
-            if angle == MIN_ANGLE:
-                self.pwm.ChangeDutyCycle(0)
+        # if lowering hand, relax servo to stop erratic movements
+        relax = angle == MIN_ANGLE
 
-    async def set_angle(self, angle: float, sleep_time) -> None:
+        started = get_clock().monotonic()
+        if self.worker is not None:
+            await self._move_in_thread(steps, step_time, relax)
+        else:
+            await self._move(steps, step_time, relax)
+        motion_seconds.observe(get_clock().monotonic() - started)
+
+        self.angle = angle
+
+    async def _move(
+        self, steps: Tuple[Step, ...], step_time: float, relax: bool
+    ) -> None:
+        clock = get_clock()
+        started = clock.monotonic()
+        for n, (step_angle, duty_cycle) in enumerate(steps):
+            self.pwm.ChangeDutyCycle(duty_cycle)
+            # how late the loop got to this step
+            self.actuation_stats.record(clock.monotonic() - started - n * step_time)
+            self.angle = step_angle
+            await clock.sleep(step_time)
+
+        if relax:
+            self.pwm.ChangeDutyCycle(0)
+
+    async def _move_in_thread(
+        self, steps: Tuple[Step, ...], step_time: float, relax: bool
+    ) -> None:
+        future = self.worker.move(steps, step_time, relax)
+        try:
+            await asyncio.wrap_future(future)
+        finally:
+            if not future.done():
+                self.worker.interrupt()
+            self.angle = self.worker.angle
+
+    @contextlib.asynccontextmanager
+    async def _locked(self) -> AsyncIterator[None]:
+        waiting_since = get_clock().monotonic()
         async with self.lock:
+            lock_wait_seconds.observe(get_clock().monotonic() - waiting_since)
+            yield
+
+    async def set_angle(self, angle: float, sleep_time) -> None:
+        async with self._locked():
             await self._set_angle(angle, sleep_time)
 
     async def set_angle_twice(
         self, angle1: float, angle2: float, sleep_time: float
     ) -> None:
-        async with self.lock:
+        async with self._locked():
             await self._set_angle(angle1, sleep_time)
             await self._set_angle(angle2, sleep_time)
 
+    def stats(self) -> Dict[str, Union[int, float, bool, None]]:
+        return {
+            "angle": self.angle,
+            "threaded": self.worker is not None,
+            **self.actuation_stats.stats(),
+        }
+
     def stop(self) -> None:
-        if is_rasp_pi:
+        if self.worker is not None:
+            self.worker.stop()
+        if self.uses_gpio:
             self.pwm.stop()
-            GPIO.cleanup()
+            if is_rasp_pi:
+                GPIO.cleanup()
 
 
-servo_controller = ServoController()
+# with shared state, a worker only takes the servo once it claims it on startup
+servo_controller = ServoController(owner=STATE_BACKEND != "sqlite")
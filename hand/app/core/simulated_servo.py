@@ -0,0 +1,46 @@
+from typing import List, Optional, Tuple
+
+from core.clock import get_clock
+
+
+def duty_cycle_to_angle(duty_cycle: float) -> Optional[float]:
+    # a duty cycle of 0 relaxes the servo, so it isn't holding any angle
+    if duty_cycle == 0:
+        return None
+    return (duty_cycle - 2) * 18
+
+
+class SimulatedPwm:
+    """
+    Stands in for RPi.GPIO.PWM and records every duty cycle with the clock time
+    it was sent, so tests can check exactly how and when the arm moved. Pass it
+    to ServoController with threaded=False to run on a VirtualClock.
+
+    Attributes:
+        trace (List[Tuple[float, float]]): (time, duty cycle) for every change.
+
+        running (bool): Whether the pwm has been started and not stopped.
+    """
+
+    def __init__(self) -> None:
+        self.trace: List[Tuple[float, float]] = []
+        self.running = False
+
+    def start(self, duty_cycle: float) -> None:
+        self.running = True
+        if duty_cycle:
+            self.ChangeDutyCycle(duty_cycle)
+
+    def ChangeDutyCycle(self, duty_cycle: float) -> None:
+        self.trace.append((get_clock().monotonic(), duty_cycle))
+
+    def stop(self) -> None:
+        self.running = False
+
+    def angles(self) -> List[Tuple[float, Optional[float]]]:
+        """(time, angle) for every change, with None when the servo relaxed."""
+        return [(at, duty_cycle_to_angle(duty)) for at, duty in self.trace]
+
+    def angle(self) -> Optional[float]:
+        """The angle the servo was last sent to, None if relaxed or never moved."""
+        return duty_cycle_to_angle(self.trace[-1][1]) if self.trace else None
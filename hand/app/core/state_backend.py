@@ -0,0 +1,599 @@
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import IO, Deque, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from core.clock import get_clock
+from core.indexed_queue import IndexedQueue
+from core.journal import Journal
+
+try:
+    import fcntl
+except ImportError:
+    # windows, which is only used for single worker development
+    fcntl = None
+
+# "memory" keeps state in this process. "sqlite" shares it between uvicorn workers
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+# left empty in .env it's the default too, since an empty path is a temporary db
+STATE_DB_PATH = os.getenv("STATE_DB_PATH") or str(
+    pathlib.Path(__file__).parents[2] / "hand_state.db"
+)
+
+# set to keep raised hands across restarts. only for "memory"
+STATE_JOURNAL_PATH = os.getenv("STATE_JOURNAL_PATH")
+# false to skip fsync. changes then survive a crash but not a power cut
+STATE_JOURNAL_FSYNC = os.getenv("STATE_JOURNAL_FSYNC", "true").lower() == "true"
+
+# number of queue changes kept so rooms can catch up without a full reload
+CHANGE_LOG_SIZE = 1024
+
+
+class QueueChange(NamedTuple):
+    version: int
+    event: str
+    identity: str
+
+
+def to_unix(deadline: Optional[float]) -> Optional[float]:
+    return None if deadline is None else get_clock().to_unix(deadline)
+
+
+def from_unix(deadline: Optional[float]) -> Optional[float]:
+    return None if deadline is None else get_clock().from_unix(deadline)
+
+
+class StateBackend(ABC):
+    """
+    Storage for state that has to be the same in every worker: the queue of each
+    room, push subscriptions, and servo commands for the worker that owns the
+    servo. A hand is raised while its identity is queued, and each queued
+    identity has the deadline its hand is lowered at, as a monotonic time.
+
+    Every queue change gets the next version of its room. Workers keep a local
+    copy of each queue and catch up by reading the changes after the version
+    they have, so the sse version numbers match across workers.
+
+    Methods are synchronous. They are either in memory or a short local sqlite
+    transaction, so running them on the event loop is cheaper than a thread hop.
+
+    Attributes:
+        shared (bool): True if other processes can see the state.
+    """
+
+    shared = False
+
+    @abstractmethod
+    def queue_add(
+        self, room: str, identity: str, deadline: Optional[float] = None
+    ) -> Tuple[bool, int]:
+        """
+        Queue identity with a reset deadline (monotonic time). Returns whether it was
+        added and the new queue length.
+        """
+
+    @abstractmethod
+    def queue_remove(
+        self, room: str, identity: str, deadline: Optional[float] = None
+    ) -> Tuple[bool, int]:
+        """
+        Returns whether identity was removed and the new queue length. If
+        `deadline` is given, identity is only removed if it's still the one it
+        was queued with, so an old timer can't lower a hand raised again since.
+        """
+
+    @abstractmethod
+    def queue_batch(
+        self, room: str, changes: List[Tuple[str, str, Optional[float]]]
+    ) -> Tuple[List[bool], int]:
+        """
+        Apply ("add" or "remove", identity, deadline) changes in order as one
+        transaction. Returns whether each one changed the queue and the new
+        queue length.
+        """
+
+    @abstractmethod
+    def queue_changes_since(
+        self, room: str, version: int
+    ) -> Optional[List[QueueChange]]:
+        """Changes after `version` in order, or None if some are no longer kept."""
+
+    @abstractmethod
+    def queue_snapshot(self, room: str) -> Tuple[int, List[str]]:
+        """The current version and queue."""
+
+    @abstractmethod
+    def get_deadline(self, room: str, identity: str) -> Optional[float]:
+        """Reset deadline of a queued identity, or None if it has none."""
+
+    @abstractmethod
+    def get_raised_hands(self) -> List[Tuple[str, str, float]]:
+        """(room, identity, deadline) of every queued identity with a deadline."""
+
+    @abstractmethod
+    def add_subscription(self, room: str, subscription: dict) -> None: ...
+
+    @abstractmethod
+    def get_subscriptions(self, room: str) -> List[dict]: ...
+
+    def has_changed(self) -> bool:
+        """True if another process changed the state since this was last called."""
+        return False
+
+    def claim_servo(self) -> bool:
+        """Try to become the only process that drives the servo."""
+        return True
+
+    @abstractmethod
+    def push_servo_command(self, mode: str) -> None:
+        """Ask the process that owns the servo to move it."""
+
+    @abstractmethod
+    def pop_servo_commands(self) -> List[str]:
+        """Take the servo commands in the order they were pushed."""
+
+    def forget_room(self, room: str) -> None:
+        """
+        Free what's kept for a room with an empty queue. Its version is kept so
+        it keeps counting up if the room is used again.
+        """
+
+    def close(self) -> None:
+        """Finish any pending writes. Called on shutdown."""
+
+
+class MemoryBackend(StateBackend):
+    """
+    State for a single process.
+
+    With a journal, every queue change is appended to it, and the state is
+    rebuilt from it when the backend is created so a restart keeps the raised
+    hands and their deadlines. Deadlines are written to it as unix times since
+    monotonic time starts over on a reboot. Subscriptions are never journaled so
+    they don't persist.
+    """
+
+    def __init__(self, journal: Optional[Journal] = None) -> None:
+        self._queues: Dict[str, IndexedQueue] = defaultdict(IndexedQueue)
+        self._changes: Dict[str, Deque[QueueChange]] = defaultdict(
+            lambda: deque(maxlen=CHANGE_LOG_SIZE)
+        )
+        self._versions: Dict[str, int] = defaultdict(int)
+        self._deadlines: Dict[str, Dict[str, Optional[float]]] = defaultdict(dict)
+        self._subscriptions: Dict[str, List[dict]] = defaultdict(list)
+        self._servo_commands: List[str] = []
+
+        self._journal = journal
+        if journal is not None:
+            self._restore(journal)
+
+    def _restore(self, journal: Journal) -> None:
+        start = time.perf_counter()
+        snapshot, records = journal.load()
+
+        if snapshot is not None:
+            for room, entries in snapshot["queues"].items():
+                self._deadlines[room] = {
+                    identity: from_unix(deadline) for identity, deadline in entries
+                }
+                self._queues[room] = IndexedQueue(self._deadlines[room])
+            self._versions.update(snapshot["versions"])
+
+        for record in records:
+            if "deadline" in record:
+                record["deadline"] = from_unix(record["deadline"])
+            self._apply(record)
+
+        # start from a fresh snapshot so the journal only has new records
+        journal.compact(self._snapshot_state())
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        logging.info(
+            f"Restored state from {len(records)} journal records in {elapsed_ms:.1f}ms"
+        )
+
+    def close(self) -> None:
+        if self._journal is not None:
+            self._journal.close()
+
+    def _snapshot_state(self) -> dict:
+        # deadlines are kept in queue order, so they're enough to rebuild the queue
+        return {
+            "queues": {
+                room: [
+                    (identity, to_unix(deadline))
+                    for identity, deadline in deadlines.items()
+                ]
+                for room, deadlines in self._deadlines.items()
+                if deadlines
+            },
+            "versions": dict(self._versions),
+        }
+
+    def _apply(self, record: dict) -> bool:
+        """Apply a journal record. Returns False if it didn't change anything."""
+        room, identity, op = record["room"], record["identity"], record["op"]
+        queue, deadlines = self._queues[room], self._deadlines[room]
+
+        if op == "add":
+            if not queue.append(identity):
+                return False
+            deadlines[identity] = record.get("deadline")
+        else:
+            if not queue.remove(identity):
+                return False
+            del deadlines[identity]
+
+        self._versions[room] += 1
+        self._changes[room].append(QueueChange(self._versions[room], op, identity))
+        return True
+
+    def _change(self, record: dict) -> bool:
+        changed = self._apply(record)
+        if changed and self._journal is not None:
+            if "deadline" in record:
+                record = {**record, "deadline": to_unix(record["deadline"])}
+            self._journal.append(record)
+            if self._journal.needs_compaction():
+                self._journal.compact(self._snapshot_state())
+        return changed
+
+    def queue_add(
+        self, room: str, identity: str, deadline: Optional[float] = None
+    ) -> Tuple[bool, int]:
+        record = {"op": "add", "room": room, "identity": identity, "deadline": deadline}
+        added = self._change(record)
+        return added, len(self._queues[room])
+
+    def queue_remove(
+        self, room: str, identity: str, deadline: Optional[float] = None
+    ) -> Tuple[bool, int]:
+        if deadline is not None and self._deadlines[room].get(identity) != deadline:
+            return False, len(self._queues[room])
+
+        removed = self._change({"op": "remove", "room": room, "identity": identity})
+        return removed, len(self._queues[room])
+
+    def queue_batch(
+        self, room: str, changes: List[Tuple[str, str, Optional[float]]]
+    ) -> Tuple[List[bool], int]:
+        # nothing else runs between these, so they're applied together
+        changed = []
+        for event, identity, deadline in changes:
+            record = {"op": event, "room": room, "identity": identity}
+            if event == "add":
+                record["deadline"] = deadline
+            changed.append(self._change(record))
+        return changed, len(self._queues[room])
+
+    def queue_changes_since(
+        self, room: str, version: int
+    ) -> Optional[List[QueueChange]]:
+        # read without adding the room, so rooms that aren't in use stay freed
+        changes = self._changes.get(room, ())
+        missed = self._versions.get(room, 0) - version
+        if missed < 0 or missed > len(changes):
+            return None
+        # versions in the log are consecutive so the missed ones are at the end
+        return [changes[i] for i in range(len(changes) - missed, len(changes))]
+
+    def queue_snapshot(self, room: str) -> Tuple[int, List[str]]:
+        queue = self._queues.get(room)
+        return self._versions.get(room, 0), queue.to_list() if queue else []
+
+    def get_deadline(self, room: str, identity: str) -> Optional[float]:
+        return self._deadlines.get(room, {}).get(identity)
+
+    def get_raised_hands(self) -> List[Tuple[str, str, float]]:
+        return [
+            (room, identity, deadline)
+            for room, deadlines in self._deadlines.items()
+            for identity, deadline in deadlines.items()
+            if deadline is not None
+        ]
+
+    def add_subscription(self, room: str, subscription: dict) -> None:
+        self._subscriptions[room].append(subscription)
+
+    def get_subscriptions(self, room: str) -> List[dict]:
+        return self._subscriptions.get(room, [])
+
+    def push_servo_command(self, mode: str) -> None:
+        self._servo_commands.append(mode)
+
+    def pop_servo_commands(self) -> List[str]:
+        commands, self._servo_commands = self._servo_commands, []
+        return commands
+
+    def forget_room(self, room: str) -> None:
+        if self._deadlines.get(room):
+            return
+        self._queues.pop(room, None)
+        self._changes.pop(room, None)
+        self._deadlines.pop(room, None)
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS queue (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    room TEXT NOT NULL,
+    identity TEXT NOT NULL,
+    deadline REAL,
+    UNIQUE (room, identity)
+);
+CREATE INDEX IF NOT EXISTS queue_order ON queue (room, id);
+CREATE TABLE IF NOT EXISTS queue_versions (
+    room TEXT PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS queue_changes (
+    room TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    event TEXT NOT NULL,
+    identity TEXT NOT NULL,
+    PRIMARY KEY (room, version)
+);
+CREATE TABLE IF NOT EXISTS subscriptions (
+    room TEXT NOT NULL,
+    subscription TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS servo_commands (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    mode TEXT NOT NULL
+);
+"""
+
+
+class SqliteBackend(StateBackend):
+    """
+    State shared by every worker through a sqlite database in WAL mode, so reads
+    never wait on writers and each write is a single short transaction.
+
+    Other workers' commits are detected with `PRAGMA data_version`, which only
+    changes when a different connection writes, so polling it costs no disk io.
+    """
+
+    shared = True
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._servo_lock: Optional[IO] = None
+
+        # autocommit mode, transactions are started explicitly in _transaction
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=2000")
+        self._conn.executescript(SQLITE_SCHEMA)
+        self._data_version = self._get_data_version()
+
+    @staticmethod
+    def reset(path: str) -> None:
+        """Delete the database so a new server starts empty."""
+        for suffix in ("", "-wal", "-shm"):
+            pathlib.Path(path + suffix).unlink(missing_ok=True)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        # take the write lock up front so the reads inside can't go stale
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._conn
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def _get_data_version(self) -> int:
+        return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _queue_length(self, conn: sqlite3.Connection, room: str) -> int:
+        query = "SELECT COUNT(*) FROM queue WHERE room = ?"
+        return conn.execute(query, (room,)).fetchone()[0]
+
+    def _record_change(
+        self, conn: sqlite3.Connection, room: str, event: str, identity: str
+    ) -> None:
+        conn.execute(
+            "INSERT INTO queue_versions (room, version) VALUES (?, 1) "
+            "ON CONFLICT (room) DO UPDATE SET version = version + 1",
+            (room,),
+        )
+        query = "SELECT version FROM queue_versions WHERE room = ?"
+        version = conn.execute(query, (room,)).fetchone()[0]
+
+        conn.execute(
+            "INSERT INTO queue_changes (room, version, event, identity) "
+            "VALUES (?, ?, ?, ?)",
+            (room, version, event, identity),
+        )
+        conn.execute(
+            "DELETE FROM queue_changes WHERE room = ? AND version <= ?",
+            (room, version - CHANGE_LOG_SIZE),
+        )
+
+    def queue_add(
+        self, room: str, identity: str, deadline: Optional[float] = None
+    ) -> Tuple[bool, int]:
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO queue (room, identity, deadline) "
+                "VALUES (?, ?, ?)",
+                (room, identity, deadline),
+            )
+            added = cursor.rowcount == 1
+            if added:
+                self._record_change(conn, room, "add", identity)
+            return added, self._queue_length(conn, room)
+
+    def queue_remove(
+        self, room: str, identity: str, deadline: Optional[float] = None
+    ) -> Tuple[bool, int]:
+        query = "DELETE FROM queue WHERE room = ? AND identity = ?"
+        params: Tuple = (room, identity)
+        if deadline is not None:
+            query += " AND deadline = ?"
+            params += (deadline,)
+
+        with self._transaction() as conn:
+            cursor = conn.execute(query, params)
+            removed = cursor.rowcount == 1
+            if removed:
+                self._record_change(conn, room, "remove", identity)
+            return removed, self._queue_length(conn, room)
+
+    def queue_batch(
+        self, room: str, changes: List[Tuple[str, str, Optional[float]]]
+    ) -> Tuple[List[bool], int]:
+        changed = []
+        with self._transaction() as conn:
+            for event, identity, deadline in changes:
+                if event == "add":
+                    cursor = conn.execute(
+                        "INSERT OR IGNORE INTO queue (room, identity, deadline) "
+                        "VALUES (?, ?, ?)",
+                        (room, identity, deadline),
+                    )
+                else:
+                    cursor = conn.execute(
+                        "DELETE FROM queue WHERE room = ? AND identity = ?",
+                        (room, identity),
+                    )
+                if cursor.rowcount == 1:
+                    self._record_change(conn, room, event, identity)
+                changed.append(cursor.rowcount == 1)
+            return changed, self._queue_length(conn, room)
+
+    def queue_changes_since(
+        self, room: str, version: int
+    ) -> Optional[List[QueueChange]]:
+        rows = self._conn.execute(
+            "SELECT version, event, identity FROM queue_changes "
+            "WHERE room = ? AND version > ? ORDER BY version",
+            (room, version),
+        ).fetchall()
+
+        if not rows:
+            current = self._get_version(room)
+            # a newer version than the database means it was reset
+            return [] if version <= current else None
+
+        if rows[0][0] != version + 1:
+            return None
+        return [QueueChange(*row) for row in rows]
+
+    def _get_version(self, room: str) -> int:
+        query = "SELECT version FROM queue_versions WHERE room = ?"
+        row = self._conn.execute(query, (room,)).fetchone()
+        return row[0] if row else 0
+
+    def queue_snapshot(self, room: str) -> Tuple[int, List[str]]:
+        # a read transaction so the version and queue are from the same commit
+        self._conn.execute("BEGIN")
+        try:
+            version = self._get_version(room)
+            rows = self._conn.execute(
+                "SELECT identity FROM queue WHERE room = ? ORDER BY id", (room,)
+            ).fetchall()
+        finally:
+            self._conn.execute("COMMIT")
+        return version, [identity for (identity,) in rows]
+
+    def get_deadline(self, room: str, identity: str) -> Optional[float]:
+        row = self._conn.execute(
+            "SELECT deadline FROM queue WHERE room = ? AND identity = ?",
+            (room, identity),
+        ).fetchone()
+        return row[0] if row else None
+
+    def get_raised_hands(self) -> List[Tuple[str, str, float]]:
+        query = "SELECT room, identity, deadline FROM queue WHERE deadline IS NOT NULL"
+        return self._conn.execute(query).fetchall()
+
+    def add_subscription(self, room: str, subscription: dict) -> None:
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO subscriptions (room, subscription) VALUES (?, ?)",
+                (room, json.dumps(subscription)),
+            )
+
+    def get_subscriptions(self, room: str) -> List[dict]:
+        rows = self._conn.execute(
+            "SELECT subscription FROM subscriptions WHERE room = ?", (room,)
+        ).fetchall()
+        return [json.loads(subscription) for (subscription,) in rows]
+
+    def has_changed(self) -> bool:
+        data_version = self._get_data_version()
+        changed = data_version != self._data_version
+        self._data_version = data_version
+        return changed
+
+    def claim_servo(self) -> bool:
+        if fcntl is None:
+            return True
+        if self._servo_lock is not None:
+            return True
+
+        # the lock is released by the os if the owner dies, so a restarted
+        # worker can take over
+        lock_file = open(self.path + ".servo", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+
+        self._servo_lock = lock_file
+        logging.info(f"Worker {os.getpid()} owns the servo")
+        return True
+
+    def close(self) -> None:
+        # closing the lock file releases the servo for another worker
+        if self._servo_lock is not None:
+            self._servo_lock.close()
+            self._servo_lock = None
+        self._conn.close()
+
+    def push_servo_command(self, mode: str) -> None:
+        with self._transaction() as conn:
+            conn.execute("INSERT INTO servo_commands (mode) VALUES (?)", (mode,))
+
+    def pop_servo_commands(self) -> List[str]:
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT id, mode FROM servo_commands ORDER BY id"
+            ).fetchall()
+            if rows:
+                conn.execute("DELETE FROM servo_commands WHERE id <= ?", (rows[-1][0],))
+        return [mode for _, mode in rows]
+
+
+def create_backend() -> StateBackend:
+    if STATE_BACKEND == "sqlite":
+        if STATE_JOURNAL_PATH:
+            raise RuntimeError("STATE_JOURNAL_PATH needs STATE_BACKEND=memory")
+        return SqliteBackend(STATE_DB_PATH)
+    if STATE_BACKEND != "memory":
+        raise RuntimeError(f"Unknown STATE_BACKEND: {STATE_BACKEND}")
+    journal = None
+    if STATE_JOURNAL_PATH:
+        journal = Journal(STATE_JOURNAL_PATH, fsync=STATE_JOURNAL_FSYNC)
+    return MemoryBackend(journal)
+
+
+_backend: Optional[StateBackend] = None
+
+
+def get_backend() -> StateBackend:
+    # created on first use so env variables from .env are loaded by then
+    global _backend
+    if _backend is None:
+        _backend = create_backend()
+    return _backend
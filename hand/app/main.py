@@ -1,4 +1,5 @@
 import argparse
+import asyncio
 import logging
 import os
 import pathlib
@@ -26,7 +27,16 @@ app_env = os.getenv("APP_ENV", "dev")
 if app_env.lower() == "prod":
     IS_DEV_MODE = False
 
+from core.hand import restore_hands, watch_shared_state  # noqa: E402
+from core.state_backend import (  # noqa: E402
+    STATE_BACKEND,
+    STATE_DB_PATH,
+    STATE_JOURNAL_PATH,
+    SqliteBackend,
+    get_backend,
+)
 from routes.captions_ws import router as captions_router  # noqa: E402
+from routes.metrics import router as metrics_router  # noqa: E402
 from routes.notifications import router as notifications_router  # noqa: E402
 from routes.push_to_talk import router as push_to_talk_router  # noqa: E402
 from routes.queue_sse import router as queue_router  # noqa: E402
@@ -40,8 +50,25 @@ async def lifespan(_: FastAPI):
     logging.info("\n")
     logging.info("--- Starting hand server ---\n")
 
+    # the journal is replayed when the backend is first used, so hands raised
+    # before a restart come back with the time they had left
+    if STATE_JOURNAL_PATH:
+        await restore_hands()
+
+    # other workers' changes only need to be picked up when the state is shared.
+    # this also decides which worker drives the servo
+    watch_task = None
+    if get_backend().shared:
+        watch_task = asyncio.create_task(watch_shared_state())
+
     yield
 
+    if watch_task is not None:
+        watch_task.cancel()
+
+    # so changes still queued for the journal aren't lost
+    get_backend().close()
+
 
 app = FastAPI(lifespan=lifespan)
 
@@ -61,6 +88,7 @@ routers = (
     captions_router,
     schedule_router,
     push_to_talk_router,
+    metrics_router,
 )
 
 for router in routers:
@@ -125,13 +153,15 @@ def run_npm(command: str):
         subprocess.run(f"npm run {command}", **kwargs)
 
 
-def run_uvicorn(fastapi_app, use_reload=False):
+def run_uvicorn(fastapi_app, use_reload=False, workers=1):
     uvicorn.run(
         fastapi_app,
         host="127.0.0.1",
         port=PORT,
         log_config=LOGGING_CONFIG,
         reload=use_reload,
+        workers=workers,
+        app_dir=str(app_dir),
     )
 
 
@@ -156,6 +186,19 @@ def parse_args():
         dest="build_only",
         help="Enable to run npm build and exit.",
     )
+    # only the queue, subscriptions and servo commands are shared between
+    # workers. rate limits and the idempotency cache are kept by each worker,
+    # so the global limits allow N times as much and a retry that lands on
+    # another worker is applied again
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help=(
+            "Number of server processes. More than 1 needs STATE_BACKEND=sqlite."
+            " Rate limits and retry detection are per worker."
+        ),
+    )
     args = parser.parse_args()
     return args
 
@@ -168,6 +211,19 @@ def main():
         run_npm("build")
         return
 
+    if args.workers > 1 and STATE_BACKEND != "sqlite":
+        print("Running more than 1 worker needs STATE_BACKEND=sqlite")
+        return
+
+    if args.workers > 1 and IS_DEV_MODE:
+        # uvicorn can't reload with several workers
+        print("Running more than 1 worker needs APP_ENV=prod")
+        return
+
+    if STATE_BACKEND == "sqlite":
+        # state only lasts while the server runs, the same as in memory state
+        SqliteBackend.reset(STATE_DB_PATH)
+
     if IS_DEV_MODE:
         print("Starting dev mode")
         run_dev()
@@ -175,7 +231,8 @@ def main():
 
     print("Starting prod mode\n\n")
     print("Reminder to build app!!!\n" * 5)
-    run_uvicorn(app)
+    # workers import the app themselves so it has to be passed as a string
+    run_uvicorn("main:app" if args.workers > 1 else app, workers=args.workers)
 
 
 if __name__ == "__main__":
@@ -1,40 +1,282 @@
+import asyncio
+import contextlib
 import logging
+import os
 import time
 from asyncio import Lock
-from typing import Dict, Optional
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple, Union
 
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from fastapi import (
+    APIRouter,
+    HTTPException,
+    WebSocket,
+    WebSocketDisconnect,
+    WebSocketException,
+)
 
+from core.caption_history import CaptionHistory
+from core.constants import DEFAULT_ROOM
+from core.encoding import Encoder, encode_json
+from core.metrics import registry
 from core.models import CaptionActionData, CaptionData
 
 router = APIRouter(prefix="/api")
 
+# messages a client can have waiting to be sent before it's disconnected
+CAPTION_QUEUE_SIZE = 64
+# clients with a message waiting longer than this are disconnected
+CAPTION_MAX_LAG_SECONDS = 5
+# how long closing a dropped client's socket is waited on
+CAPTION_CLOSE_TIMEOUT_SECONDS = 1
+# close code telling the client to reconnect, since it missed captions
+CLOSE_TRY_AGAIN_LATER = 1013
+# max time captions are held back so updates to the same one are sent as one
+CAPTION_BATCH_SECONDS = float(os.getenv("CAPTION_BATCH_MS", "100")) / 1000
+# finalized captions kept per room, by count and by total transcript length
+CAPTION_HISTORY_SIZE = int(os.getenv("CAPTION_HISTORY_SIZE", "200"))
+CAPTION_HISTORY_CHARS = 50_000
+# most recent captions sent to a client when it connects
+CAPTION_REPLAY_SIZE = int(os.getenv("CAPTION_REPLAY_SIZE", "20"))
+# most caption rooms kept at once. rooms without clients are dropped, with their
+# history, to make space, and new rooms over this are refused
+MAX_CAPTION_ROOMS = int(os.getenv("MAX_CAPTION_ROOMS", "100"))
+
+caption_send_lag_seconds = registry.histogram(
+    "caption_send_lag_seconds", "Seconds a caption message waited to be sent."
+)
+caption_clients_dropped_total = registry.counter(
+    "caption_clients_dropped_total", "Caption clients dropped for falling behind."
+)
+
+
+class CaptionWriter:
+    """
+    Sends one websocket's messages from its own task, so a slow client only
+    delays itself. Messages wait in a bounded queue, and a client that lets it
+    fill up or leaves a message waiting too long is dropped instead of being
+    waited on.
+
+    Attributes:
+        websocket (WebSocket): The client's socket.
+
+        dropped (bool): True once the client fell too far behind.
+
+        max_lag (float): Longest a sent message waited, in seconds.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        max_queue: int = CAPTION_QUEUE_SIZE,
+        max_lag_seconds: float = CAPTION_MAX_LAG_SECONDS,
+    ) -> None:
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.max_lag_seconds = max_lag_seconds
+        self.dropped = False
+        self.max_lag = 0.0
+
+        # (queued at, encoded message), oldest first
+        self._pending: Deque[Tuple[float, str]] = deque()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        self._closing: Optional[asyncio.Task] = None
+
+    @property
+    def depth(self) -> int:
+        return len(self._pending)
+
+    def send(self, message: str) -> bool:
+        """
+        Queue an encoded message without waiting. Returns False if the client is
+        dropped.
+        """
+        if self.dropped or self._task.done():
+            return False
+
+        now = time.monotonic()
+        if len(self._pending) >= self.max_queue or (
+            self._pending and now - self._pending[0][0] > self.max_lag_seconds
+        ):
+            self.drop()
+            return False
+
+        self._pending.append((now, message))
+        self._wakeup.set()
+        return True
+
+    def drop(self) -> None:
+        """Stop sending and close the socket so the client reconnects."""
+        if self.dropped:
+            return
+        self.dropped = True
+        self._pending.clear()
+        caption_clients_dropped_total.inc()
+        logging.info(f"Dropping caption client that fell behind: {self.websocket}")
+        # this also interrupts a send that's stuck on the slow client
+        self._task.cancel()
+        self._closing = asyncio.create_task(self._close_socket())
+
+    def close(self) -> None:
+        self._pending.clear()
+        self._task.cancel()
+
+    async def _run(self) -> None:
+        try:
+            while True:
+                while not self._pending:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+
+                queued_at, message = self._pending.popleft()
+                await self.websocket.send_text(message)
+
+                lag = time.monotonic() - queued_at
+                self.max_lag = max(self.max_lag, lag)
+                caption_send_lag_seconds.observe(lag)
+        except Exception as e:
+            # the client went away. the receive loop finds out and disconnects it
+            logging.info(f"Stopped sending captions to client: {e}")
+
+    async def _close_socket(self) -> None:
+        with contextlib.suppress(Exception):
+            await asyncio.wait_for(
+                self.websocket.close(code=CLOSE_TRY_AGAIN_LATER),
+                CAPTION_CLOSE_TIMEOUT_SECONDS,
+            )
+
+
+class CaptionConnection:
+    """
+    One websocket of a `ConnectionManager`.
+
+    Attributes:
+        identity (str): Who the client is.
+
+        captions_on (bool): True if the client has captions enabled.
+
+        writer (CaptionWriter): Sends the client's messages.
+
+        captions (int): Caption updates received from the client.
+
+        actions (int): Caption start and stop actions received from the client.
+    """
+
+    __slots__ = ("identity", "captions_on", "writer", "captions", "actions")
+
+    def __init__(self, identity: str, writer: CaptionWriter) -> None:
+        self.identity = identity
+        self.captions_on = False
+        self.writer = writer
+        self.captions = 0
+        self.actions = 0
+
+    def stats(self) -> Dict[str, Union[str, int, float, bool]]:
+        return {
+            "identity": self.identity,
+            "captions_on": self.captions_on,
+            "captions": self.captions,
+            "actions": self.actions,
+            "depth": self.writer.depth,
+            "max_lag_ms": self.writer.max_lag * 1000,
+            "dropped": self.writer.dropped,
+        }
+
 
 class ConnectionManager:
     """
     Manages websocket connections and if those connections have captions on.
 
     Attributes:
-        active_connections (dict): Websocket key to boolean value indicating if
-        captions are enabled for that connection.
+        active_connections (dict): Websocket key to its `CaptionConnection`.
+
+        captions_on_count (int): Number of connections with captions enabled,
+        kept up to date as they change so nothing has to be scanned.
 
         is_captions_on (bool): True if captions are on for at least one client
+
+        encode (callable): Turns a message into the JSON text sent to every client.
+
+        batch_seconds (float): Captions are sent at most once per this long. The
+        first caption after a quiet period is sent right away, and the ones in
+        the window after it are sent together when it ends with only the latest
+        update of each caption.
+
+        history (CaptionHistory): Recent finalized captions of the room.
+
+        replay_size (int): Most captions from `history` sent to a client when it
+        connects.
+
+        joining (int): Clients still being accepted, which aren't in
+        `active_connections` yet.
     """
 
-    def __init__(self) -> None:
-        self.active_connections: Dict[WebSocket, bool] = {}
+    def __init__(
+        self,
+        encode: Encoder = encode_json,
+        batch_seconds: float = CAPTION_BATCH_SECONDS,
+        replay_size: int = CAPTION_REPLAY_SIZE,
+    ) -> None:
+        self.encode = encode
+        self.batch_seconds = batch_seconds
+        self.history = CaptionHistory(CAPTION_HISTORY_SIZE, CAPTION_HISTORY_CHARS)
+        self.replay_size = replay_size
+        self.active_connections: Dict[WebSocket, CaptionConnection] = {}
+        self.joining = 0
+        self.captions_on_count = 0
         self.is_captions_on = False
         self._lock = Lock()
+        self._dropped = 0
 
-    async def connect(self, websocket: WebSocket) -> None:
-        await websocket.accept()
-        async with self._lock:
-            self.active_connections[websocket] = False
-            await self._update_caption_state()
+        # caption id to its latest update, in the order they were first seen
+        self._pending_captions: Dict[str, dict] = {}
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._last_flush = float("-inf")
+
+        self._captions = 0
+        self._superseded = 0
+        self._caption_frames = 0
+
+    async def connect(
+        self, websocket: WebSocket, identity: str = "", since: Optional[int] = None
+    ) -> None:
+        """
+        Register a client and send it the captions it missed: the latest ones, or
+        with `since` (a caption timestamp) only those after it.
+        """
+        # counted while accepting so the room isn't dropped under the client
+        self.joining += 1
+        try:
+            await websocket.accept()
+            async with self._lock:
+                connection = CaptionConnection(identity, CaptionWriter(websocket))
+                self.active_connections[websocket] = connection
+                await self._update_caption_state()
+        finally:
+            self.joining -= 1
+
+        captions = self.history.recent(self.replay_size, since)
+        if captions:
+            connection.writer.send(
+                self.encode(
+                    {"type": "caption_batch", "captions": captions, "history": True}
+                )
+            )
+
+    def is_idle(self) -> bool:
+        return not self.active_connections and not self.joining
 
     async def disconnect(self, websocket: WebSocket) -> None:
         async with self._lock:
-            del self.active_connections[websocket]
+            connection = self.active_connections.pop(websocket, None)
+            if connection is None:
+                return
+            if connection.captions_on:
+                self.captions_on_count -= 1
+            connection.writer.close()
+            self._dropped += connection.writer.dropped
             # when client disconnects, they might be the only one with captions
             # on, so need to update state
             await self._update_caption_state()
@@ -42,9 +284,77 @@ class ConnectionManager:
     async def send_personal_message(self, message: dict, websocket: WebSocket) -> None:
         await websocket.send_json(message)
 
-    async def broadcast(self, message: dict) -> None:
-        for connection in self.active_connections.keys():
-            await connection.send_json(message)
+    def broadcast(self, message: dict) -> None:
+        """Queue a message for every client. Doesn't wait for any of them."""
+        if not self.active_connections:
+            return
+        # every client gets the same text, so it's only encoded once
+        text = self.encode(message)
+        for connection in self.active_connections.values():
+            connection.writer.send(text)
+
+    def send_caption(self, caption: dict, is_final: bool = False) -> None:
+        """
+        Queue a caption update for the next batch. An update replaces any
+        pending one with the same `captionId`. Doesn't block.
+        """
+        self.history.update(caption, is_final)
+        self._captions += 1
+        if caption["captionId"] in self._pending_captions:
+            self._superseded += 1
+        self._pending_captions[caption["captionId"]] = caption
+
+        if self.batch_seconds <= 0:
+            self._flush_captions()
+            return
+
+        loop = asyncio.get_running_loop()
+        if self._flush_handle is not None and self._flush_loop is loop:
+            # this goes out with the flush that's already scheduled
+            return
+
+        delay = self._last_flush + self.batch_seconds - time.monotonic()
+        if delay <= 0:
+            self._flush_captions()
+        else:
+            self._flush_handle = loop.call_later(delay, self._flush_captions)
+            self._flush_loop = loop
+
+    def stats(self) -> Dict[str, Union[int, float, bool]]:
+        writers = [connection.writer for connection in self.active_connections.values()]
+        max_lag = max((writer.max_lag for writer in writers), default=0.0)
+        return {
+            "connections": len(self.active_connections),
+            "captions_on": self.is_captions_on,
+            "captions_on_connections": self.captions_on_count,
+            "max_depth": max((writer.depth for writer in writers), default=0),
+            "max_lag_ms": max_lag * 1000,
+            "dropped": self._dropped + sum(writer.dropped for writer in writers),
+            # caption updates received vs frames actually sent to each client
+            "captions": self._captions,
+            "captions_superseded": self._superseded,
+            "caption_frames": self._caption_frames,
+            "history": len(self.history),
+        }
+
+    def connection_stats(self) -> List[Dict[str, Union[str, int, float, bool]]]:
+        return [connection.stats() for connection in self.active_connections.values()]
+
+    def _flush_captions(self) -> None:
+        self._flush_handle = None
+        self._flush_loop = None
+        if not self._pending_captions:
+            return
+
+        captions: List[dict] = list(self._pending_captions.values())
+        self._pending_captions.clear()
+        self._last_flush = time.monotonic()
+        self._caption_frames += 1
+
+        if len(captions) == 1:
+            self.broadcast(captions[0])
+        else:
+            self.broadcast({"type": "caption_batch", "captions": captions})
 
     async def update_caption_state(self) -> Optional[bool]:
         async with self._lock:
@@ -56,7 +366,7 @@ class ConnectionManager:
         `None` if no state change. Only use this if you have the lock aquired.
         """
         old_state = self.is_captions_on
-        self.is_captions_on = any(self.active_connections.values())
+        self.is_captions_on = self.captions_on_count > 0
         if old_state != self.is_captions_on:
             return self.is_captions_on
         return None
@@ -68,17 +378,44 @@ class ConnectionManager:
         Sets caption state for a websocket and updates `is_captions_on`
         """
         async with self._lock:
-            self.active_connections[websocket] = new_value
+            connection = self.active_connections[websocket]
+            connection.actions += 1
+            if connection.captions_on != new_value:
+                connection.captions_on = new_value
+                self.captions_on_count += 1 if new_value else -1
             return await self._update_caption_state()
 
 
-manager = ConnectionManager()
+# room name to its connections, created when first used
+managers: Dict[str, ConnectionManager] = {}
 
 
-async def handle_caption(identity: str, data: dict) -> None:
+def get_manager(room: str = DEFAULT_ROOM) -> ConnectionManager:
+    """The room's manager, created if needed. Refused if there are too many."""
+    manager = managers.get(room)
+    if manager is None:
+        if len(managers) >= MAX_CAPTION_ROOMS:
+            evict_idle_managers()
+        if len(managers) >= MAX_CAPTION_ROOMS:
+            raise WebSocketException(CLOSE_TRY_AGAIN_LATER, "Too many rooms")
+        manager = managers[room] = ConnectionManager()
+    return manager
+
+
+def evict_idle_managers() -> None:
+    """Drop rooms without clients."""
+    for name, manager in list(managers.items()):
+        if manager.is_idle():
+            del managers[name]
+
+
+async def handle_caption(
+    manager: ConnectionManager, websocket: WebSocket, identity: str, data: dict
+) -> None:
     caption_data = CaptionData(**data)
-    # send to all clients
-    await manager.broadcast(
+    manager.active_connections[websocket].captions += 1
+    # send to all clients in the room with the next batch
+    manager.send_caption(
         {
             "type": "caption",
             # this avoids overlapping caption ids for different users
@@ -86,12 +423,13 @@ async def handle_caption(identity: str, data: dict) -> None:
             "transcript": caption_data.transcript,
             "identity": identity,
             "timestamp": round(time.time() * 1000),
-        }
+        },
+        caption_data.isFinal,
     )
 
 
 async def handle_caption_action(
-    websocket: WebSocket, identity: str, data: dict
+    manager: ConnectionManager, websocket: WebSocket, identity: str, data: dict
 ) -> None:
     caption_action_data = CaptionActionData(**data)
     logging.info(f"{caption_action_data.action} captions for {identity}")
@@ -106,14 +444,20 @@ async def handle_caption_action(
 
     logging.info(f"Changed captions to: {new_caption_state}")
 
-    # if caption state change, tell all clients to start/stop recording
+    # if caption state change, tell all clients in the room to start/stop recording
     action_type = "start" if new_caption_state else "stop"
-    await manager.broadcast({"type": f"{action_type}_recording"})
+    manager.broadcast({"type": f"{action_type}_recording"})
 
 
 @router.websocket("/ws/captions")
-async def captions_websocket(websocket: WebSocket, identity: str) -> None:
-    await manager.connect(websocket)
+async def captions_websocket(
+    websocket: WebSocket,
+    identity: str,
+    room: str = DEFAULT_ROOM,
+    since: Optional[int] = None,
+) -> None:
+    manager = get_manager(room)
+    await manager.connect(websocket, identity, since)
 
     try:
         while True:
@@ -121,10 +465,20 @@ async def captions_websocket(websocket: WebSocket, identity: str) -> None:
             msg_type = data["type"]
 
             if msg_type == "caption":
-                await handle_caption(identity, data)
+                await handle_caption(manager, websocket, identity, data)
             elif msg_type == "caption_action":
-                await handle_caption_action(websocket, identity, data)
+                await handle_caption_action(manager, websocket, identity, data)
 
     except WebSocketDisconnect:
         logging.info("WebSocket client disconnected")
+    finally:
+        # this also runs when a dropped client's socket is closed under it
         await manager.disconnect(websocket)
+
+
+@router.get("/captions/stats")
+async def caption_stats_endpoint(room: str = DEFAULT_ROOM) -> dict:
+    manager = managers.get(room)
+    if manager is None:
+        raise HTTPException(status_code=404, detail=f"{room} isn't in use")
+    return {**manager.stats(), "clients": manager.connection_stats()}
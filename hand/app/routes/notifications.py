@@ -1,11 +1,13 @@
 import logging
 import os
-from typing import Dict, List
+from typing import List
 
 from fastapi import APIRouter, HTTPException, Request
 from fastapi.responses import JSONResponse
 from pywebpush import WebPushException, webpush
 
+from core.constants import DEFAULT_ROOM
+from core.state_backend import get_backend
 from core.utils import is_pytest_running
 
 router = APIRouter(prefix="/api")
@@ -18,9 +20,6 @@ if not is_pytest_running() and (not vapid_private_key or not vapid_email):
         "Missing environment variables: VAPID_PRIVATE_KEY or VAPID_EMAIL"
     )
 
-# this is stored in memory vs a db because we don't want subs to persist
-subscriptions: List[Dict] = []
-
 
 async def push(subscription: dict, message: str) -> None:
     try:
@@ -35,22 +34,37 @@ async def push(subscription: dict, message: str) -> None:
         logging.error(f"Web push failed for subscription {subscription}: {e}")
 
 
-# this is async so it doesn't block
-async def send_notification(name: str) -> None:
+async def notify_room(message: str, room: str = DEFAULT_ROOM) -> None:
+    subscriptions = get_backend().get_subscriptions(room)
     if not subscriptions:
         return
 
     for subscription in subscriptions:
-        await push(subscription, f"{name} has a question!")
+        await push(subscription, message)
+
+
+# this is async so it doesn't block
+async def send_notification(name: str, room: str = DEFAULT_ROOM) -> None:
+    await notify_room(f"{name} has a question!", room)
+
+
+async def send_batch_notification(names: List[str], room: str = DEFAULT_ROOM) -> None:
+    """One notification for hands raised together instead of one each."""
+    if len(names) == 1:
+        await send_notification(names[0], room)
+    elif names:
+        await notify_room(f"{len(names)} people have questions!", room)
 
 
 @router.post("/save-subscription")
-async def save_subscription_endpoint(request: Request) -> JSONResponse:
+async def save_subscription_endpoint(
+    request: Request, room: str = DEFAULT_ROOM
+) -> JSONResponse:
     if vapid_private_key is None or vapid_email is None:
         raise HTTPException(status_code=500, detail="Missing env variable")
 
     subscription: dict = await request.json()
-    subscriptions.append(subscription)
+    get_backend().add_subscription(room, subscription)
     # confirmation message
     await push(subscription, "Notifications successfully enabled")
 
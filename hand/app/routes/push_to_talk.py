@@ -1,8 +1,9 @@
 import os
 
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
 from livekit import api
 
+from core.constants import DEFAULT_ROOM
 from core.models import TokenRequest
 from core.utils import is_pytest_running
 
@@ -11,18 +12,22 @@ LIVEKIT_API_SECRET = os.getenv("LIVEKIT_API_SECRET")
 if not is_pytest_running() and (not LIVEKIT_API_KEY or not LIVEKIT_API_SECRET):
     raise RuntimeError("LIVEKIT_API_KEY and LIVEKIT_API_SECRET must be set.")
 
-
-ROOM_NAME = "Classroom"
+# comma separated rooms tokens can be made for, since every token is room admin
+LIVEKIT_ROOMS = {
+    room.strip()
+    for room in os.getenv("LIVEKIT_ROOMS", DEFAULT_ROOM).split(",")
+    if room.strip()
+}
 
 
 router = APIRouter(prefix="/api")
 
 
-def generate_token(user_id: str, room_admin=False) -> dict:
+def generate_token(user_id: str, room_admin=False, room: str = DEFAULT_ROOM) -> dict:
     # TODO check if user_id is in room already
 
     video_grants = api.VideoGrants(
-        room=ROOM_NAME,
+        room=room,
         room_join=True,
         # clients don't need to hear audio, just publish it
         # can_subscribe=False,
@@ -44,9 +49,11 @@ def generate_token(user_id: str, room_admin=False) -> dict:
         .to_jwt()
     )
 
-    return {"token": token, "room_name": ROOM_NAME}
+    return {"token": token, "room_name": room}
 
 
 @router.post("/get-token")
 async def get_token(request: TokenRequest):
-    return generate_token(request.id, ROOM_NAME)
+    if request.room not in LIVEKIT_ROOMS:
+        raise HTTPException(status_code=403, detail="Unknown room")
+    return generate_token(request.id, room_admin=True, room=request.room)
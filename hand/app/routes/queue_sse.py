@@ -1,68 +1,418 @@
 import asyncio
 import json
-from typing import AsyncGenerator, Dict, List, Optional, Tuple
+import logging
+import os
+from collections import deque
+from itertools import islice
+from typing import (
+    AsyncGenerator,
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
-from fastapi import APIRouter
-from sse_starlette.sse import EventSourceResponse
+from fastapi import APIRouter, Header, HTTPException
+from sse_starlette.sse import EventSourceResponse, ServerSentEvent
+from starlette.background import BackgroundTask
+
+from core.broadcast import BroadcastHub
+from core.constants import DEFAULT_ROOM
+from core.indexed_queue import IndexedQueue
+from core.state_backend import QueueChange, get_backend
 
 router = APIRouter(prefix="/api")
 
-queue: List[str] = []
-queue_event: Optional[asyncio.Event] = None
-queue_lock = asyncio.Lock()
+# clients that haven't finished sending an update for this long are disconnected
+SSE_EVICT_SECONDS = 30
+# a single stalled send is given up on after this long
+SSE_SEND_TIMEOUT_SECONDS = 15
+# new connections over this limit get a 503 straight away
+MAX_SSE_CONNECTIONS = int(os.getenv("MAX_SSE_CONNECTIONS", "1000"))
+# max time queue changes are held back so a burst of raises is sent as one update
+QUEUE_COALESCE_SECONDS = float(os.getenv("QUEUE_COALESCE_MS", "100")) / 1000
+
+# most rooms kept at once. rooms nobody is streaming with an empty queue are
+# dropped to make space, and new rooms over this get a 503
+MAX_ROOMS = int(os.getenv("MAX_ROOMS", "100"))
+
+# number of changes kept for delta clients to resume from with Last-Event-ID
+DELTA_LOG_SIZE = 512
+
+
+class QueuePayloads:
+    """
+    The queue encoded once for a single version. Every subscriber sends these
+    same bytes instead of copying and serializing the queue itself.
+    """
+
+    def __init__(self, version: int, identities: List[str]) -> None:
+        self.version = version
+        self.data = json.dumps(identities)
+        self.frame = ServerSentEvent(self.data).encode()
+        self.snapshot_frame = ServerSentEvent(
+            self.data, id=str(version), event="snapshot"
+        ).encode()
+
+
+class RoomQueue:
+    """
+    Local copy of a room's queue plus its sse fan-out. The state backend owns the
+    queue, and this applies its changes in version order so every worker streams
+    the same versions. Each room has its own lock and hub so traffic in one room
+    never waits on another.
+
+    Attributes:
+        queue (IndexedQueue): Identities with raised hands in order.
+
+        lock (asyncio.Lock): Held for each whole raise or lower, so checking the
+        queue and changing it can't interleave with another request.
+
+        hub (BroadcastHub): Every queue change is published here so each sse
+        subscriber wakes up. Its version is the backend version of the queue.
+
+        delta_log (deque): (version, encoded sse frame) for the most recent
+        changes.
+
+        streams (int): Open sse responses for the room. They're counted from
+        when the request comes in rather than when the stream subscribes, so the
+        room isn't dropped while a stream is starting.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.queue = IndexedQueue()
+        self.lock = asyncio.Lock()
+        self.hub = BroadcastHub(QUEUE_COALESCE_SECONDS, SSE_EVICT_SECONDS)
+        self.delta_log: Deque[Tuple[int, bytes]] = deque(maxlen=DELTA_LOG_SIZE)
+        self.streams = 0
+        # rebuilt lazily on the first read after a change
+        self._payloads: Optional[QueuePayloads] = None
+
+    def is_idle(self) -> bool:
+        """True if the room can be dropped without anyone noticing."""
+        return (
+            not self.queue
+            and not self.streams
+            and not self.hub.subscribers
+            and not self.lock.locked()
+        )
+
+    def open_stream(self) -> Callable[[], None]:
+        """Count a stream. Returns a function that stops counting it."""
+        self.streams += 1
+        closed = False
+
+        def close() -> None:
+            nonlocal closed
+            if not closed:
+                closed = True
+                self.streams -= 1
+
+        return close
+
+    def apply_change(self, change: QueueChange) -> None:
+        """Apply a backend change, publish it and record it for delta clients."""
+        if change.event == "add":
+            self.queue.append(change.identity)
+        else:
+            self.queue.remove(change.identity)
+
+        self._payloads = None
+        version = self.hub.publish(change.version)
+        data = json.dumps({"identity": change.identity})
+        frame = ServerSentEvent(data, id=str(version), event=change.event).encode()
+        self.delta_log.append((version, frame))
+
+    def sync(self) -> None:
+        """Catch up with changes made through the backend, including other workers'."""
+        backend = get_backend()
+        changes = backend.queue_changes_since(self.name, self.hub.version)
+        if changes is not None:
+            for change in changes:
+                self.apply_change(change)
+            return
+
+        # too far behind to replay, so reload the whole queue. delta clients get a
+        # snapshot since the log no longer connects to their version
+        version, identities = backend.queue_snapshot(self.name)
+        self.queue = IndexedQueue(identities)
+        self.delta_log.clear()
+        self._payloads = None
+        self.hub.publish(version)
+
+    def add(self, identity: str, deadline: Optional[float] = None) -> Tuple[bool, int]:
+        """Queue identity. The caller holds the lock for the whole transition."""
+        added, length = get_backend().queue_add(self.name, identity, deadline)
+        self.sync()
+        return added, length
+
+    def remove(
+        self, identity: str, deadline: Optional[float] = None
+    ) -> Tuple[bool, int]:
+        """Remove identity. The caller holds the lock for the whole transition."""
+        removed, length = get_backend().queue_remove(self.name, identity, deadline)
+        self.sync()
+        return removed, length
+
+    def apply_batch(
+        self, changes: List[Tuple[str, str, Optional[float]]]
+    ) -> Tuple[List[bool], int]:
+        """
+        Apply ("add" or "remove", identity, deadline) changes together, so
+        subscribers get them in one update. The caller holds the lock.
+        """
+        changed, length = get_backend().queue_batch(self.name, changes)
+        self.sync()
+        return changed, length
+
+    def get_payloads(self) -> QueuePayloads:
+        """
+        Cached payloads for the current queue version. This doesn't need the lock
+        since queue changes and this read never interleave on the event loop.
+        """
+        if self._payloads is None or self._payloads.version != self.hub.version:
+            self._payloads = QueuePayloads(self.hub.version, self.queue.to_list())
+        return self._payloads
+
+    def get_events_since(self, last_version: Optional[int]) -> Tuple[int, List[bytes]]:
+        """
+        Returns the current version and the delta frames after `last_version`. If
+        the client has no version yet or missed changes that are no longer in the
+        delta log, a single snapshot frame is returned instead.
+        """
+        version = self.hub.version
+        oldest_version = self.delta_log[0][0] if self.delta_log else version + 1
+
+        if last_version is None or not oldest_version - 1 <= last_version <= version:
+            return version, [self.get_payloads().snapshot_frame]
+
+        # versions in the log are consecutive so the missed ones are at the end
+        start = len(self.delta_log) - (version - last_version)
+        return version, [frame for _, frame in islice(self.delta_log, start, None)]
+
+    async def event_generator(self) -> AsyncGenerator[bytes, None]:
+        with self.hub.subscription() as subscriber:
+            # send queue immediately when they connect
+            current = self.get_payloads()
+            yield current.frame
+            self.hub.mark_sent(subscriber, current.version)
 
+            while True:
+                # wait until the queue is newer than the last one sent. this returns
+                # right away if it changed while the last update was being sent.
+                # only the latest queue is sent so a slow client skips stale ones
+                await self.hub.wait(subscriber)
+                if subscriber.evicted:
+                    logging.info(f"Disconnecting {self.name} queue client, behind")
+                    return
 
-# this is for an error when asyncio.Event is created in a different event loop.
-# it delays creating it until used so it uses the uvicorn event loop
-async def ensure_event() -> None:
-    global queue_event
-    if queue_event is None:
-        queue_event = asyncio.Event()
+                current = self.get_payloads()
+                yield current.frame
+                self.hub.mark_sent(subscriber, current.version)
 
+    async def delta_event_generator(
+        self, last_event_id: Optional[int]
+    ) -> AsyncGenerator[bytes, None]:
+        with self.hub.subscription() as subscriber:
+            # snapshot on first connect, otherwise only the deltas that were missed.
+            # a client can't be sent more than the delta log holds since a snapshot
+            # replaces the backlog once it falls out of the log
+            version, frames = self.get_events_since(last_event_id)
+            for frame in frames:
+                yield frame
+            self.hub.mark_sent(subscriber, version)
 
-async def add_to_queue(identity: str) -> Tuple[bool, int]:
-    await ensure_event()
-    async with queue_lock:
-        if identity not in queue:
-            queue.append(identity)
-            queue_event.set()
-            return True, len(queue)
-        return False, len(queue)
+            while True:
+                await self.hub.wait(subscriber)
+                if subscriber.evicted:
+                    logging.info(f"Disconnecting {self.name} queue client, behind")
+                    return
 
+                version, frames = self.get_events_since(version)
+                for frame in frames:
+                    yield frame
+                self.hub.mark_sent(subscriber, version)
 
-async def remove_from_queue(identity: str) -> int:
-    await ensure_event()
-    async with queue_lock:
-        if identity in queue:
-            queue.remove(identity)
-            queue_event.set()
-    return await get_queue_length()
 
+class ConnectionSlots:
+    """
+    Counts streaming connections against a limit. A slot is taken before the
+    response is returned rather than when its stream subscribes, so connections
+    that arrive together can't all pass the check first. Taking one doesn't
+    await, so the check and the increment can't interleave on the event loop.
 
-async def get_queue_length() -> int:
-    async with queue_lock:
-        return len(queue)
+    Attributes:
+        limit (int): Most connections at once.
 
+        active (int): Slots taken and not yet released.
+    """
 
-async def get_queue() -> Dict[str, str]:
-    async with queue_lock:
-        data = json.dumps(queue.copy())
-    return {"data": data}
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.active = 0
 
+    def reserve(self) -> Optional[Callable[[], None]]:
+        """Take a slot. Returns a function that releases it, or None if full."""
+        if self.active >= self.limit:
+            return None
+        self.active += 1
 
-async def event_generator() -> AsyncGenerator[Dict[str, str], None]:
-    await ensure_event()
-    # send queue immediately when they connect
-    yield await get_queue()
+        released = False
 
-    while True:
-        # wait until queue updates
-        await queue_event.wait()
+        def release() -> None:
+            # called from both the stream and the response, whichever ends first
+            nonlocal released
+            if not released:
+                released = True
+                self.active -= 1
 
-        queue_event.clear()
-        yield await get_queue()
+        return release
+
+
+async def release_when_done(
+    generator: AsyncIterator[bytes], release: Callable[[], None]
+) -> AsyncGenerator[bytes, None]:
+    try:
+        async for frame in generator:
+            yield frame
+    finally:
+        release()
+
+
+sse_slots = ConnectionSlots(MAX_SSE_CONNECTIONS)
+
+# room name to its queue, created when first used
+rooms: Dict[str, RoomQueue] = {}
+
+
+def get_room_queue(room: str = DEFAULT_ROOM, capped: bool = True) -> RoomQueue:
+    """
+    The room's queue, created if it isn't in use. 503 if there are too many,
+    unless `capped` is False for changes the server makes itself.
+    """
+    room_queue = rooms.get(room)
+    if room_queue is None:
+        if len(rooms) >= MAX_ROOMS:
+            evict_idle_rooms()
+        if capped and len(rooms) >= MAX_ROOMS:
+            raise HTTPException(status_code=503, detail="Too many rooms")
+        room_queue = rooms[room] = RoomQueue(room)
+        room_queue.sync()
+    return room_queue
+
+
+def evict_idle_rooms() -> None:
+    """Drop rooms nobody is streaming that have an empty queue."""
+    for name, room_queue in list(rooms.items()):
+        if room_queue.is_idle():
+            del rooms[name]
+            get_backend().forget_room(name)
+
+
+def read_queue(room: str) -> List[str]:
+    """
+    The room's queue. Rooms that aren't in use are read from the backend instead
+    of being created, so read-only requests can't add rooms.
+    """
+    room_queue = rooms.get(room)
+    if room_queue is None:
+        return get_backend().queue_snapshot(room)[1]
+    return room_queue.queue.to_list()
+
+
+def sync_rooms() -> None:
+    """Catch every room up after another worker changed the state."""
+    for room_queue in rooms.values():
+        room_queue.sync()
+
+
+async def get_queue_length(room: str = DEFAULT_ROOM) -> int:
+    room_queue = rooms.get(room)
+    if room_queue is None:
+        return len(read_queue(room))
+    return len(room_queue.queue)
+
+
+async def get_queue_position(identity: str, room: str = DEFAULT_ROOM) -> Optional[int]:
+    """1-based position of identity in the queue, or None if not in queue"""
+    room_queue = rooms.get(room)
+    if room_queue is None:
+        identities = read_queue(room)
+        return identities.index(identity) + 1 if identity in identities else None
+    return room_queue.queue.position(identity)
+
+
+async def get_queue(room: str = DEFAULT_ROOM) -> Dict[str, str]:
+    room_queue = rooms.get(room)
+    if room_queue is None:
+        return {"data": json.dumps(read_queue(room))}
+    return {"data": room_queue.get_payloads().data}
+
+
+def parse_last_event_id(last_event_id: Optional[str]) -> Optional[int]:
+    try:
+        return int(last_event_id)
+    except (TypeError, ValueError):
+        return None
 
 
 @router.get("/queue")
-async def queue_sse() -> EventSourceResponse:
-    return EventSourceResponse(event_generator())
+async def queue_sse(
+    room: str = DEFAULT_ROOM,
+    delta: bool = False,
+    last_event_id: Optional[str] = Header(None),
+) -> EventSourceResponse:
+    """
+    Streams the queue of a room. By default every update is the full queue as a
+    JSON list. With `?delta=true` the stream starts with a `snapshot` event, then
+    sends sequence numbered `add` and `remove` events, and reconnecting with
+    `Last-Event-ID` only replays the changes that were missed.
+    """
+    room_queue = get_room_queue(room)
+    release_slot = sse_slots.reserve()
+    if release_slot is None:
+        raise HTTPException(status_code=503, detail="Too many queue connections")
+    close_stream = room_queue.open_stream()
+
+    def release() -> None:
+        release_slot()
+        close_stream()
+
+    if delta:
+        generator = room_queue.delta_event_generator(parse_last_event_id(last_event_id))
+    else:
+        generator = room_queue.event_generator()
+
+    # the stream might never start if the client leaves first, so the response
+    # releases the slot too
+    return EventSourceResponse(
+        release_when_done(generator, release),
+        send_timeout=SSE_SEND_TIMEOUT_SECONDS,
+        background=BackgroundTask(release),
+    )
+
+
+@router.get("/queue/stats")
+async def queue_stats_endpoint(
+    room: str = DEFAULT_ROOM,
+) -> Dict[str, Union[int, float]]:
+    room_queue = rooms.get(room)
+    if room_queue is None:
+        raise HTTPException(status_code=404, detail=f"{room} isn't in use")
+    return room_queue.hub.stats()
+
+
+@router.get("/queue/position")
+async def queue_position_endpoint(
+    identity: str, room: str = DEFAULT_ROOM
+) -> Dict[str, int]:
+    position = await get_queue_position(identity, room)
+    if position is None:
+        raise HTTPException(status_code=404, detail=f"{identity} isn't in queue")
+
+    return {"position": position}
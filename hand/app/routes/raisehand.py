@@ -1,19 +1,100 @@
 import logging
+import math
+from typing import Dict, Union
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Request
 from fastapi.responses import JSONResponse
 
-from core.hand import process_hand_request
-from core.models import RaiseHandRequest
+from core.constants import DEFAULT_ROOM, Mode
+from core.hand import (
+    check_batch_rate_limit,
+    check_rate_limit,
+    clear_hands,
+    expiry_scheduler,
+    is_retry,
+    motion_planner,
+    process_batch_request,
+    process_hand_request,
+)
+from core.models import BatchRaiseHandRequest, RaiseHandRequest
+from core.servo_controller import servo_controller
 
 router = APIRouter(prefix="/api")
 
 
+def client_address(http_request: Request) -> str:
+    return http_request.client.host if http_request.client else "unknown"
+
+
+def raise_if_limited(wait: float) -> None:
+    if math.isinf(wait):
+        # e.g. a batch with more changes for one person than their burst
+        raise HTTPException(
+            status_code=422, detail="Request is bigger than the rate limit allows"
+        )
+    if wait > 0:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many requests",
+            headers={"Retry-After": str(math.ceil(wait))},
+        )
+
+
 @router.post("/raisehand")
-async def raise_hand_endpoint(request: RaiseHandRequest) -> JSONResponse:
+async def raise_hand_endpoint(
+    request: RaiseHandRequest, http_request: Request
+) -> JSONResponse:
+    # requests without an identity (waves) are limited by address instead
+    client = request.identity
+    if client is None:
+        client = client_address(http_request)
+
+    # a retry only gets the result of the first request, so it doesn't use a token
+    wait = (
+        0.0
+        if is_retry(request)
+        else check_rate_limit(request.mode, client, request.room)
+    )
+    raise_if_limited(wait)
+
     error = await process_hand_request(request)
     if error is not None:
         logging.error(f"/raisehand error: {error}")
         raise HTTPException(status_code=400, detail=error)
 
     return JSONResponse(content={"message": "OK"}, status_code=200)
+
+
+@router.post("/raisehand/batch")
+async def raise_hand_batch_endpoint(request: BatchRaiseHandRequest) -> JSONResponse:
+    raise_if_limited(check_batch_rate_limit(request))
+
+    error, applied = await process_batch_request(request)
+    if error is not None:
+        logging.error(f"/raisehand/batch error: {error}")
+        raise HTTPException(status_code=400, detail=error)
+
+    # a change another worker already made isn't applied again
+    return JSONResponse(content={"message": "OK", "applied": applied}, status_code=200)
+
+
+@router.post("/raisehand/clear")
+async def clear_hands_endpoint(
+    http_request: Request, room: str = DEFAULT_ROOM
+) -> JSONResponse:
+    raise_if_limited(
+        check_rate_limit(Mode.LOWER.value, client_address(http_request), room)
+    )
+
+    lowered = await clear_hands(room)
+    return JSONResponse(content={"message": "OK", "lowered": lowered}, status_code=200)
+
+
+@router.get("/raisehand/timers")
+async def hand_timers_endpoint() -> Dict[str, Union[int, float]]:
+    return expiry_scheduler.stats()
+
+
+@router.get("/raisehand/servo")
+async def hand_servo_endpoint() -> Dict[str, Union[int, float, bool, None]]:
+    return {**motion_planner.stats(), **servo_controller.stats()}
@@ -0,0 +1,12 @@
+import pytest
+from pytest_mock import MockFixture
+
+from core.clock import VirtualClock
+
+
+@pytest.fixture
+def clock(mocker: MockFixture) -> VirtualClock:
+    # starts at a realistic unix time since deadlines are stored as one
+    clock = VirtualClock(start=1_700_000_000.0)
+    mocker.patch("core.clock._clock", clock)
+    return clock
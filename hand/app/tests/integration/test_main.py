@@ -8,3 +8,27 @@ client = TestClient(app)
 def test_main() -> None:
     response = client.get("/")
     assert response.status_code == 200
+
+
+def test_get_token_unknown_room() -> None:
+    # tokens are room admin, so only configured rooms get one
+    response = client.post("/api/get-token", json={"id": "user", "room": "Other"})
+    assert response.status_code == 403
+
+
+def test_captions_websocket() -> None:
+    with client.websocket_connect("/api/ws/captions?identity=user") as websocket:
+        websocket.send_json({"type": "caption_action", "action": "start"})
+        assert websocket.receive_json() == {"type": "start_recording"}
+
+        websocket.send_json({"type": "caption", "id": 1, "transcript": "hi"})
+        caption = websocket.receive_json()
+        assert caption["captionId"] == "user1"
+        assert caption["transcript"] == "hi"
+
+
+def test_caption_stats() -> None:
+    with client.websocket_connect("/api/ws/captions?identity=user&room=Stats"):
+        response = client.get("/api/captions/stats?room=Stats")
+        assert response.status_code == 200
+        assert response.json()["clients"][0]["identity"] == "user"
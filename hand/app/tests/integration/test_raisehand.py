@@ -1,5 +1,7 @@
 from fastapi.testclient import TestClient
 
+from core.constants import MAX_BATCH_CHANGES
+from core.hand import HAND_BURST, hand_limiter, hand_request_cache, wave_limiter
 from main import app
 
 client = TestClient(app)
@@ -14,3 +16,80 @@ def test_raisehand() -> None:
 def test_raisehand_no_data() -> None:
     response = client.post("/api/raisehand")
     assert response.status_code != 200
+
+
+def test_raisehand_batch_and_clear() -> None:
+    changes = [
+        {"identity": "user1", "mode": "RAISE"},
+        {"identity": "user2", "mode": "RAISE"},
+    ]
+    response = client.post("/api/raisehand/batch", json={"changes": changes})
+    assert response.status_code == 200
+
+    response = client.post("/api/raisehand/clear")
+    assert response.status_code == 200
+    assert response.json()["lowered"] >= 2
+
+
+def test_raisehand_wave_rate_limited() -> None:
+    data = {"mode": "WAVE"}
+    client.post("/api/raisehand", json=data)
+
+    response = client.post("/api/raisehand", json=data)
+    assert response.status_code == 429
+    assert "Retry-After" in response.headers
+
+
+def test_raisehand_retry_not_rate_limited() -> None:
+    # retrying with the same key should get the first result, not a 429
+    wave_limiter.clear()
+    hand_request_cache.clear()
+    data = {"mode": "WAVE", "idempotency_key": "wave-retry"}
+
+    for _ in range(3):
+        response = client.post("/api/raisehand", json=data)
+        assert response.status_code == 200
+
+    # a new request still uses a token
+    response = client.post("/api/raisehand", json={"mode": "WAVE"})
+    assert response.status_code == 429
+
+
+def test_metrics() -> None:
+    client.post("/api/raisehand", json={"identity": "user3", "mode": "RAISE"})
+
+    response = client.get("/api/metrics")
+    assert response.status_code == 200
+    assert 'hand_requests_total{mode="RAISE",result="ok"}' in response.text
+    assert "hand_request_seconds_bucket" in response.text
+
+
+def test_raisehand_batch_limits() -> None:
+    # a batch can't be used to raise more hands than their own requests could
+    hand_limiter.clear()
+    changes = [{"identity": f"user{n}", "mode": "RAISE"} for n in range(3)]
+    response = client.post("/api/raisehand/batch", json={"changes": changes})
+    assert response.status_code == 200
+    assert response.json()["applied"] == [True] * 3
+
+    lowers = [
+        {"identity": "user0", "mode": "LOWER"},
+        {"identity": "user0", "mode": "RAISE"},
+    ]
+    for _ in range(2):
+        response = client.post("/api/raisehand/batch", json={"changes": lowers})
+    response = client.post("/api/raisehand/batch", json={"changes": lowers})
+    assert response.status_code == 429
+
+    # more changes for one person than their burst could never be let through
+    hand_limiter.clear()
+    changes = [{"identity": "user0", "mode": "RAISE"}] * (int(HAND_BURST) + 1)
+    response = client.post("/api/raisehand/batch", json={"changes": changes})
+    assert response.status_code == 422
+
+    changes = [
+        {"identity": f"user{n}", "mode": "RAISE"} for n in range(MAX_BATCH_CHANGES + 1)
+    ]
+    response = client.post("/api/raisehand/batch", json={"changes": changes})
+    assert response.status_code == 422
+    hand_limiter.clear()
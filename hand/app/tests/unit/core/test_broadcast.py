@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from core.broadcast import BroadcastHub
+
+
+@pytest.mark.anyio
+async def test_publish_wakes_every_subscriber() -> None:
+    # one publish should wake all subscribers, not just the first one
+    hub = BroadcastHub()
+
+    async def subscriber() -> int:
+        with hub.subscription() as sub:
+            return await hub.wait(sub)
+
+    tasks = [asyncio.create_task(subscriber()) for _ in range(50)]
+    await asyncio.sleep(0)
+    assert hub.subscribers == 50
+
+    hub.publish()
+    versions = await asyncio.wait_for(asyncio.gather(*tasks), timeout=1)
+
+    assert versions == [1] * 50
+    assert hub.subscribers == 0
+    assert hub.stats()["wakeups"] == 50
+
+
+@pytest.mark.anyio
+async def test_wait_returns_immediately_when_behind() -> None:
+    # a subscriber that missed publishes while busy should not block
+    hub = BroadcastHub()
+    with hub.subscription() as subscriber:
+        hub.publish()
+        hub.publish()
+
+        version = await asyncio.wait_for(hub.wait(subscriber), timeout=1)
+
+    assert version == 2
+
+
+@pytest.mark.anyio
+async def test_publish_coalesces_bursts() -> None:
+    # a burst of changes should wake subscribers once more with the latest version
+    hub = BroadcastHub(coalesce_seconds=0.05)
+
+    with hub.subscription() as subscriber:
+        # first change after a quiet period is sent right away
+        assert hub.publish() == 1
+        assert await asyncio.wait_for(hub.wait(subscriber), timeout=1) == 1
+        hub.mark_sent(subscriber, 1)
+
+        hub.publish()
+        hub.publish()
+        hub.publish()
+        assert hub.notified_version == 1
+
+        assert await asyncio.wait_for(hub.wait(subscriber), timeout=1) == 4
+
+    stats = hub.stats()
+    assert stats["publishes"] == 4
+    assert stats["notifications"] == 2
+
+
+@pytest.mark.anyio
+async def test_subscriber_evicted_when_behind() -> None:
+    # a client that never finishes sending should be evicted, not waited on
+    hub = BroadcastHub(evict_after_seconds=0.01)
+
+    with hub.subscription() as slow, hub.subscription() as fast:
+        for _ in range(3):
+            hub.publish()
+            hub.mark_sent(fast, hub.version)
+            await asyncio.sleep(0.02)
+
+        assert slow.evicted
+        assert not fast.evicted
+        assert hub.stats()["evictions"] == 1
+
+        # an evicted subscriber stops waiting so its stream can close
+        await asyncio.wait_for(hub.wait(slow), timeout=1)
@@ -0,0 +1,54 @@
+from core.caption_history import CaptionHistory
+
+
+def caption(identity: str, caption_id: str, transcript: str, timestamp: int) -> dict:
+    return {
+        "type": "caption",
+        "captionId": caption_id,
+        "identity": identity,
+        "transcript": transcript,
+        "timestamp": timestamp,
+    }
+
+
+def test_finalized_by_flag_or_next_caption() -> None:
+    # interim updates aren't kept, only the last update of a finished caption
+    history = CaptionHistory()
+    history.update(caption("a", "a0", "hel", 1))
+    history.update(caption("a", "a0", "hello", 2))
+    history.update(caption("b", "b0", "hi there", 3), is_final=True)
+    assert [c["transcript"] for c in history.recent(10)] == ["hi there"]
+
+    # a new caption from the same speaker means the last one was finished
+    history.update(caption("a", "a1", "next", 4))
+    assert [c["transcript"] for c in history.recent(10)] == ["hi there", "hello"]
+
+
+def test_recent_limit_and_since() -> None:
+    history = CaptionHistory()
+    for i in range(5):
+        history.update(caption("a", f"a{i}", str(i), i * 1000), is_final=True)
+
+    assert [c["transcript"] for c in history.recent(2)] == ["3", "4"]
+    # a reconnect only gets what came after the last caption it saw
+    assert [c["transcript"] for c in history.recent(10, since=2000)] == ["3", "4"]
+
+
+def test_since_with_late_finalized_caption() -> None:
+    # a caption finalized late with an old timestamp shouldn't hide newer ones
+    history = CaptionHistory()
+    history.update(caption("a", "a0", "slow", 1000))
+    history.update(caption("b", "b0", "quick", 2000), is_final=True)
+    history.update(caption("a", "a0", "slow", 1000), is_final=True)
+    assert [c["transcript"] for c in history.recent(10, since=1500)] == ["quick"]
+
+
+def test_bounded_by_count_and_chars() -> None:
+    history = CaptionHistory(max_captions=3, max_chars=10)
+    for i in range(5):
+        history.update(caption("a", f"a{i}", "abc", i), is_final=True)
+    assert len(history) == 3
+
+    # one long caption pushes out older ones to stay under the character limit
+    history.update(caption("a", "long", "abcdefgh", 10), is_final=True)
+    assert [c["captionId"] for c in history.recent(10)] == ["long"]
@@ -0,0 +1,21 @@
+import json
+
+import pytest
+
+from core.encoding import ENCODERS, get_encoder
+
+
+@pytest.mark.parametrize("name", list(ENCODERS))
+def test_encoders_match(name: str) -> None:
+    # every encoder should give text that decodes to the same message
+    message = {"type": "caption", "transcript": "café ✓", "timestamp": 1}
+    text = get_encoder(name)(message)
+
+    assert isinstance(text, str)
+    assert json.loads(text) == message
+    assert text == ENCODERS["json"](message)
+
+
+def test_unknown_encoder() -> None:
+    with pytest.raises(ValueError):
+        get_encoder("yaml")
@@ -0,0 +1,75 @@
+from unittest.mock import AsyncMock
+
+import pytest
+from pytest_mock import MockFixture
+
+from core.clock import VirtualClock
+from core.expiry import ExpiryScheduler
+
+
+@pytest.mark.anyio
+async def test_rearm_and_cancel():
+    # only the latest deadline of a key should count
+    scheduler = ExpiryScheduler(AsyncMock())
+    scheduler.arm("a", 10.0)
+    scheduler.arm("b", 20.0)
+    scheduler.arm("a", 30.0)
+    scheduler.arm("c", 5.0)
+    assert scheduler.cancel("c")
+    assert not scheduler.cancel("c")
+
+    assert scheduler.pop_due(25.0) == [("b", 20.0)]
+    assert scheduler.pop_due(35.0) == [("a", 30.0)]
+    assert len(scheduler) == 0
+
+
+@pytest.mark.anyio
+async def test_cancel_compacts_heap():
+    # stale heap entries from cancelled keys shouldn't pile up
+    scheduler = ExpiryScheduler(AsyncMock())
+    for n in range(1000):
+        scheduler.arm(n, 100.0 + n)
+    for n in range(999):
+        scheduler.cancel(n)
+
+    assert scheduler.stats()["heap_size"] <= 2 + scheduler.COMPACT_SLACK
+    assert scheduler.pop_due(2000.0) == [(999, 1099.0)]
+
+
+@pytest.mark.anyio
+async def test_expires_due_keys_in_one_batch(clock: VirtualClock):
+    # keys due close together should be expired with a single call, never early
+    on_expire = AsyncMock()
+    scheduler = ExpiryScheduler(on_expire, batch_seconds=0.1)
+    now = clock.now
+    scheduler.arm("later", now + 60)
+    scheduler.arm("a", now + 0.02)
+    scheduler.arm("b", now + 0.05)
+    scheduler.arm("c", now + 0.15)
+
+    await clock.advance(0.04)
+    on_expire.assert_not_awaited()
+
+    # just past the 0.1 boundary, since rounding up to it can land a hair after
+    await clock.advance(0.07)
+    on_expire.assert_awaited_once_with([("a", now + 0.02), ("b", now + 0.05)])
+    stats = scheduler.stats()
+    assert stats["armed"] == 2
+    assert stats["expired"] == 2
+    assert stats["batches"] == 1
+    assert stats["max_lateness_ms"] <= 100
+
+
+@pytest.mark.anyio
+async def test_ignores_wall_clock_steps(clock: VirtualClock, mocker: MockFixture):
+    # an ntp sync moving the wall clock shouldn't expire keys that aren't due
+    on_expire = AsyncMock()
+    scheduler = ExpiryScheduler(on_expire)
+    scheduler.arm("a", clock.monotonic() + 10)
+
+    mocker.patch.object(clock, "time", return_value=clock.now + 3600)
+    await clock.advance(5)
+    on_expire.assert_not_awaited()
+
+    await clock.advance(5)
+    on_expire.assert_awaited_once()
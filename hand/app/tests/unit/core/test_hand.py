@@ -1,31 +1,51 @@
+import asyncio
 import json
 from unittest.mock import AsyncMock, MagicMock
 
 import pytest
 from pytest_mock import MockFixture
 
-from core.constants import HALFWAY_ANGLE, HALFWAY_SLEEP_TIME, MIN_ANGLE, Mode
-from core.hand import process_hand_request, raise_hand, raised_hands, timers
-from core.models import RaiseHandRequest
-from routes.queue_sse import get_queue, remove_from_queue
-
-
-# reset queue before each test
+import core.hand
+from core.clock import VirtualClock
+from core.constants import (
+    DEFAULT_ROOM,
+    HALFWAY_ANGLE,
+    HALFWAY_SLEEP_TIME,
+    MIN_ANGLE,
+    Mode,
+)
+from core.hand import (
+    clear_hands,
+    expire_hands,
+    expiry_scheduler,
+    hand_request_cache,
+    process_batch_request,
+    process_hand_request,
+    raise_hand,
+    restore_hands,
+)
+from core.models import BatchRaiseHandRequest, HandChange, RaiseHandRequest
+from core.state_backend import MemoryBackend, get_backend
+from routes.queue_sse import (
+    RoomQueue,
+    get_queue,
+    get_queue_length,
+    get_queue_position,
+    get_room_queue,
+)
+
+
+# reset queue and hands before each test
 @pytest.fixture(autouse=True)
-async def reset_queue():
-    queue_json = await get_queue()
-    queue_data = queue_json["data"]
-    current_queue = json.loads(queue_data)
-    for identity in current_queue:
-        await remove_from_queue(identity)
+def reset_state(mocker: MockFixture):
+    mocker.patch("core.state_backend._backend", MemoryBackend())
+    mocker.patch("routes.queue_sse.rooms", {})
 
 
 @pytest.fixture(autouse=True)
-def reset_hands_and_timers():
-    raised_hands.clear()
-    for task in timers.values():
-        task.cancel()
-    timers.clear()
+def reset_timers():
+    expiry_scheduler.clear()
+    hand_request_cache.clear()
 
 
 @pytest.fixture
@@ -37,13 +57,14 @@ def mock_servo_controller(mocker: MockFixture) -> MagicMock:
 
 
 @pytest.fixture
-def mock_add_to_queue(mocker: MockFixture) -> AsyncMock:
-    return mocker.patch("core.hand.add_to_queue", new_callable=AsyncMock)
-
-
-@pytest.fixture
-def mock_raise_hand(mocker: MockFixture) -> AsyncMock:
-    return mocker.patch("core.hand.raise_hand", new_callable=AsyncMock)
+def mock_move(mocker: MockFixture) -> MagicMock:
+    # only the mode is recorded, not when it was requested
+    moves = MagicMock()
+    mocker.patch(
+        "core.hand.motion_planner.submit",
+        side_effect=lambda mode, requested_at=None: moves(mode),
+    )
+    return moves
 
 
 @pytest.fixture
@@ -51,11 +72,6 @@ def mock_send_notification(mocker: MockFixture) -> AsyncMock:
     return mocker.patch("core.hand.send_notification", new_callable=AsyncMock)
 
 
-@pytest.fixture
-def mock_remove_from_queue(mocker: MockFixture) -> AsyncMock:
-    return mocker.patch("core.hand.remove_from_queue", new_callable=AsyncMock)
-
-
 @pytest.mark.anyio
 async def test_raise_hand_init(mock_servo_controller: MagicMock) -> None:
     # init mode shouldn't do anything
@@ -90,21 +106,19 @@ async def test_raise_hand_lower(mock_servo_controller: MagicMock) -> None:
 
 @pytest.mark.anyio
 async def test_process_hand_request_raise(
-    mock_add_to_queue: AsyncMock,
     mock_send_notification: AsyncMock,
-    mock_raise_hand: AsyncMock,
+    mock_move: MagicMock,
 ) -> None:
     # user should be able to raise hand
-    mock_add_to_queue.return_value = (True, 1)
-
     request = RaiseHandRequest(mode="RAISE", identity="user")
     error = await process_hand_request(request)
 
-    mock_raise_hand.assert_called_once_with(Mode.RAISE)
+    mock_move.assert_called_once_with(Mode.RAISE)
     assert error is None
 
-    mock_add_to_queue.assert_called_once_with("user")
-    mock_send_notification.assert_called_once_with("user")
+    assert await get_queue_position("user") == 1
+    assert (DEFAULT_ROOM, "user") in expiry_scheduler
+    mock_send_notification.assert_called_once_with("user", DEFAULT_ROOM)
 
 
 @pytest.mark.anyio
@@ -117,12 +131,8 @@ async def test_process_hand_request_invalid_mode():
 
 
 @pytest.mark.anyio
-async def test_process_hand_request_lower(
-    mock_remove_from_queue: AsyncMock, mock_raise_hand: AsyncMock
-):
+async def test_process_hand_request_lower(mock_move: MagicMock):
     # user should be able to lower hand
-    mock_remove_from_queue.return_value = 0
-
     request = RaiseHandRequest(mode="RAISE", identity="user")
     await process_hand_request(request)
 
@@ -131,9 +141,10 @@ async def test_process_hand_request_lower(
 
     assert error is None
 
-    mock_raise_hand.assert_called_with(Mode.LOWER)
+    mock_move.assert_called_with(Mode.LOWER)
 
-    mock_remove_from_queue.assert_called_with("user")
+    assert await get_queue_position("user") is None
+    assert (DEFAULT_ROOM, "user") not in expiry_scheduler
 
 
 @pytest.mark.anyio
@@ -146,7 +157,7 @@ async def test_process_hand_request_lower_fail():
 
 
 @pytest.mark.anyio
-async def test_process_hand_request_lower_return(mock_raise_hand: AsyncMock):
+async def test_process_hand_request_lower_return(mock_move: MagicMock):
     # mode should change from lower to lower_return if queue isn't empty
 
     # first raise
@@ -163,4 +174,228 @@ async def test_process_hand_request_lower_return(mock_raise_hand: AsyncMock):
 
     assert error is None
 
-    mock_raise_hand.assert_called_with(Mode.LOWER_RETURN)
+    mock_move.assert_called_with(Mode.LOWER_RETURN)
+
+
+@pytest.mark.anyio
+async def test_process_hand_request_other_room(mock_move: MagicMock):
+    # hands in a room without the physical hand shouldn't move the servo
+    request = RaiseHandRequest(mode="RAISE", identity="user", room="Lab")
+    error = await process_hand_request(request)
+
+    assert error is None
+    mock_move.assert_not_called()
+
+    # the same identity can still raise in the hand room
+    request = RaiseHandRequest(mode="RAISE", identity="user")
+    error = await process_hand_request(request)
+
+    assert error is None
+    mock_move.assert_called_once_with(Mode.RAISE)
+
+
+@pytest.mark.anyio
+async def test_process_hand_request_forwards_servo_move(
+    mocker: MockFixture, mock_move: MagicMock
+):
+    # a worker that doesn't own the servo should hand the move to the owner
+    mock_push = mocker.patch.object(get_backend(), "push_servo_command")
+    mocker.patch("core.hand.servo_controller.owner", False)
+
+    request = RaiseHandRequest(mode="RAISE", identity="user")
+    error = await process_hand_request(request)
+
+    assert error is None
+    mock_move.assert_not_called()
+    mock_push.assert_called_once_with("RAISE")
+
+
+@pytest.mark.anyio
+async def test_restore_hands(clock: VirtualClock, mock_move: MagicMock):
+    # restored hands should expire after the time they had left
+    get_backend().queue_add(DEFAULT_ROOM, "user1", clock.now - 100)
+    get_backend().queue_add(DEFAULT_ROOM, "user2", clock.now + 100)
+
+    await restore_hands()
+    # let the expired timer run
+    await clock.advance(0)
+
+    # user1's time ran out while the server was down
+    assert json.loads((await get_queue())["data"]) == ["user2"]
+    assert (DEFAULT_ROOM, "user1") not in expiry_scheduler
+    assert (DEFAULT_ROOM, "user2") in expiry_scheduler
+    mock_move.assert_any_call(Mode.RAISE)
+
+
+@pytest.mark.anyio
+async def test_expire_hands_moves_servo_once(mock_move: MagicMock):
+    # hands that time out together should lower the physical hand once
+    for identity in ["user1", "user2", "user3"]:
+        await process_hand_request(RaiseHandRequest(mode="RAISE", identity=identity))
+    await asyncio.sleep(0)
+    mock_move.reset_mock()
+
+    backend = get_backend()
+    await expire_hands(
+        [
+            ((DEFAULT_ROOM, identity), backend.get_deadline(DEFAULT_ROOM, identity))
+            for identity in ["user1", "user2"]
+        ]
+    )
+    await asyncio.sleep(0)
+
+    assert json.loads((await get_queue())["data"]) == ["user3"]
+    mock_move.assert_called_once_with(Mode.LOWER_RETURN)
+
+
+@pytest.mark.anyio
+async def test_process_hand_request_concurrent_raises(mock_move: MagicMock):
+    # the same hand raised twice at once should only be raised once
+    request = RaiseHandRequest(mode="RAISE", identity="user")
+    errors = await asyncio.gather(
+        process_hand_request(request), process_hand_request(request)
+    )
+
+    assert errors.count(None) == 1
+    assert "Hand is already raised at position 1" in errors
+    mock_move.assert_called_once_with(Mode.RAISE)
+
+
+@pytest.mark.anyio
+async def test_expire_hands_keeps_hand_raised_again(mock_move: MagicMock):
+    # an old timer shouldn't lower a hand that was lowered and raised again
+    request = RaiseHandRequest(mode="RAISE", identity="user")
+    await process_hand_request(request)
+    old_deadline = get_backend().get_deadline(DEFAULT_ROOM, "user")
+
+    await process_hand_request(RaiseHandRequest(mode="LOWER", identity="user"))
+    get_backend().queue_add(DEFAULT_ROOM, "user", old_deadline + 1)
+
+    await expire_hands([((DEFAULT_ROOM, "user"), old_deadline)])
+
+    assert await get_queue_position("user") == 1
+
+
+@pytest.mark.anyio
+async def test_expire_hands_over_room_limit(mocker: MockFixture, mock_move: MagicMock):
+    # a timer that already fired should still lower its hand when rooms are full
+    mocker.patch("routes.queue_sse.MAX_ROOMS", 1)
+    await process_hand_request(RaiseHandRequest(mode="RAISE", identity="user1"))
+    get_backend().queue_add("Lab", "user2", 100.0)
+
+    await expire_hands([(("Lab", "user2"), 100.0)])
+
+    assert get_backend().queue_snapshot("Lab")[1] == []
+
+
+@pytest.mark.anyio
+async def test_process_batch_request(mocker: MockFixture, mock_move: MagicMock):
+    # a batch should notify and move the hand once for every change
+    await process_hand_request(RaiseHandRequest(mode="RAISE", identity="user1"))
+    mock_move.reset_mock()
+    mock_notify = mocker.patch(
+        "core.hand.send_batch_notification", new_callable=AsyncMock
+    )
+    room_queue = get_room_queue(DEFAULT_ROOM)
+    version = room_queue.hub.version
+
+    request = BatchRaiseHandRequest(
+        changes=[
+            HandChange(mode="RAISE", identity="user2"),
+            HandChange(mode="LOWER", identity="user1"),
+            HandChange(mode="RAISE", identity="user3"),
+        ]
+    )
+    assert await process_batch_request(request) == (None, [True] * 3)
+
+    assert json.loads((await get_queue())["data"]) == ["user2", "user3"]
+    assert (DEFAULT_ROOM, "user1") not in expiry_scheduler
+    assert (DEFAULT_ROOM, "user3") in expiry_scheduler
+    # delta clients get every change of the batch in one update
+    assert len(room_queue.get_events_since(version)[1]) == 3
+    mock_notify.assert_awaited_once_with(["user2", "user3"], DEFAULT_ROOM)
+    mock_move.assert_called_once_with(Mode.RAISE_RETURN)
+
+
+@pytest.mark.anyio
+async def test_process_batch_request_all_or_nothing(mock_move: MagicMock):
+    # a batch with a change that can't be applied shouldn't apply any of it
+    request = BatchRaiseHandRequest(
+        changes=[
+            HandChange(mode="RAISE", identity="user1"),
+            HandChange(mode="LOWER", identity="user2"),
+        ]
+    )
+    error, applied = await process_batch_request(request)
+
+    assert error == "Hand isn't raised for user2"
+    assert applied == []
+    assert await get_queue_length() == 0
+    assert (DEFAULT_ROOM, "user1") not in expiry_scheduler
+    mock_move.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_process_batch_request_shared_state(
+    mocker: MockFixture, mock_move: MagicMock
+):
+    # another worker's raise should be seen, and if it lands after the check the
+    # result should say what the backend actually did
+    mock_notify = mocker.patch(
+        "core.hand.send_batch_notification", new_callable=AsyncMock
+    )
+    get_backend().queue_add(DEFAULT_ROOM, "user1", None)
+    request = BatchRaiseHandRequest(
+        changes=[HandChange(mode="RAISE", identity="user1")]
+    )
+
+    error, _ = await process_batch_request(request)
+    assert error == "Hand is already raised for user1"
+
+    # the raise lands between the check and the batch
+    get_backend().queue_add(DEFAULT_ROOM, "user2", None)
+    mocker.patch.object(RoomQueue, "sync")
+    request = BatchRaiseHandRequest(
+        changes=[
+            HandChange(mode="RAISE", identity="user2"),
+            HandChange(mode="RAISE", identity="user3"),
+        ]
+    )
+    assert await process_batch_request(request) == (None, [False, True])
+
+    assert (DEFAULT_ROOM, "user2") not in expiry_scheduler
+    assert (DEFAULT_ROOM, "user3") in expiry_scheduler
+    mock_notify.assert_awaited_once_with(["user3"], DEFAULT_ROOM)
+
+
+@pytest.mark.anyio
+async def test_clear_hands(mock_move: MagicMock):
+    # clearing should lower every hand with one move
+    for identity in ["user1", "user2", "user3"]:
+        await process_hand_request(RaiseHandRequest(mode="RAISE", identity=identity))
+    mock_move.reset_mock()
+
+    assert await clear_hands() == 3
+
+    assert await get_queue_length() == 0
+    assert len(expiry_scheduler) == 0
+    mock_move.assert_called_once_with(Mode.LOWER)
+
+
+@pytest.mark.anyio
+async def test_process_hand_request_retry(
+    mocker: MockFixture, mock_send_notification: AsyncMock, mock_move: MagicMock
+):
+    # a retried request should get the first result without raising again
+    handle_raise = mocker.spy(core.hand, "handle_raise")
+    request = RaiseHandRequest(mode="RAISE", identity="user", idempotency_key="1")
+
+    assert await process_hand_request(request) is None
+    assert await process_hand_request(request) is None
+
+    handle_raise.assert_called_once()
+    mock_move.assert_called_once_with(Mode.RAISE)
+
+    # a new key is a new request
+    retry = RaiseHandRequest(mode="RAISE", identity="user", idempotency_key="2")
+    assert await process_hand_request(retry) == "Hand is already raised at position 1"
@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from core.clock import VirtualClock
+from core.idempotency import IdempotencyCache
+
+
+@pytest.mark.anyio
+async def test_retry_shares_running_request():
+    # a retry while the first request runs should wait for its result
+    cache: IdempotencyCache[str] = IdempotencyCache()
+    calls = 0
+
+    async def request() -> str:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return "done"
+
+    results = await asyncio.gather(cache.run("key", request), cache.run("key", request))
+
+    assert results == ["done", "done"]
+    assert calls == 1
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 1}
+
+
+@pytest.mark.anyio
+async def test_results_expire_and_evict(clock: VirtualClock):
+    # old and least recently used results should be forgotten
+    cache: IdempotencyCache[int] = IdempotencyCache(max_size=2, ttl_seconds=10)
+    calls = 0
+
+    async def request() -> int:
+        nonlocal calls
+        calls += 1
+        return calls
+
+    assert await cache.run("a", request) == 1
+    assert await cache.run("b", request) == 2
+    assert await cache.run("a", request) == 1
+    assert await cache.run("c", request) == 3
+    # b was used least recently
+    assert await cache.run("b", request) == 4
+
+    await clock.advance(10)
+    assert await cache.run("c", request) == 5
+    assert len(cache) == 2
+
+
+@pytest.mark.anyio
+async def test_failed_request_can_be_retried():
+    # a request that raised shouldn't be remembered
+    cache: IdempotencyCache[str] = IdempotencyCache()
+
+    async def fail() -> str:
+        raise RuntimeError("failed")
+
+    async def succeed() -> str:
+        return "done"
+
+    with pytest.raises(RuntimeError):
+        await cache.run("key", fail)
+
+    assert await cache.run("key", succeed) == "done"
+
+
+@pytest.mark.anyio
+async def test_contains_until_expired(clock: VirtualClock):
+    # a key counts as cached while its result would be reused
+    cache: IdempotencyCache[int] = IdempotencyCache(ttl_seconds=10)
+
+    async def request() -> int:
+        return 1
+
+    assert "a" not in cache
+    await cache.run("a", request)
+    assert "a" in cache
+
+    await clock.advance(10)
+    assert "a" not in cache
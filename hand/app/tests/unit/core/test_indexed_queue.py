@@ -0,0 +1,52 @@
+from core.indexed_queue import IndexedQueue
+
+
+def test_indexed_queue_fifo_order() -> None:
+    # identities should come out in the order they were added
+    queue = IndexedQueue(["a", "b", "c"])
+
+    assert queue.append("a") is False
+    assert queue.append("d") is True
+
+    assert list(queue) == ["a", "b", "c", "d"]
+    assert len(queue) == 4
+    assert "c" in queue
+
+
+def test_indexed_queue_position() -> None:
+    # positions should shift down when earlier identities are removed
+    queue = IndexedQueue(["a", "b", "c", "d"])
+
+    assert queue.position("a") == 1
+    assert queue.position("d") == 4
+
+    assert queue.remove("b") is True
+    assert queue.remove("b") is False
+
+    assert queue.position("c") == 2
+    assert queue.position("d") == 3
+    assert queue.position("b") is None
+
+
+def test_indexed_queue_readd_goes_to_back() -> None:
+    queue = IndexedQueue(["a", "b"])
+
+    queue.remove("a")
+    queue.append("a")
+
+    assert list(queue) == ["b", "a"]
+    assert queue.position("a") == 2
+
+
+def test_indexed_queue_compaction_keeps_positions() -> None:
+    # lots of churn should compact the tree without changing order or positions
+    queue = IndexedQueue()
+    for i in range(1000):
+        queue.append(f"user{i}")
+        if i % 3:
+            queue.remove(f"user{i - 1}")
+
+    expected = list(queue)
+    assert len(queue._tree) - 1 <= 2 * len(queue) + IndexedQueue.COMPACT_SLACK
+    for position, identity in enumerate(expected, 1):
+        assert queue.position(identity) == position
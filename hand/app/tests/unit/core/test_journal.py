@@ -0,0 +1,83 @@
+import pathlib
+import threading
+
+import pytest
+from pytest_mock import MockFixture
+
+from core.clock import VirtualClock
+from core.journal import Journal
+from core.state_backend import MemoryBackend
+
+
+@pytest.fixture
+def journal_path(tmp_path: pathlib.Path) -> str:
+    return str(tmp_path / "state.journal")
+
+
+def test_journal_restores_queue_and_hands(journal_path: str, clock: VirtualClock):
+    # a restarted backend should have the same queue, versions and hands
+    backend = MemoryBackend(Journal(journal_path, fsync=False))
+    backend.queue_add("room", "user1", clock.now + 50)
+    backend.queue_add("room", "user2", clock.now + 100)
+    backend.queue_remove("room", "user1")
+    backend.add_subscription("room", {"endpoint": "url"})
+    backend.close()
+
+    restored = MemoryBackend(Journal(journal_path, fsync=False))
+
+    assert restored.queue_snapshot("room") == (3, ["user2"])
+    assert restored.get_raised_hands() == [("room", "user2", clock.now + 100)]
+    # subscriptions shouldn't persist
+    assert restored.get_subscriptions("room") == []
+
+
+def test_journal_compaction(journal_path: str):
+    # records should move into the snapshot without being applied twice
+    journal = Journal(journal_path, compact_every=2, fsync=False)
+    backend = MemoryBackend(journal)
+    for identity in ["user1", "user2", "user3"]:
+        backend.queue_add("room", identity)
+    journal.flush()
+
+    with open(journal_path) as f:
+        assert len(f.readlines()) == 1
+
+    restored = MemoryBackend(Journal(journal_path, fsync=False))
+
+    assert restored.queue_snapshot("room") == (3, ["user1", "user2", "user3"])
+
+
+def test_journal_ignores_incomplete_record(journal_path: str):
+    # a record cut off by a crash should be dropped, not break the restore
+    backend = MemoryBackend(Journal(journal_path, fsync=False))
+    backend.queue_add("room", "user1")
+    backend.close()
+    with open(journal_path, "a") as f:
+        f.write('{"op": "add", "room": "ro')
+
+    restored = MemoryBackend(Journal(journal_path, fsync=False))
+
+    assert restored.queue_snapshot("room") == (1, ["user1"])
+
+
+def test_journal_group_commit(journal_path: str, mocker: MockFixture):
+    # appends shouldn't wait for the disk, and ones queued meanwhile share a sync
+    syncing, release = threading.Event(), threading.Event()
+
+    def slow_fsync(fd: int) -> None:
+        syncing.set()
+        release.wait(5)
+
+    fsync = mocker.patch("core.journal.os.fsync", side_effect=slow_fsync)
+    journal = Journal(journal_path)
+    journal.append({"op": "add", "room": "room", "identity": "user1"})
+    assert syncing.wait(5)
+
+    for identity in ["user2", "user3", "user4"]:
+        journal.append({"op": "add", "room": "room", "identity": identity})
+    release.set()
+    journal.close()
+
+    assert fsync.call_count == 2
+    _, records = Journal(journal_path).load()
+    assert [record["seq"] for record in records] == [1, 2, 3, 4]
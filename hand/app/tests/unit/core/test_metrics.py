@@ -0,0 +1,46 @@
+import pytest
+
+from core.metrics import MetricsRegistry
+
+
+def test_counter_render() -> None:
+    registry = MetricsRegistry()
+    counter = registry.counter("requests_total", "Requests.", ("mode",))
+    counter.inc(mode="RAISE")
+    counter.inc(2, mode="RAISE")
+    counter.inc(mode="LOWER")
+
+    assert counter.value(mode="RAISE") == 3
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests.",
+        "# TYPE requests_total counter",
+        'requests_total{mode="RAISE"} 3',
+        'requests_total{mode="LOWER"} 1',
+    ]
+
+
+def test_histogram_buckets() -> None:
+    registry = MetricsRegistry()
+    histogram = registry.histogram("wait_seconds", "Wait.", buckets=(0.1, 1))
+    for value in [0.05, 0.1, 0.5, 3]:
+        histogram.observe(value)
+
+    # buckets are cumulative and include their upper bound
+    assert histogram.count() == 4
+    assert registry.render().splitlines()[2:] == [
+        'wait_seconds_bucket{le="0.1"} 2',
+        'wait_seconds_bucket{le="1"} 3',
+        'wait_seconds_bucket{le="+Inf"} 4',
+        "wait_seconds_sum 3.65",
+        "wait_seconds_count 4",
+    ]
+
+
+def test_registry_returns_existing_metric() -> None:
+    # modules declaring the same metric share it, a different type is an error
+    registry = MetricsRegistry()
+    counter = registry.counter("moves_total", "Moves.")
+    assert registry.counter("moves_total", "Moves.") is counter
+
+    with pytest.raises(ValueError):
+        registry.histogram("moves_total", "Moves.")
@@ -0,0 +1,109 @@
+import asyncio
+from typing import List
+
+import pytest
+
+from core.constants import Mode
+from core.motion_planner import MotionPlanner
+
+
+class RecordingServo:
+    def __init__(self, delay: float = 0.0) -> None:
+        self.delay = delay
+        self.moves: List[Mode] = []
+
+    async def __call__(self, mode: Mode) -> None:
+        self.moves.append(mode)
+        await asyncio.sleep(self.delay)
+
+
+@pytest.mark.anyio
+async def test_raise_then_lower_cancels():
+    # a raise and lower before either runs shouldn't move a hand that's down
+    servo = RecordingServo()
+    planner = MotionPlanner(servo)
+    planner.submit(Mode.LOWER)
+    await asyncio.sleep(0.01)
+
+    planner.submit(Mode.RAISE)
+    planner.submit(Mode.LOWER)
+    await asyncio.sleep(0.01)
+
+    assert servo.moves == [Mode.LOWER]
+    assert planner.stats()["collapsed"] == 2
+
+
+@pytest.mark.anyio
+async def test_repeated_nudges_collapse():
+    # nudges queued behind a running move should become one nudge
+    servo = RecordingServo(delay=0.05)
+    planner = MotionPlanner(servo)
+    planner.submit(Mode.RAISE)
+    await asyncio.sleep(0.01)
+
+    for _ in range(10):
+        planner.submit(Mode.RAISE_RETURN)
+    assert planner.depth == 1
+    assert planner.lag() > 0
+
+    await asyncio.sleep(0.15)
+
+    assert servo.moves == [Mode.RAISE, Mode.RAISE_RETURN]
+    stats = planner.stats()
+    assert stats["depth"] == 0
+    assert stats["lag_ms"] == 0
+    assert stats["position_raised"] is True
+
+
+@pytest.mark.anyio
+async def test_latest_position_wins():
+    # only the final position should run after the interrupted move
+    servo = RecordingServo(delay=0.05)
+    planner = MotionPlanner(servo)
+    planner.submit(Mode.RAISE)
+    await asyncio.sleep(0.01)
+
+    planner.submit(Mode.LOWER)
+    planner.submit(Mode.WAVE)
+    planner.submit(Mode.WAVE2)
+    planner.submit(Mode.RAISE)
+    await asyncio.sleep(0.15)
+
+    # the raise was cut short, so it has to run again
+    assert servo.moves == [Mode.RAISE, Mode.RAISE]
+    assert planner.target is True
+    assert planner.stats()["interrupted"] == 1
+
+
+@pytest.mark.anyio
+async def test_pending_moves_are_bounded():
+    # waves and nudges alternating can't all collapse, so the oldest are dropped
+    servo = RecordingServo(delay=0.05)
+    planner = MotionPlanner(servo, max_pending=2)
+    planner.submit(Mode.LOWER)
+    await asyncio.sleep(0.01)
+
+    for _ in range(3):
+        planner.submit(Mode.WAVE)
+        planner.submit(Mode.LOWER_RETURN)
+
+    assert planner.depth == 2
+    assert planner.stats()["dropped"] > 0
+
+
+@pytest.mark.anyio
+async def test_reversal_interrupts_running_move():
+    # lowering while the hand is still going up should stop the raise
+    servo = RecordingServo(delay=1.0)
+    planner = MotionPlanner(servo)
+    planner.submit(Mode.RAISE)
+    await asyncio.sleep(0.01)
+
+    servo.delay = 0.0
+    planner.submit(Mode.LOWER)
+    await asyncio.sleep(0.01)
+
+    assert servo.moves == [Mode.RAISE, Mode.LOWER]
+    stats = planner.stats()
+    assert stats["interrupted"] == 1
+    assert stats["position_raised"] is False
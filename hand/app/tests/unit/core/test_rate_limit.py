@@ -0,0 +1,68 @@
+import math
+
+import pytest
+
+from core.clock import VirtualClock
+from core.rate_limit import RateLimiter
+
+
+@pytest.mark.anyio
+async def test_key_limit(clock: VirtualClock):
+    # a key should get its burst, then wait for tokens to refill
+    limiter = RateLimiter(rate=1, burst=3, global_rate=100, global_burst=100)
+    assert [limiter.acquire("user") for _ in range(3)] == [0, 0, 0]
+    assert limiter.acquire("user") == pytest.approx(1)
+    # other keys have their own bucket
+    assert limiter.acquire("other") == 0
+
+    await clock.advance(1)
+
+    assert limiter.acquire("user") == 0
+    assert limiter.stats() == {"active": 2, "allowed": 5, "rejected": 1}
+
+
+@pytest.mark.anyio
+async def test_global_limit(clock: VirtualClock):
+    # every key together shouldn't go over the global limit
+    limiter = RateLimiter(rate=1, burst=1, global_rate=1, global_burst=2)
+    assert limiter.acquire("user1") == 0
+    assert limiter.acquire("user2") == 0
+    assert limiter.acquire("user3") == pytest.approx(1)
+
+
+@pytest.mark.anyio
+async def test_idle_buckets_dropped(clock: VirtualClock):
+    # buckets that have refilled shouldn't be kept
+    limiter = RateLimiter(rate=1, burst=2, global_rate=100, global_burst=100)
+    for n in range(100):
+        limiter.acquire(f"user{n}")
+    assert len(limiter) == 100
+
+    await clock.advance(2)
+    limiter.acquire("user")
+
+    assert len(limiter) == 1
+
+
+@pytest.mark.anyio
+async def test_acquire_many(clock: VirtualClock):
+    # a request for several keys should cost each of them, or none if one is short
+    limiter = RateLimiter(rate=1, burst=2, global_rate=100, global_burst=100)
+    assert limiter.acquire("user1") == 0
+    assert limiter.acquire("user1") == 0
+
+    assert limiter.acquire_many(["user1", "user2"]) == pytest.approx(1)
+    assert limiter.acquire("user2") == 0
+
+    assert limiter.acquire_many(["user2", "user3", "user3"]) == 0
+    assert limiter.acquire("user3") == pytest.approx(1)
+
+
+@pytest.mark.anyio
+async def test_acquire_more_than_burst(clock: VirtualClock):
+    # a cost no bucket can ever hold should be refused outright, not retried
+    limiter = RateLimiter(rate=1, burst=2, global_rate=100, global_burst=3)
+    assert limiter.acquire_many(["user1"] * 3) == math.inf
+    assert limiter.acquire_many(["user1", "user2", "user3", "user4"]) == math.inf
+    assert limiter.acquire_many(["user1", "user1", "user2"]) == 0
+    assert limiter.stats()["rejected"] == 2
@@ -1,4 +1,13 @@
-from core.servo_controller import ServoController
+import asyncio
+import threading
+
+import pytest
+from pytest_mock import MockFixture
+
+from core.clock import VirtualClock
+from core.constants import HALFWAY_ANGLE, MAX_ANGLE, MIN_ANGLE, SERVO_STEP_TIME
+from core.servo_controller import ServoController, travel_time
+from core.simulated_servo import SimulatedPwm
 
 
 def test_servo_controller_init() -> None:
@@ -8,3 +17,102 @@ def test_servo_controller_init() -> None:
     assert servo_controller.pwm is not None
 
     assert servo_controller.lock is not None
+
+
+@pytest.mark.anyio
+async def test_move_time_depends_on_distance(clock: VirtualClock) -> None:
+    # a move should take as long as the distance, and a move in place nothing
+    pwm = SimulatedPwm()
+    servo_controller = ServoController(threaded=False, pwm=pwm)
+    servo_controller.angle = MIN_ANGLE
+
+    move = asyncio.create_task(servo_controller.set_angle(HALFWAY_ANGLE, 10))
+    await clock.advance(travel_time(MIN_ANGLE, HALFWAY_ANGLE) - SERVO_STEP_TIME)
+    assert not move.done()
+    await clock.advance(SERVO_STEP_TIME * 2)
+
+    assert move.done()
+    assert pwm.angle() == servo_controller.angle == HALFWAY_ANGLE
+
+    sent = len(pwm.trace)
+    await servo_controller.set_angle(HALFWAY_ANGLE, 10)
+
+    assert len(pwm.trace) == sent
+
+
+@pytest.mark.anyio
+async def test_cancelled_move_keeps_angle(clock: VirtualClock) -> None:
+    # a cancelled move should leave the angle where the arm stopped
+    pwm = SimulatedPwm()
+    servo_controller = ServoController(threaded=False, pwm=pwm)
+    servo_controller.angle = MIN_ANGLE
+
+    move = asyncio.create_task(servo_controller.set_angle(MAX_ANGLE, 10))
+    await clock.advance(travel_time(MIN_ANGLE, MAX_ANGLE) / 2)
+    move.cancel()
+    await asyncio.gather(move, return_exceptions=True)
+
+    stopped = servo_controller.angle
+    assert MAX_ANGLE < stopped < MIN_ANGLE
+    assert pwm.angle() == stopped
+    assert not servo_controller.lock.locked()
+
+    # turning back only goes the distance covered so far
+    back = asyncio.create_task(servo_controller.set_angle(MIN_ANGLE, 10))
+    await clock.advance(travel_time(stopped, MIN_ANGLE) + SERVO_STEP_TIME)
+
+    assert back.done()
+    assert servo_controller.angle == MIN_ANGLE
+
+
+@pytest.mark.anyio
+async def test_cancelled_threaded_move_keeps_angle() -> None:
+    # the worker thread should stop where it is and report the last step sent
+    pwm = SimulatedPwm()
+    servo_controller = ServoController(threaded=True, pwm=pwm)
+    servo_controller.angle = MIN_ANGLE
+
+    move = asyncio.create_task(servo_controller.set_angle(MAX_ANGLE, 10))
+
+    async def steps_sent(count: int) -> None:
+        while len(pwm.trace) < count:
+            await asyncio.sleep(0.005)
+
+    await asyncio.wait_for(steps_sent(3), timeout=5)
+    move.cancel()
+    await asyncio.gather(move, return_exceptions=True)
+
+    sent = [angle for _, angle in pwm.angles()]
+    assert MAX_ANGLE < servo_controller.angle < MIN_ANGLE
+    assert servo_controller.angle in sent
+    assert MAX_ANGLE not in sent
+    assert not servo_controller.lock.locked()
+
+    await servo_controller.set_angle(MIN_ANGLE, 10)
+    servo_controller.worker.stop()
+
+    assert servo_controller.angle == MIN_ANGLE
+    # it went back from where it stopped, so it never reached the far end
+    assert MAX_ANGLE not in [angle for _, angle in pwm.angles()]
+
+
+@pytest.mark.anyio
+async def test_threaded_moves_record_latency(mocker: MockFixture) -> None:
+    # duty cycles should be sent from the worker thread, not the event loop
+    servo_controller = ServoController(threaded=True)
+    servo_controller.angle = HALFWAY_ANGLE
+    threads = []
+    mocker.patch.object(
+        servo_controller.pwm,
+        "ChangeDutyCycle",
+        side_effect=lambda _: threads.append(threading.current_thread()),
+    )
+
+    await servo_controller.set_angle(HALFWAY_ANGLE + 10, 10)
+    servo_controller.worker.stop()
+
+    assert threads and threading.main_thread() not in threads
+    assert servo_controller.angle == HALFWAY_ANGLE + 10
+    stats = servo_controller.stats()
+    assert stats["threaded"]
+    assert stats["actuations"] == len(threads)
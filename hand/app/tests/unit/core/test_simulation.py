@@ -0,0 +1,131 @@
+import random
+import time
+from typing import Dict
+
+import pytest
+from pytest_mock import MockFixture
+
+from core.clock import VirtualClock
+from core.constants import HALFWAY_ANGLE, MIN_ANGLE, SERVO_STEP_TIME
+from core.hand import (
+    HAND_ROOM,
+    HAND_TIMEOUT_SECONDS,
+    expiry_scheduler,
+    process_hand_request,
+    raise_hand,
+)
+from core.models import RaiseHandRequest
+from core.motion_planner import MotionPlanner
+from core.servo_controller import ServoController, travel_time
+from core.simulated_servo import SimulatedPwm
+from core.state_backend import MemoryBackend
+from routes.queue_sse import get_queue_length, get_room_queue
+
+# a class with this many students raising hands at these rates
+CLASS_MINUTES = 45
+STUDENTS = 30
+# chance per second that a student raises or lowers their hand
+RAISE_CHANCE = 1 / 600
+LOWER_CHANCE = 1 / 200
+# the queue has to stay the same this long for the hand to have caught up
+SETTLE_SECONDS = 3
+# the whole class should simulate in under this many real seconds
+MAX_REAL_SECONDS = 1
+
+
+@pytest.fixture
+def pwm(mocker: MockFixture, clock: VirtualClock) -> SimulatedPwm:
+    mocker.patch("core.state_backend._backend", MemoryBackend())
+    mocker.patch("routes.queue_sse.rooms", {})
+    expiry_scheduler.clear()
+
+    pwm = SimulatedPwm()
+    controller = ServoController(threaded=False, pwm=pwm)
+    # the hand starts lowered
+    controller.angle = MIN_ANGLE
+    mocker.patch("core.hand.servo_controller", controller)
+    mocker.patch("core.hand.motion_planner", MotionPlanner(raise_hand))
+    return pwm
+
+
+async def send(mode: str, identity: str) -> None:
+    request = RaiseHandRequest(mode=mode, identity=identity, room=HAND_ROOM)
+    assert await process_hand_request(request) is None
+
+
+@pytest.mark.anyio
+async def test_raise_trace(clock: VirtualClock, pwm: SimulatedPwm):
+    # raising should move the arm to halfway in steps over the travel time
+    start = clock.now
+    await send("RAISE", "user")
+    await clock.advance(5)
+
+    steps = round(travel_time(MIN_ANGLE, HALFWAY_ANGLE) / SERVO_STEP_TIME)
+    angles = pwm.angles()
+    assert [at - start for at, _ in angles] == pytest.approx(
+        [n * SERVO_STEP_TIME for n in range(steps)]
+    )
+    assert angles[-1][1] == HALFWAY_ANGLE
+    assert all(a > b for (_, a), (_, b) in zip(angles, angles[1:]))
+
+
+@pytest.mark.anyio
+async def test_hand_times_out(clock: VirtualClock, pwm: SimulatedPwm):
+    # the hand should go back down once the timeout passes
+    await send("RAISE", "user")
+    await clock.advance(HAND_TIMEOUT_SECONDS - 1)
+    assert pwm.angle() == HALFWAY_ANGLE
+
+    await clock.advance(SETTLE_SECONDS)
+
+    assert await get_queue_length(HAND_ROOM) == 0
+    # relaxed at the bottom
+    assert pwm.angle() is None
+    assert pwm.angles()[-2][1] == MIN_ANGLE
+
+
+@pytest.mark.anyio
+async def test_class_of_hand_traffic(clock: VirtualClock, pwm: SimulatedPwm):
+    # the hand should always catch up with the queue over a whole class
+    started = time.perf_counter()
+    rng = random.Random(0)
+    raised: Dict[str, bool] = {f"student-{n}": False for n in range(STUDENTS)}
+    requests = 0
+    last_length = 0
+    unchanged_since = clock.now
+
+    for _ in range(CLASS_MINUTES * 60):
+        for identity, is_raised in raised.items():
+            if not is_raised and rng.random() < RAISE_CHANCE:
+                await send("RAISE", identity)
+            elif is_raised and rng.random() < LOWER_CHANCE:
+                await send("LOWER", identity)
+            else:
+                continue
+            requests += 1
+            # a raise and a lower together leave the length the same
+            unchanged_since = clock.now
+
+        await clock.advance(1)
+
+        # hands can also time out, so check the queue for who is still up
+        queue = get_room_queue(HAND_ROOM).queue
+        length = len(queue)
+        raised = {identity: identity in queue for identity in raised}
+
+        if length != last_length:
+            last_length = length
+            unchanged_since = clock.now
+        elif clock.now - unchanged_since >= SETTLE_SECONDS:
+            expected = HALFWAY_ANGLE if length else None
+            assert pwm.angle() == expected, f"hand behind at {clock.now}"
+
+    assert requests > 100
+    assert expiry_scheduler.stats()["expired"] > 0
+
+    # the rest of the hands time out after class
+    await clock.advance(HAND_TIMEOUT_SECONDS + SETTLE_SECONDS)
+
+    assert await get_queue_length(HAND_ROOM) == 0
+    assert time.perf_counter() - started < MAX_REAL_SECONDS
+    assert pwm.angle() is None
@@ -0,0 +1,148 @@
+import pathlib
+
+import pytest
+from pytest_mock import MockFixture
+
+from core.state_backend import MemoryBackend, SqliteBackend
+from routes.queue_sse import RoomQueue
+
+
+@pytest.fixture
+def db_path(tmp_path: pathlib.Path) -> str:
+    return str(tmp_path / "state.db")
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_backend_queue_changes(shared: bool, db_path: str):
+    # both backends should version queue changes the same way
+    backend = SqliteBackend(db_path) if shared else MemoryBackend()
+
+    assert backend.queue_add("room", "user1") == (True, 1)
+    assert backend.queue_add("room", "user1") == (False, 1)
+    assert backend.queue_add("room", "user2") == (True, 2)
+    assert backend.queue_remove("room", "user1") == (True, 1)
+    assert backend.queue_remove("room", "user1") == (False, 1)
+
+    changes = backend.queue_changes_since("room", 1)
+    assert [(c.version, c.event, c.identity) for c in changes] == [
+        (2, "add", "user2"),
+        (3, "remove", "user1"),
+    ]
+    assert backend.queue_changes_since("room", 3) == []
+    assert backend.queue_snapshot("room") == (3, ["user2"])
+    assert backend.queue_snapshot("other room") == (0, [])
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_backend_queue_batch(shared: bool, db_path: str):
+    # a batch should apply in order and version each change
+    backend = SqliteBackend(db_path) if shared else MemoryBackend()
+    backend.queue_add("room", "user1")
+
+    changes = [
+        ("add", "user2", 50.0),
+        ("remove", "user1", None),
+        ("add", "user2", 60.0),
+        ("add", "user3", 50.0),
+    ]
+    assert backend.queue_batch("room", changes) == ([True, True, False, True], 2)
+
+    assert backend.queue_snapshot("room") == (4, ["user2", "user3"])
+    assert backend.get_deadline("room", "user2") == 50.0
+
+
+@pytest.mark.anyio
+async def test_sqlite_backend_shared_between_workers(
+    mocker: MockFixture, db_path: str
+) -> None:
+    # a queue changed through one worker should show up in the other
+    worker1, worker2 = SqliteBackend(db_path), SqliteBackend(db_path)
+    room1, room2 = RoomQueue("room"), RoomQueue("room")
+
+    mocker.patch("core.state_backend._backend", worker1)
+    room1.add("user1")
+
+    mocker.patch("core.state_backend._backend", worker2)
+    assert worker2.has_changed()
+    assert not worker2.has_changed()
+    room2.add("user2")
+
+    mocker.patch("core.state_backend._backend", worker1)
+    assert worker1.has_changed()
+    room1.sync()
+
+    assert list(room1.queue) == list(room2.queue) == ["user1", "user2"]
+    assert room1.hub.version == room2.hub.version == 2
+    assert room1.get_events_since(1) == room2.get_events_since(1)
+
+
+@pytest.mark.anyio
+async def test_room_queue_reloads_when_changes_are_gone(
+    mocker: MockFixture, db_path: str
+) -> None:
+    # a worker that missed pruned changes should reload the whole queue
+    backend = mocker.patch("core.state_backend._backend", SqliteBackend(db_path))
+    mocker.patch("core.state_backend.CHANGE_LOG_SIZE", 2)
+    room_queue = RoomQueue("room")
+
+    for identity in ["user1", "user2", "user3"]:
+        backend.queue_add("room", identity)
+    assert backend.queue_changes_since("room", 0) is None
+
+    room_queue.sync()
+
+    assert list(room_queue.queue) == ["user1", "user2", "user3"]
+    assert room_queue.hub.version == 3
+    _, events = room_queue.get_events_since(1)
+    assert events[0].startswith(b"id: 3\r\nevent: snapshot")
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_backend_remove_with_deadline(shared: bool, db_path: str):
+    # removing with a deadline should only remove the hand it was raised with
+    backend = SqliteBackend(db_path) if shared else MemoryBackend()
+    backend.queue_add("room", "user", 100.0)
+
+    assert backend.queue_remove("room", "user", 50.0) == (False, 1)
+    assert backend.get_deadline("room", "user") == 100.0
+    assert backend.get_raised_hands() == [("room", "user", 100.0)]
+    assert backend.queue_remove("room", "user", 100.0) == (True, 0)
+    assert backend.get_deadline("room", "user") is None
+
+
+def test_sqlite_backend_subscriptions(db_path: str) -> None:
+    worker1, worker2 = SqliteBackend(db_path), SqliteBackend(db_path)
+
+    worker1.add_subscription("room", {"endpoint": "url"})
+
+    assert worker2.get_subscriptions("room") == [{"endpoint": "url"}]
+    assert worker2.get_subscriptions("other room") == []
+
+
+def test_sqlite_backend_single_servo_owner(db_path: str) -> None:
+    # only one worker should drive the servo, the others send it commands
+    owner, other = SqliteBackend(db_path), SqliteBackend(db_path)
+
+    assert owner.claim_servo()
+    assert not other.claim_servo()
+
+    other.push_servo_command("RAISE")
+    other.push_servo_command("LOWER")
+
+    assert owner.pop_servo_commands() == ["RAISE", "LOWER"]
+    assert owner.pop_servo_commands() == []
+
+    # a worker that shuts down lets another one take over
+    owner.close()
+    assert other.claim_servo()
+    other.close()
+
+
+def test_memory_backend_servo_commands() -> None:
+    # commands come back once, in the order they were pushed
+    backend = MemoryBackend()
+    backend.push_servo_command("RAISE")
+    backend.push_servo_command("LOWER")
+
+    assert backend.pop_servo_commands() == ["RAISE", "LOWER"]
+    assert backend.pop_servo_commands() == []
@@ -0,0 +1,200 @@
+import asyncio
+import json
+from typing import List
+
+import pytest
+from fastapi import WebSocketException
+from pytest_mock import MockFixture
+
+from routes.captions_ws import CLOSE_TRY_AGAIN_LATER, ConnectionManager, get_manager
+
+
+class FakeWebSocket:
+    def __init__(self, stalled: bool = False) -> None:
+        self.stalled = stalled
+        self.sent: List[dict] = []
+        self.close_code = None
+
+    async def accept(self) -> None:
+        pass
+
+    async def send_text(self, message: str) -> None:
+        if self.stalled:
+            # a half-dead client that never acknowledges anything
+            await asyncio.Event().wait()
+        self.sent.append(json.loads(message))
+
+    async def close(self, code: int = 1000) -> None:
+        self.close_code = code
+
+
+@pytest.mark.anyio
+async def test_broadcast_doesnt_wait_for_slow_client() -> None:
+    # a stalled client should be dropped without holding up the others
+    manager = ConnectionManager()
+    fast, slow = FakeWebSocket(), FakeWebSocket(stalled=True)
+    await manager.connect(fast)
+    await manager.connect(slow)
+
+    for i in range(100):
+        manager.broadcast({"type": "caption", "id": i})
+        await asyncio.sleep(0)
+
+    assert [message["id"] for message in fast.sent] == list(range(100))
+    assert slow.close_code == CLOSE_TRY_AGAIN_LATER
+    assert manager.stats()["dropped"] == 1
+
+    await manager.disconnect(slow)
+    await manager.disconnect(fast)
+    assert manager.stats()["connections"] == 0
+
+
+@pytest.mark.anyio
+async def test_client_dropped_when_message_waits_too_long(monkeypatch) -> None:
+    # a client can be dropped for lag before its queue is full
+    manager = ConnectionManager()
+    slow = FakeWebSocket(stalled=True)
+    await manager.connect(slow)
+    writer = manager.active_connections[slow].writer
+    monkeypatch.setattr(writer, "max_lag_seconds", 0)
+
+    manager.broadcast({"type": "caption"})
+    manager.broadcast({"type": "caption"})
+    await asyncio.sleep(0.01)
+    manager.broadcast({"type": "caption"})
+    await asyncio.sleep(0)
+
+    assert writer.dropped
+    assert slow.close_code == CLOSE_TRY_AGAIN_LATER
+    await manager.disconnect(slow)
+
+
+@pytest.mark.anyio
+async def test_broadcast_encodes_once() -> None:
+    # every client should get the same text from a single encode
+    encoded = []
+
+    def encode(message: dict) -> str:
+        encoded.append(message)
+        return json.dumps(message)
+
+    manager = ConnectionManager(encode)
+    websockets = [FakeWebSocket() for _ in range(10)]
+    for websocket in websockets:
+        await manager.connect(websocket)
+
+    manager.broadcast({"type": "caption", "transcript": "hi"})
+    await asyncio.sleep(0)
+
+    assert len(encoded) == 1
+    assert all(
+        ws.sent == [{"type": "caption", "transcript": "hi"}] for ws in websockets
+    )
+    for websocket in websockets:
+        await manager.disconnect(websocket)
+
+
+def caption(caption_id: str, transcript: str) -> dict:
+    return {
+        "type": "caption",
+        "captionId": caption_id,
+        "identity": caption_id[0],
+        "transcript": transcript,
+        "timestamp": 0,
+    }
+
+
+@pytest.mark.anyio
+async def test_captions_batched_with_latest_update() -> None:
+    # interim updates in one window should go out as one frame with the latest
+    manager = ConnectionManager(batch_seconds=0.05)
+    websocket = FakeWebSocket()
+    await manager.connect(websocket)
+
+    # the first caption after a quiet period is sent right away
+    manager.send_caption(caption("a1", "hello"))
+    manager.send_caption(caption("a1", "hello every"))
+    manager.send_caption(caption("b1", "hi"))
+    manager.send_caption(caption("a1", "hello everyone"))
+    await asyncio.sleep(0)
+    assert websocket.sent == [caption("a1", "hello")]
+
+    await asyncio.sleep(0.1)
+    assert websocket.sent[1:] == [
+        {
+            "type": "caption_batch",
+            "captions": [caption("a1", "hello everyone"), caption("b1", "hi")],
+        }
+    ]
+
+    stats = manager.stats()
+    assert stats["captions"] == 4
+    assert stats["captions_superseded"] == 1
+    assert stats["caption_frames"] == 2
+    await manager.disconnect(websocket)
+
+
+@pytest.mark.anyio
+async def test_captions_on_count() -> None:
+    # caption state should follow the count of clients with captions on
+    manager = ConnectionManager()
+    first, second = FakeWebSocket(), FakeWebSocket()
+    await manager.connect(first, "user1")
+    await manager.connect(second, "user2")
+
+    assert await manager.set_websocket_caption_bool(first, True) is True
+    assert await manager.set_websocket_caption_bool(second, True) is None
+    # turning it on twice shouldn't count twice
+    assert await manager.set_websocket_caption_bool(second, True) is None
+    assert manager.captions_on_count == 2
+
+    assert await manager.set_websocket_caption_bool(first, False) is None
+    await manager.disconnect(second)
+    assert manager.captions_on_count == 0
+    assert not manager.is_captions_on
+
+    assert manager.connection_stats()[0]["identity"] == "user1"
+    assert manager.connection_stats()[0]["actions"] == 2
+    await manager.disconnect(first)
+
+
+@pytest.mark.anyio
+async def test_history_replayed_on_connect() -> None:
+    # a client joining late should get the finished captions it missed
+    manager = ConnectionManager(batch_seconds=0, replay_size=2)
+    for i in range(3):
+        manager.send_caption(
+            {**caption(f"a{i}", str(i)), "timestamp": i},
+            is_final=True,
+        )
+
+    websocket = FakeWebSocket()
+    await manager.connect(websocket, "late")
+    await asyncio.sleep(0)
+    assert websocket.sent[0]["history"]
+    assert [c["transcript"] for c in websocket.sent[0]["captions"]] == ["1", "2"]
+
+    # a reconnect with since only gets newer captions, and nothing if none
+    reconnected = FakeWebSocket()
+    await manager.connect(reconnected, "late", since=2)
+    await asyncio.sleep(0)
+    assert reconnected.sent == []
+
+    await manager.disconnect(websocket)
+    await manager.disconnect(reconnected)
+
+
+@pytest.mark.anyio
+async def test_rooms_limited(mocker: MockFixture) -> None:
+    # rooms without clients make space for new ones
+    mocker.patch("routes.captions_ws.MAX_CAPTION_ROOMS", 1)
+    managers = mocker.patch("routes.captions_ws.managers", {})
+
+    websocket = FakeWebSocket()
+    await get_manager("Lab").connect(websocket)
+    with pytest.raises(WebSocketException):
+        get_manager("Other")
+
+    await get_manager("Lab").disconnect(websocket)
+    get_manager("Other")
+    assert list(managers) == ["Other"]
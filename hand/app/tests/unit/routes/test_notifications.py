@@ -3,24 +3,31 @@ from unittest.mock import MagicMock, call
 import pytest
 from pytest_mock import MockFixture
 
+from core.state_backend import MemoryBackend
 from routes.notifications import send_notification
 
 
+@pytest.fixture
+def backend(mocker: MockFixture) -> MemoryBackend:
+    return mocker.patch("core.state_backend._backend", MemoryBackend())
+
+
 @pytest.fixture
 def mock_push(mocker: MockFixture) -> MagicMock:
     return mocker.patch("routes.notifications.push")
 
 
 @pytest.mark.anyio
-async def test_send_notification(mocker: MockFixture, mock_push: MagicMock) -> None:
+async def test_send_notification(backend: MemoryBackend, mock_push: MagicMock) -> None:
     # it should send a notification to each subscription
 
     mock_subs = [{1: "sub1"}, {2: "sub2"}]
-    mocker.patch("routes.notifications.subscriptions", mock_subs)
+    for sub in mock_subs:
+        backend.add_subscription("room", sub)
 
     name = "user"
 
-    await send_notification(name)
+    await send_notification(name, "room")
 
     expected_calls = [
         call(mock_subs[0], f"{name} has a question!"),
@@ -32,11 +39,11 @@ async def test_send_notification(mocker: MockFixture, mock_push: MagicMock) -> N
 
 @pytest.mark.anyio
 async def test_send_notification_no_subs(
-    mocker: MockFixture, mock_push: MagicMock
+    backend: MemoryBackend, mock_push: MagicMock
 ) -> None:
     # it shouldn't send any notifications when no subscriptions
 
-    mocker.patch("routes.notifications.subscriptions", [])
-    await send_notification("user")
+    backend.add_subscription("other room", {1: "sub1"})
+    await send_notification("user", "room")
 
     mock_push.assert_not_called()
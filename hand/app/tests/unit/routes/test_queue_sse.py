@@ -1,26 +1,173 @@
+from collections import deque
+
 import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
 from pytest_mock import MockFixture
 
-from routes.queue_sse import add_to_queue
+from core.constants import DEFAULT_ROOM
+from core.state_backend import MemoryBackend
+from main import app
+from routes.queue_sse import (
+    ConnectionSlots,
+    RoomQueue,
+    get_queue_length,
+    get_queue_position,
+    get_room_queue,
+    queue_sse,
+)
 
 
-@pytest.mark.anyio
-async def test_add_to_queue_new_identity(mocker: MockFixture):
-    mock_queue = mocker.patch("routes.queue_sse.queue", [])
+@pytest.fixture
+def room_queue(mocker: MockFixture) -> RoomQueue:
+    mocker.patch("core.state_backend._backend", MemoryBackend())
+    mocker.patch("routes.queue_sse.rooms", {})
+    return get_room_queue()
 
+
+@pytest.mark.anyio
+async def test_add_new_identity(room_queue: RoomQueue):
     identity = "user"
-    result = await add_to_queue(identity)
+    result = room_queue.add(identity)
 
     assert result == (True, 1)
-    assert mock_queue == [identity]
+    assert list(room_queue.queue) == [identity]
 
 
 @pytest.mark.anyio
-async def test_add_to_queue_same_identity(mocker: MockFixture):
+async def test_add_same_identity(room_queue: RoomQueue):
     identity = "user"
-    mock_queue = mocker.patch("routes.queue_sse.queue", [identity])
+    room_queue.add(identity)
 
-    result = await add_to_queue(identity)
+    result = room_queue.add(identity)
 
     assert result == (False, 1)
-    assert mock_queue == [identity]
+    assert list(room_queue.queue) == [identity]
+
+
+@pytest.mark.anyio
+async def test_get_queue_position(room_queue: RoomQueue):
+    room_queue.add("user1")
+    room_queue.add("user2")
+
+    assert await get_queue_position("user2") == 2
+    assert await get_queue_position("user3") is None
+
+
+@pytest.mark.anyio
+async def test_rooms_are_independent(room_queue: RoomQueue):
+    # the same identity can be queued in different rooms
+    room_queue.add("user1")
+    get_room_queue("Lab").add("user2")
+
+    assert get_room_queue("Lab").add("user1") == (True, 2)
+    assert list(room_queue.queue) == ["user1"]
+    assert room_queue.hub.version == 1
+
+
+@pytest.fixture
+def fresh_queue(room_queue: RoomQueue) -> RoomQueue:
+    room_queue.delta_log = deque(maxlen=2)
+    return room_queue
+
+
+@pytest.mark.anyio
+async def test_queue_events_snapshot_on_first_connect(fresh_queue: RoomQueue):
+    fresh_queue.add("user1")
+
+    version, events = fresh_queue.get_events_since(None)
+
+    assert version == 1
+    assert events == [b'id: 1\r\nevent: snapshot\r\ndata: ["user1"]\r\n\r\n']
+
+
+@pytest.mark.anyio
+async def test_queue_events_replay_missed_deltas(fresh_queue: RoomQueue):
+    # a client that reconnects with Last-Event-ID should only get what it missed
+    fresh_queue.add("user1")
+    fresh_queue.add("user2")
+    fresh_queue.remove("user1")
+
+    version, events = fresh_queue.get_events_since(2)
+
+    assert version == 3
+    assert events == [b'id: 3\r\nevent: remove\r\ndata: {"identity": "user1"}\r\n\r\n']
+
+
+@pytest.mark.anyio
+async def test_queue_events_snapshot_on_gap(fresh_queue: RoomQueue):
+    # deltas that fell out of the log can't be replayed, so send a snapshot
+    fresh_queue.add("user1")
+    fresh_queue.add("user2")
+    fresh_queue.add("user3")
+
+    _, events = fresh_queue.get_events_since(0)
+
+    assert events == [
+        b'id: 3\r\nevent: snapshot\r\ndata: ["user1", "user2", "user3"]\r\n\r\n'
+    ]
+
+
+@pytest.mark.anyio
+async def test_queue_payload_encoded_once_per_version(fresh_queue: RoomQueue):
+    # subscribers should share the same encoded frame until the queue changes
+    fresh_queue.add("user1")
+
+    first = fresh_queue.get_payloads()
+    assert fresh_queue.get_payloads() is first
+    assert first.frame == b'data: ["user1"]\r\n\r\n'
+
+    fresh_queue.add("user2")
+
+    assert fresh_queue.get_payloads() is not first
+
+
+def test_queue_sse_connection_limit(mocker: MockFixture):
+    # connections over the limit should be rejected right away
+    mocker.patch("routes.queue_sse.sse_slots", ConnectionSlots(0))
+
+    response = TestClient(app).get("/api/queue")
+
+    assert response.status_code == 503
+
+
+@pytest.mark.anyio
+async def test_queue_sse_slot_taken_before_stream(mocker: MockFixture):
+    # connections arriving together shouldn't all pass the limit before any of
+    # them has started streaming
+    slots = mocker.patch("routes.queue_sse.sse_slots", ConnectionSlots(1))
+    mocker.patch("routes.queue_sse.rooms", {})
+
+    response = await queue_sse(room=DEFAULT_ROOM, delta=False, last_event_id=None)
+    with pytest.raises(HTTPException) as error:
+        await queue_sse(room=DEFAULT_ROOM, delta=False, last_event_id=None)
+    assert error.value.status_code == 503
+
+    # the slot is freed once, whether the stream or the response ends first
+    await response.background()
+    await response.background()
+    assert slots.active == 0
+
+
+@pytest.mark.anyio
+async def test_rooms_limited(room_queue: RoomQueue, mocker: MockFixture):
+    # reads shouldn't create rooms, and idle rooms make space for new ones
+    mocker.patch("routes.queue_sse.MAX_ROOMS", 1)
+    rooms = mocker.patch("routes.queue_sse.rooms", {DEFAULT_ROOM: room_queue})
+
+    assert await get_queue_position("user", "Lab") is None
+    assert await get_queue_length("Lab") == 0
+    assert TestClient(app).get("/api/queue/stats?room=Lab").status_code == 404
+    assert list(rooms) == [DEFAULT_ROOM]
+
+    get_room_queue("Lab").add("user")
+    assert list(rooms) == ["Lab"]
+
+    # a room with a raised hand is kept
+    with pytest.raises(HTTPException) as error:
+        get_room_queue("Other")
+    assert error.value.status_code == 503
+
+    get_room_queue("Lab").remove("user")
+    get_room_queue("Other")
+    assert list(rooms) == ["Other"]
@@ -7,11 +7,11 @@ import { IconButton } from '@mui/material';
 import SpeechRecognition, { useSpeechRecognition } from 'react-speech-recognition';
 import useWebSocket from 'react-use-websocket';
 
-import { WS_SERVER_URL } from '../../../constants';
 import useLocalAudioToggle from '../../../hooks/useLocalAudioToggle/useLocalAudioToggle';
 import useVideoContext from '../../../hooks/useVideoContext/useVideoContext';
 import { useAppState } from '../../../state';
 import Snackbar from '../../Snackbar/Snackbar';
+import getCaptionsSocketUrl from '../../CaptionRenderer/captionsSocketUrl';
 import { CaptionActionMessage, CaptionSendMessage, CaptionWebSocketMessage } from '../../CaptionRenderer/CaptionTypes';
 
 const PREFIX = 'ToggleCaptionsButton';
@@ -52,7 +52,7 @@ export default function ToggleCaptionsButton() {
 
   const { displayCaptions, setDisplayCaptions } = useAppState();
 
-  const { lastJsonMessage, sendJsonMessage } = useWebSocket<CaptionWebSocketMessage>(`${WS_SERVER_URL}/captions`, {
+  const { lastJsonMessage, sendJsonMessage } = useWebSocket<CaptionWebSocketMessage>(getCaptionsSocketUrl, {
     queryParams: { identity },
     share: true,
     shouldReconnect: () => true,
@@ -125,6 +125,7 @@ export default function ToggleCaptionsButton() {
         type: 'caption',
         transcript: caption,
         id: captionIdRef.current,
+        isFinal,
       };
       sendJsonMessage(message);
 
@@ -5,8 +5,8 @@ import { styled } from '@mui/material/styles';
 import { Typography } from '@mui/material';
 import useWebSocket from 'react-use-websocket';
 
-import { Caption } from './CaptionTypes';
-import { WS_SERVER_URL } from '../../constants';
+import getCaptionsSocketUrl, { recordCaptionTimestamp } from './captionsSocketUrl';
+import { Caption, CaptionWebSocketMessage } from './CaptionTypes';
 import useVideoContext from '../../hooks/useVideoContext/useVideoContext';
 import { useAppState } from '../../state';
 import Snackbar from '../Snackbar/Snackbar';
@@ -39,8 +39,13 @@ const Root = styled('div')(({ theme }) => ({
   },
 }));
 
+interface ShownCaption extends Caption {
+  // when it was received, since replayed captions have old timestamps but still need to be shown
+  shownAt: number;
+}
+
 interface CaptionMap {
-  [identity: string]: Caption[];
+  [identity: string]: ShownCaption[];
 }
 
 export function CaptionRenderer() {
@@ -53,47 +58,62 @@ export function CaptionRenderer() {
 
   const [error, setError] = useState(false);
 
-  const { lastJsonMessage } = useWebSocket<Caption>(`${WS_SERVER_URL}/captions`, {
+  const { lastJsonMessage } = useWebSocket<CaptionWebSocketMessage>(getCaptionsSocketUrl, {
     queryParams: { identity },
     share: true,
+    shouldReconnect: () => true,
     onError: () => {
       setError(true);
     },
   });
 
-  const registerResult = useCallback((caption: Caption) => {
+  const registerResults = useCallback((newCaptions: Caption[]) => {
+    const shownAt = Date.now();
+    for (const caption of newCaptions) {
+      recordCaptionTimestamp(caption.timestamp);
+    }
+
     setCaptions((prevCaptions) => {
       const updatedCaptions = { ...prevCaptions };
 
-      let captionsArray = updatedCaptions[caption.identity] || [];
+      for (const newCaption of newCaptions) {
+        const caption = { ...newCaption, shownAt };
+        let captionsArray = updatedCaptions[caption.identity] || [];
 
-      const existingIndex = captionsArray.findIndex((item) => item.captionId === caption.captionId);
+        const existingIndex = captionsArray.findIndex((item) => item.captionId === caption.captionId);
 
-      if (existingIndex !== -1) {
-        // overwrite interim results
-        captionsArray[existingIndex] = caption;
-      } else {
-        captionsArray = [...captionsArray, caption];
+        if (existingIndex !== -1) {
+          // overwrite interim results
+          captionsArray = [...captionsArray];
+          captionsArray[existingIndex] = caption;
+        } else {
+          captionsArray = [...captionsArray, caption];
 
-        // only keep 15 last captions when there are over 30
-        if (captionsArray.length > 30) {
-          captionsArray = captionsArray.slice(-15);
+          // only keep 15 last captions when there are over 30
+          if (captionsArray.length > 30) {
+            captionsArray = captionsArray.slice(-15);
+          }
         }
-      }
 
-      updatedCaptions[caption.identity] = captionsArray;
+        updatedCaptions[caption.identity] = captionsArray;
+      }
       return updatedCaptions;
     });
   }, []);
 
   useEffect(() => {
-    if (lastJsonMessage !== null && lastJsonMessage.type === 'caption') {
-      const caption = lastJsonMessage as Caption;
-      registerResult(caption);
+    if (lastJsonMessage === null) return;
+
+    if (lastJsonMessage.type === 'caption') {
+      registerResults([lastJsonMessage]);
+    } else if (lastJsonMessage.type === 'caption_batch') {
+      // the server merges updates that arrive close together into one message, and
+      // sends the captions that were missed the same way when connecting
+      registerResults(lastJsonMessage.captions);
     }
-  }, [lastJsonMessage, registerResult]);
+  }, [lastJsonMessage, registerResults]);
 
-  // every second check captions to see if any are older than ten seconds
+  // every second check captions to see if any were shown more than ten seconds ago
   useEffect(() => {
     const intervalId = setInterval(() => {
       setCaptions((prevCaptions) => {
@@ -103,8 +123,8 @@ export function CaptionRenderer() {
 
         for (const captionIdentity of identities) {
           const captionSet = prevCaptions[captionIdentity];
-          // only include if most recent caption is newer than 10 seconds
-          if (captionSet[captionSet.length - 1].timestamp > now - 10000) {
+          // only include if most recent caption was shown in the last 10 seconds
+          if (captionSet[captionSet.length - 1].shownAt > now - 10000) {
             updatedCaptions[captionIdentity] = captionSet;
           }
         }
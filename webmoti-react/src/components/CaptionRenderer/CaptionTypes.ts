@@ -3,6 +3,7 @@ export interface CaptionSendMessage {
   type: 'caption';
   transcript: string;
   id: number;
+  isFinal: boolean;
 }
 
 export interface CaptionActionMessage {
@@ -19,6 +20,14 @@ export interface Caption {
   transcript: string;
 }
 
+// several captions sent together, with only the latest update of each
+export interface CaptionBatch {
+  type: 'caption_batch';
+  captions: Caption[];
+  // true for recent captions sent when connecting
+  history?: boolean;
+}
+
 interface StartRecordingMessage {
   type: 'start_recording';
 }
@@ -29,5 +38,6 @@ interface StopRecordingMessage {
 
 export type CaptionWebSocketMessage =
   | Caption
+  | CaptionBatch
   | StartRecordingMessage
   | StopRecordingMessage;
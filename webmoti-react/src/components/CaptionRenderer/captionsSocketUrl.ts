@@ -0,0 +1,17 @@
+import { WS_SERVER_URL } from '../../constants';
+
+// newest caption timestamp received, so a reconnect only replays the captions that were missed
+let lastCaptionTimestamp: number | null = null;
+
+export function recordCaptionTimestamp(timestamp: number) {
+  if (lastCaptionTimestamp === null || timestamp > lastCaptionTimestamp) {
+    lastCaptionTimestamp = timestamp;
+  }
+}
+
+// react-use-websocket calls this on every connect. the renderer and the captions button both use it so they get the
+// same url and keep sharing one socket
+export default function getCaptionsSocketUrl() {
+  const url = `${WS_SERVER_URL}/captions`;
+  return lastCaptionTimestamp === null ? url : `${url}?since=${lastCaptionTimestamp}`;
+}